@@ -1,6 +1,16 @@
+from array import array
+from heapq import heappush, heapreplace
 import logging
+import math
+from random import random
+import sys
 from time import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from checks.metric_types import MetricTypes
 from config import get_histogram_aggregates, get_histogram_percentiles
 
@@ -18,6 +28,31 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Relative accuracy of the values reported by the sketch histograms
+HISTOGRAM_RELATIVE_ACCURACY_DEFAULT = 0.01
+# Maximum number of buckets of each sign kept by a sketch histogram. Past it, the
+# buckets of the lowest absolute values are merged together.
+HISTOGRAM_SKETCH_MAX_BUCKETS = 2048
+# Histograms of at least this many samples find their median and percentiles
+# with numpy's selection, when it's available, rather than by sorting them
+HISTOGRAM_PARTITION_THRESHOLD = 256
+
+# Precision of the HyperLogLog sets: they use 2 ** precision registers, and their
+# relative error is around 1.04 / sqrt(2 ** precision), i.e. 1.6% for 12.
+SET_HLL_PRECISION_DEFAULT = 12
+MASK_64 = (1 << 64) - 1
+
+# Contexts over the per-name limit are folded into a context with this tag
+CONTEXT_OVERFLOW_TAG = 'context_overflow:true'
+# Period, in seconds, over which distinct contexts are counted against the limits
+CONTEXT_LIMIT_WINDOW = 10
+# Number of metric names over the context limits that are reported
+CONTEXT_LIMIT_TOP_K = 10
+
+# Number of packet contexts resolved (tags parsed, sorted and stripped of the
+# host and device magic tags) that aggregators keep around, per generation.
+CONTEXT_CACHE_SIZE_DEFAULT = 10000
+
 class Infinity(Exception): pass
 class UnknownValue(Exception): pass
 
@@ -26,7 +61,23 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There can be hundreds of thousands of live metrics, so they have no
+    per-instance dict: subclasses list their attributes in `__slots__`.
     """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -36,9 +87,15 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Add the points of another metric of the same context to this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -55,6 +112,12 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Keep the most recent value
+        if other.value is not None and other.last_sample_time >= self.last_sample_time:
+            self.value = other.value
+            self.last_sample_time = other.last_sample_time
+            self.timestamp = other.timestamp
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -80,6 +143,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -101,6 +165,8 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'value')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -133,6 +199,8 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -181,6 +249,8 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'value')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -195,6 +265,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -216,6 +290,8 @@ DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'count', 'samples', 'aggregates', 'percentiles')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -238,17 +314,54 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def summarize(self):
+        """
+        Return the min, max, median and average of the samples, and the list of
+        their percentiles. The median is None if it isn't one of the aggregates.
+        """
+        samples = self.samples
+        length = len(samples)
+        avg = sum(samples) / float(length)
+
+        # Ranks of the order statistics to report, negative ones count from the end
+        ranks = [int(round(p * length - 1)) for p in self.percentiles]
+        if 'median' in self.aggregates:
+            ranks.append(int(round(length/2 - 1)))
+
+        if not ranks:
+            # No need to order the samples for their extrema
+            return min(samples), max(samples), None, avg, []
+
+        if numpy is not None and length >= HISTOGRAM_PARTITION_THRESHOLD:
+            # Only put the requested ranks in place, the values are still read
+            # from the samples so that they keep their type.
+            kth = sorted(set([0, length - 1] + [rank % length for rank in ranks]))
+            order = numpy.argpartition(numpy.array(samples, dtype=float), kth)
+            value_at = lambda rank: samples[order[rank]]
+        else:
+            samples.sort()
+            value_at = samples.__getitem__
+
+        percentiles = [value_at(rank % length) for rank in ranks[:len(self.percentiles)]]
+        med = None
+        if len(ranks) > len(self.percentiles):
+            med = value_at(ranks[-1] % length)
+        return value_at(0), value_at(length - 1), med, avg, percentiles
+
+    def reset(self):
+        self.samples = []
+        self.count = 0
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
-
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+        min_, max_, med, avg, percentiles = self.summarize()
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -276,8 +389,7 @@ class Histogram(Metric):
             ) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in zip(self.percentiles, percentiles):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -290,14 +402,222 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
+        self.reset()
+
+        return metrics
+
+
+class SketchHistogram(Histogram):
+    """
+    A histogram that keeps its samples in logarithmic buckets, like DDSketch,
+    instead of keeping them all. Its memory is bounded whatever the number of
+    samples, and the values it reports are within `relative_accuracy` of the
+    ones of an exact histogram (min, max and avg are exact).
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'max_buckets', 'length', 'sum',
+        'min', 'max', 'zeros', 'positive', 'negative')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, name, tags, hostname, device_name,
+            extra_config)
+        relative_accuracy = None
+        if extra_config is not None:
+            relative_accuracy = extra_config.get('relative_accuracy')
+        self.relative_accuracy = relative_accuracy or HISTOGRAM_RELATIVE_ACCURACY_DEFAULT
+        self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = HISTOGRAM_SKETCH_MAX_BUCKETS
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.length = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.zeros = 0
+        # Bucket index: number of samples, for positive and negative samples
+        self.positive = {}
+        self.negative = {}
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.length += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value > 0:
+            self._add(self.positive, int(math.ceil(math.log(value) / self.log_gamma)), 1)
+        elif value < 0:
+            self._add(self.negative, int(math.ceil(math.log(-value) / self.log_gamma)), 1)
+        else:
+            self.zeros += 1
+        self.last_sample_time = time()
+
+    def _add(self, buckets, index, count):
+        buckets[index] = buckets.get(index, 0) + count
+        if len(buckets) > self.max_buckets:
+            # Merge the buckets of the lowest absolute values into the lowest one kept
+            indexes = sorted(buckets)
+            collapsed = indexes[:len(indexes) - self.max_buckets + 1]
+            total = 0
+            for i in collapsed:
+                total += buckets.pop(i)
+            buckets[collapsed[-1]] = total
+
+    def merge(self, other):
+        self.count += other.count
+        self.length += other.length
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.zeros += other.zeros
+        for index, count in other.positive.iteritems():
+            self._add(self.positive, index, count)
+        for index, count in other.negative.iteritems():
+            self._add(self.negative, index, count)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _value(self, index):
+        # The middle of the bucket, in relative terms
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _values_at(self, ranks):
+        """ Return the values of the samples of the given sorted ranks """
+        values = []
+        ranks = iter(ranks)
+        rank = next(ranks, None)
+        seen = 0
+        buckets = [(-self._value(i), self.negative[i]) for i in sorted(self.negative, reverse=True)]
+        if self.zeros:
+            buckets.append((0, self.zeros))
+        buckets.extend((self._value(i), self.positive[i]) for i in sorted(self.positive))
+        for value, count in buckets:
+            seen += count
+            while rank is not None and rank < seen:
+                # Values are at most relative_accuracy off, but never out of bounds
+                values.append(min(max(value, self.min), self.max))
+                rank = next(ranks, None)
+            if rank is None:
+                break
+        return values
+
+    def summarize(self):
+        length = self.length
+        ranks = [int(round(length/2 - 1))] + [int(round(p * length - 1)) for p in self.percentiles]
+        # Negative ranks count from the end, as in Histogram
+        ranks = [rank % length for rank in ranks]
+        order = sorted(xrange(len(ranks)), key=ranks.__getitem__)
+        sorted_values = self._values_at([ranks[i] for i in order])
+        values = [None] * len(ranks)
+        for i, value in zip(order, sorted_values):
+            values[i] = value
+
+        avg = self.sum / float(length)
+        return self.min, self.max, values[0], avg, values[1:]
+
+
+class ReservoirHistogram(Histogram):
+    """
+    A histogram that keeps at most `max_samples` of its samples: a uniform subset
+    of all the values it was sent, where values sent with a sample rate weigh
+    for the number of values they stand for. Its count, min, max and avg are
+    exact, its median and percentiles are those of the subset.
+
+    Samples are picked with weighted reservoir sampling (A-ExpJ): each value gets
+    a random key u ** (1 / weight), and the values of the highest keys are kept.
+    Rather than drawing a key for every value, the weight of the values to skip
+    before the next one that gets in is drawn. `keys` is a heap of the logs of
+    the keys, with the index of their value in samples.
+    """
+    __slots__ = ('max_samples', 'keys', 'skip', 'length', 'sum', 'min', 'max')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(ReservoirHistogram, self).__init__(formatter, name, tags, hostname, device_name,
+            extra_config)
+        self.max_samples = extra_config['max_samples']
+        self.reset()
+
+    def reset(self):
         self.samples = []
+        self.keys = []
+        self.skip = 0
         self.count = 0
+        self.length = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
 
-        return metrics
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.length += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last_sample_time = time()
+
+        keys = self.keys
+        if len(keys) < self.max_samples:
+            self._add(log_random() * sample_rate, value)
+            return
+
+        # Values weigh 1 / sample_rate
+        self.skip -= 1.0 / sample_rate
+        if self.skip <= 0:
+            # The key of this value is above the lowest one, draw it from there
+            lowest = math.exp(keys[0][0] / sample_rate)
+            self._add(math.log(lowest + (1 - lowest) * random()) * sample_rate, value)
+
+    def _add(self, key, value):
+        samples = self.samples
+        keys = self.keys
+        if len(samples) < self.max_samples:
+            heappush(keys, (key, len(samples)))
+            samples.append(value)
+        elif key > keys[0][0]:
+            # Replace the value of the lowest key
+            index = keys[0][1]
+            heapreplace(keys, (key, index))
+            samples[index] = value
+        else:
+            return
+        if len(keys) == self.max_samples:
+            self.skip = log_random() / keys[0][0]
+
+    def merge(self, other):
+        # Keys don't depend on the other values, the highest ones of both are kept
+        for key, index in other.keys:
+            self._add(key, other.samples[index])
+        self.count += other.count
+        self.length += other.length
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def summarize(self):
+        min_, max_, med, avg, percentiles = super(ReservoirHistogram, self).summarize()
+        return self.min, self.max, med, self.sum / float(self.length), percentiles
+
+
+def log_random():
+    """ The log of a random number uniformly picked in ]0;1[, which is negative """
+    return math.log(random() or 1e-300)
 
 
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'values')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -312,6 +632,10 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -330,8 +654,121 @@ class Set(Metric):
             self.values = set()
 
 
+def bit_length(n):
+    """
+    Number of bits of the non-negative integer `n`, like int.bit_length, which
+    Python 2.6 doesn't have. frexp is exact on the halves of a 64-bit integer,
+    which fit in a double.
+    """
+    high = n >> 32
+    if high:
+        return math.frexp(high)[1] + 32
+    return math.frexp(n)[1]
+
+
+def hash64(value):
+    """ A 64-bit hash of a value, the same in every process (MurmurHash3's finalizer on hash()) """
+    h = hash(value) & MASK_64
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK_64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK_64
+    h ^= h >> 33
+    return h
+
+
+class HyperLogLogSet(Set):
+    """
+    A set that estimates its number of unique elements with a HyperLogLog, in a
+    fixed amount of memory per context. Small sets keep their values, and are
+    exact, until they'd take more memory than the registers.
+    """
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(HyperLogLogSet, self).__init__(formatter, name, tags, hostname, device_name,
+            extra_config)
+        precision = None
+        if extra_config is not None:
+            precision = extra_config.get('precision')
+        self.precision = precision or SET_HLL_PRECISION_DEFAULT
+        self.registers = None
+
+    def sample(self, value, sample_rate, timestamp=None):
+        if self.registers is None:
+            self.values.add(value)
+            if len(self.values) > (1 << self.precision) >> 4:
+                self._densify()
+        else:
+            self._add_hash(hash64(value))
+        self.last_sample_time = time()
+
+    def _densify(self):
+        self.registers = bytearray(1 << self.precision)
+        for value in self.values:
+            self._add_hash(hash64(value))
+        self.values = set()
+
+    def _add_hash(self, h):
+        # The first bits pick the register, which keeps the longest run of
+        # leading zeros seen in the others.
+        width = 64 - self.precision
+        index = h >> width
+        rank = width - bit_length(h & ((1 << width) - 1)) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError("Can't merge sets of precisions %s and %s" % (self.precision, other.precision))
+        if self.registers is None and other.registers is None:
+            self.values.update(other.values)
+            if len(self.values) > (1 << self.precision) >> 4:
+                self._densify()
+        else:
+            if self.registers is None:
+                self._densify()
+            if other.registers is not None:
+                self.registers = bytearray(map(max, self.registers, other.registers))
+            for value in other.values:
+                self._add_hash(hash64(value))
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def cardinality(self):
+        if self.registers is None:
+            return len(self.values)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def flush(self, timestamp, interval):
+        if not self.values and self.registers is None:
+            return []
+        try:
+            return [self.formatter(
+                hostname=self.hostname,
+                device_name=self.device_name,
+                tags=self.tags,
+                metric=self.name,
+                value=self.cardinality(),
+                timestamp=timestamp,
+                metric_type=MetricTypes.GAUGE,
+                interval=interval,
+            )]
+        finally:
+            self.values = set()
+            self.registers = None
+
+
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+        'samples')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -382,6 +819,328 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class ColumnStore(object):
+    """
+    Keeps the values of counters, or of gauges, of all buckets in columns.
+
+    Contexts get an index in a table shared by all the buckets, and each bucket
+    stores its values and sample times in array('d') columns at that index, along
+    with the list of indexes sampled in the bucket. Sampling a known context is
+    then an index lookup and a store, without creating any object per context
+    and bucket. With `exact_values`, values are kept in a list instead, so that
+    integers past 2 ** 53, which doubles can't represent, are flushed as is.
+
+    Contexts that haven't been sampled since the expiry time are dropped, and
+    their index reused. To find them without going through all the contexts,
+    they're grouped in slots of `expiry_resolution` seconds of last sample time.
+
+    The series each context is flushed as, minus its points, can be kept in the
+    `templates` column, so that flushes only copy it.
+    """
+
+    def __init__(self, expiry_resolution=1, exact_values=False):
+        self.exact_values = exact_values
+        self.index_by_context = {}
+        self.contexts = []
+        self.templates = []
+        self.free_indexes = []
+        # Last time each context was sampled in a flushed bucket
+        self.last_sample_times = array('d')
+        self.expiry_resolution = expiry_resolution
+        # Slot: indexes of the contexts last sampled in that slot
+        self.expiry_slots = {}
+        self.expiry_slot_by_index = {}
+        # Bucket start timestamp: (values, sample times, sampled indexes)
+        self.buckets = {}
+        self.current_bucket = None
+        self.current_columns = None
+
+    def index(self, context):
+        """ Return the index of a context, allocating one if needed """
+        index = self.index_by_context.get(context)
+        if index is None:
+            if self.free_indexes:
+                index = self.free_indexes.pop()
+                self.contexts[index] = context
+                self.templates[index] = None
+                self.last_sample_times[index] = 0
+            else:
+                index = len(self.contexts)
+                self.contexts.append(context)
+                self.templates.append(None)
+                self.last_sample_times.append(0)
+            self.index_by_context[context] = index
+        return index
+
+    def columns(self, bucket_start_timestamp):
+        """ Return the columns of a bucket, large enough for all the known contexts """
+        if bucket_start_timestamp == self.current_bucket:
+            columns = self.current_columns
+        else:
+            columns = self.buckets.get(bucket_start_timestamp)
+            if columns is None:
+                columns = ([] if self.exact_values else array('d'), array('d'), [])
+                self.buckets[bucket_start_timestamp] = columns
+            self.current_bucket = bucket_start_timestamp
+            self.current_columns = columns
+
+        values, sample_times = columns[0], columns[1]
+        missing = len(self.contexts) - len(values)
+        if missing > 0:
+            # Grow geometrically so that new contexts don't copy the columns every time
+            padding = array('d', [0]) * max(missing, len(values))
+            if self.exact_values:
+                values.extend([0] * len(padding))
+            else:
+                values.extend(padding)
+            sample_times.extend(padding)
+        return columns
+
+    def pop(self, bucket_start_timestamp):
+        """ Remove the columns of a bucket, and return them """
+        columns = self.buckets.pop(bucket_start_timestamp, None)
+        if bucket_start_timestamp == self.current_bucket:
+            self.current_bucket = None
+            self.current_columns = None
+        if columns is not None:
+            self.retire(columns)
+        return columns
+
+    def detach(self, before=None):
+        """
+        Remove the columns of the buckets started before `before`, or of all the
+        buckets if None, and return them by bucket start timestamp. Their sample
+        times only count for expiry once they're passed to `retire`.
+        """
+        detached = {}
+        for bucket_start_timestamp in self.buckets.keys():
+            if before is None or bucket_start_timestamp < before:
+                detached[bucket_start_timestamp] = self.buckets.pop(bucket_start_timestamp)
+        if self.current_bucket in detached:
+            self.current_bucket = None
+            self.current_columns = None
+        return detached
+
+    def retire(self, columns):
+        """ Record the sample times of the columns of a removed bucket """
+        last_sample_times = self.last_sample_times
+        expiry_resolution = self.expiry_resolution
+        expiry_slots = self.expiry_slots
+        expiry_slot_by_index = self.expiry_slot_by_index
+        sample_times = columns[1]
+        for index in columns[2]:
+            sample_time = sample_times[index]
+            if sample_time > last_sample_times[index]:
+                last_sample_times[index] = sample_time
+                # Move the context to the expiry slot of its new sample time
+                slot = int(sample_time // expiry_resolution)
+                previous_slot = expiry_slot_by_index.get(index)
+                if slot != previous_slot:
+                    if previous_slot is not None:
+                        indexes = expiry_slots[previous_slot]
+                        indexes.discard(index)
+                        if not indexes:
+                            del expiry_slots[previous_slot]
+                    if slot in expiry_slots:
+                        expiry_slots[slot].add(index)
+                    else:
+                        expiry_slots[slot] = set([index])
+                    expiry_slot_by_index[index] = slot
+
+    def expire(self, expiry_timestamp):
+        """
+        Free the indexes of the contexts not sampled since `expiry_timestamp`,
+        and return these contexts.
+        """
+        expired = []
+        pending = None
+        expiry_resolution = self.expiry_resolution
+        last_sample_times = self.last_sample_times
+        for slot in sorted(self.expiry_slots):
+            if slot * expiry_resolution >= expiry_timestamp:
+                break
+            indexes = self.expiry_slots[slot]
+            # Only the most recent slot can hold contexts that don't expire yet
+            partial = (slot + 1) * expiry_resolution > expiry_timestamp
+            for index in list(indexes):
+                if partial and last_sample_times[index] >= expiry_timestamp:
+                    continue
+                if pending is None:
+                    # Contexts sampled in buckets that haven't been flushed yet
+                    pending = set()
+                    for columns in self.buckets.itervalues():
+                        pending.update(columns[2])
+                if index in pending:
+                    continue
+                indexes.discard(index)
+                del self.expiry_slot_by_index[index]
+                context = self.contexts[index]
+                del self.index_by_context[context]
+                self.contexts[index] = None
+                self.templates[index] = None
+                last_sample_times[index] = 0
+                self.free_indexes.append(index)
+                expired.append(context)
+            if not indexes:
+                del self.expiry_slots[slot]
+        return expired
+
+    def __len__(self):
+        return len(self.index_by_context)
+
+
+class SpaceSaving(object):
+    """
+    Keeps track of the `size` most frequent keys of a stream, with the
+    Space-Saving algorithm: a new key replaces the least frequent one and
+    inherits its count, so counts can be overestimated, never underestimated.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.size:
+            counts[key] = count
+        else:
+            least_frequent = min(counts, key=counts.get)
+            counts[key] = counts.pop(least_frequent) + count
+
+    def top(self):
+        """ Return the (key, count) pairs, most frequent first """
+        return sorted(self.counts.iteritems(), key=lambda item: item[1], reverse=True)
+
+    def clear(self):
+        self.counts = {}
+
+
+class ContextLimiter(object):
+    """
+    Limits the rate of new contexts: the number of distinct contexts submitted
+    over `window` seconds, in total and per metric name. It doesn't bound the
+    number of live contexts: counters and gauges are reported until they
+    expire, so up to expiry_seconds / window times more contexts can be live.
+
+    Over the global limit, samples of new contexts are dropped. Over the limit of
+    their name, they're dropped, or folded into a context of the same name
+    tagged with CONTEXT_OVERFLOW_TAG if `overflow` is 'fold'. The names with the
+    most limited samples are tracked with a SpaceSaving.
+    """
+
+    def __init__(self, max_new_contexts=None, max_new_contexts_per_name=None, overflow='fold',
+            window=CONTEXT_LIMIT_WINDOW, top_k=CONTEXT_LIMIT_TOP_K):
+        if overflow not in ('fold', 'drop'):
+            raise ValueError("Invalid context overflow %s, expected fold or drop" % overflow)
+        self.max_new_contexts = max_new_contexts
+        self.max_new_contexts_per_name = max_new_contexts_per_name
+        self.overflow = overflow
+        self.window = window
+        self.window_end = 0
+        self.admitted = set()
+        self.count_by_name = {}
+        self.limited = 0
+        self.offenders = SpaceSaving(top_k)
+
+    def admit(self, context):
+        """
+        Return the context to submit a sample of `context` to, which is either
+        itself or its overflow context, or None if the sample must be dropped.
+        """
+        if context in self.admitted:
+            return context
+
+        now = time()
+        if now >= self.window_end:
+            self.admitted = set()
+            self.count_by_name = {}
+            self.window_end = now + self.window
+
+        name = context[0]
+        if self.max_new_contexts and len(self.admitted) >= self.max_new_contexts:
+            self._limit(name)
+            return None
+
+        if self.max_new_contexts_per_name:
+            count = self.count_by_name.get(name, 0)
+            if count >= self.max_new_contexts_per_name:
+                self._limit(name)
+                if self.overflow == 'drop':
+                    return None
+                context = (name, (CONTEXT_OVERFLOW_TAG, ), context[2], None)
+                # Overflow contexts don't count against the limit of their name
+                self.admitted.add(context)
+                return context
+            self.count_by_name[name] = count + 1
+
+        self.admitted.add(context)
+        return context
+
+    def share(self, count):
+        """
+        Only allow a `count`-th of the limits, for one of `count` aggregators
+        sharing the traffic, e.g. dogstatsd workers.
+        """
+        if self.max_new_contexts:
+            self.max_new_contexts = max(self.max_new_contexts // count, 1)
+        if self.max_new_contexts_per_name:
+            self.max_new_contexts_per_name = max(self.max_new_contexts_per_name // count, 1)
+
+    def _limit(self, name):
+        self.limited += 1
+        self.offenders.add(name)
+
+    def merge(self, limited, offenders):
+        """ Add the output of another limiter's `flush` to this one """
+        self.limited += limited
+        for name, count in offenders:
+            self.offenders.add(name, count)
+
+    def flush(self):
+        """ Return the number of limited samples and the top offenders since the last flush """
+        limited, offenders = self.limited, self.offenders.top()
+        self.limited = 0
+        self.offenders.clear()
+        return limited, offenders
+
+
+class ContextCache(object):
+    """
+    A bounded cache that approximates a LRU with two generations: new entries go
+    to the current generation, and entries found in the previous generation are
+    moved back to the current one. When the current generation is full, it
+    becomes the previous one and the previous one is dropped. Lookups of recent
+    entries are a single dict lookup.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key):
+        value = self.current.get(key)
+        if value is None:
+            value = self.previous.get(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -392,7 +1151,10 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_backend=None,
+            histogram_relative_accuracy=None, set_backend=None, set_precision=None,
+            max_new_contexts=None, max_new_contexts_per_name=None, context_overflow=None,
+            histogram_max_samples=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -402,22 +1164,63 @@ class Aggregator(object):
         self.hostname = hostname
         self.expiry_seconds = expiry_seconds
         self.formatter = formatter or api_formatter
+        # Formatters that return api series can pre-render them, without points
+        self.series_template = getattr(self.formatter, 'series_template', None)
         self.interval = float(interval)
 
         recent_point_threshold = recent_point_threshold or RECENT_POINT_THRESHOLD_DEFAULT
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Histograms keep all their samples, a bounded subset, or an approximation of them
+        if histogram_backend == 'sketch':
+            self.histogram_class = SketchHistogram
+        elif histogram_max_samples:
+            self.histogram_class = ReservoirHistogram
+        else:
+            self.histogram_class = Histogram
+
+        # Sets keep all their values, or estimate their cardinality
+        if set_backend == 'hyperloglog':
+            self.set_class = HyperLogLogSet
+        else:
+            self.set_class = Set
+
         # Additional config passed when instantiating metric configs
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
                 'percentiles': histogram_percentiles
+            },
+            SketchHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'relative_accuracy': histogram_relative_accuracy
+            },
+            ReservoirHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'max_samples': histogram_max_samples
+            },
+            HyperLogLogSet: {
+                'precision': set_precision
             }
         }
 
         self.utf8_decoding = utf8_decoding
 
+        if context_cache_size is None:
+            context_cache_size = CONTEXT_CACHE_SIZE_DEFAULT
+        self.context_cache = ContextCache(int(context_cache_size))
+
+        # Guard against clients creating too many contexts
+        self.context_limiter = None
+        if max_new_contexts or max_new_contexts_per_name:
+            self.context_limiter = ContextLimiter(max_new_contexts, max_new_contexts_per_name,
+                context_overflow or 'fold')
+        self.context_limited_count = 0
+        self.context_limit_offenders = []
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -427,68 +1230,90 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
-        """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
 
-        if len(name_and_metadata) != 2:
+        Return a list of (name, value, metric_type, raw tags string, sample_rate).
+        """
+        name, separator, data = packet.partition(':')
+        if not separator:
             raise Exception('Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
+        # Tags are the only field that can be long, get them out of the way in
+        # one go. Unless there's a colon before them (multiple values) or more
+        # metadata after them, which is rare, we're left with a few short fields.
+        datum, tags_separator, tags = data.partition('|#')
+        if ':' in datum or '|' in tags:
+            data = self._split_metric_values(data)
+        else:
+            data = ((datum, tags_separator, tags),)
 
-        for datum in data:
+        parsed_packets = []
+        for datum, tags_separator, tags in data:
             value_and_metadata = datum.split('|')
-
             if len(value_and_metadata) < 2:
                 raise Exception('Unparseable metric packet: %s' % packet)
 
-            # Submit the metric
             raw_value = value_and_metadata[0]
             metric_type = value_and_metadata[1]
 
             if metric_type in self.ALLOW_STRINGS:
                 value = raw_value
             else:
-                # Try to cast as an int first to avoid precision issues, then as a
-                # float.
+                # Parse integers as such to avoid precision issues, and only
+                # fall back to float for the others.
                 try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
+                    if raw_value.isdigit() or (raw_value[:1] in '-+' and raw_value[1:].isdigit()):
+                        value = int(raw_value)
+                    else:
                         value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
-
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
 
-            # Parse the optional values - sample rate & tags.
+            # Parse the optional sample rate
             sample_rate = 1
-            tags = None
-            for m in value_and_metadata[2:]:
-                # Parse the sample rate
-                if m[0] == '@':
-                    sample_rate = float(m[1:])
-                    assert 0 <= sample_rate <= 1
-                elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
+            if len(value_and_metadata) > 2:
+                for m in value_and_metadata[2:]:
+                    if m[0] == '@':
+                        sample_rate = float(m[1:])
+                        assert 0 <= sample_rate <= 1
 
-            parsed_packets.append((name, value, metric_type, tags,sample_rate))
+            # Tags are returned as sent, they're parsed along with the context
+            # by the aggregator, only when it doesn't know it yet.
+            if not tags_separator:
+                tags = None
+
+            parsed_packets.append((name, value, metric_type, tags, sample_rate))
 
         return parsed_packets
 
+    def _split_metric_values(self, data):
+        """
+        Split the values of a multi-value packet, e.g. `1|c|#tag:value:2|c`, into
+        (<value>|<metric_type>|<metadata>, <tags separator>, <tags>) tuples
+        """
+        values = []
+        partial_datum = None
+        for token in data.split(':'):
+            # We need to fix the tag groups that got broken by the : split
+            if partial_datum is None:
+                partial_datum = token
+            elif "|" not in token:
+                partial_datum += ":" + token
+            else:
+                values.append(partial_datum)
+                partial_datum = token
+        values.append(partial_datum)
+
+        result = []
+        for value in values:
+            datum, tags_separator, tags = value.partition('|#')
+            if '|' in tags:
+                # Move the metadata following the tags back with the others
+                tags, _, metadata = tags.partition('|')
+                datum += '|' + metadata
+            result.append((datum, tags_separator, tags))
+        return result
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -582,26 +1407,66 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
+        context_cache_get = self.context_cache.get
+        context_cache_set = self.context_cache.set
+        context_limiter = self.context_limiter
+
+        # Packets can be batched, a bad one mustn't make us lose the next ones:
+        # the first error is raised once all of them are submitted.
+        error = None
         for packet in packets.splitlines():
             if not packet.strip():
                 continue
 
-            if packet.startswith('_e'):
-                self.event_count += 1
-                event = self.parse_event_packet(packet)
-                self.event(**event)
-            elif packet.startswith('_sc'):
-                self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-            else:
-                self.count += 1
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
+            try:
+                if packet.startswith('_e'):
+                    self.event_count += 1
+                    event = self.parse_event_packet(packet)
+                    self.event(**event)
+                elif packet.startswith('_sc'):
+                    self.service_check_count += 1
+                    service_check = self.parse_sc_packet(packet)
+                    self.service_check(**service_check)
+                else:
+                    self.count += 1
+                    parsed_packets = self.parse_metric_packet(packet)
+                    for name, value, mtype, raw_tags, sample_rate in parsed_packets:
+                        # Clients send the same series over and over, skip the parsing
+                        # of their tags once we've seen them.
+                        key = (name, raw_tags)
+                        context = context_cache_get(key)
+                        if context is None:
+                            context = self._resolve_context(name, raw_tags)
+                            context_cache_set(key, context)
+                        if context_limiter is not None:
+                            context = context_limiter.admit(context)
+                            if context is None:
+                                continue
+                        self.submit_context_metric(context, value, mtype, sample_rate=sample_rate)
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+                else:
+                    log.exception("Error submitting packet %r" % (packet, ))
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _resolve_context(self, name, raw_tags):
+        """ Build the context of a metric from the raw tags of its packet """
+        tags = None
+        if raw_tags is not None:
+            tags = tuple(raw_tags.split(','))
+        hostname, device_name, tags = self._extract_magic_tags(tags)
+        return self._get_context(name, tags, hostname, device_name)
+
+    def _get_context(self, name, tags, hostname, device_name):
+        # Keep hostname with empty string to unset it
+        hostname = hostname if hostname is not None else self.hostname
 
+        if tags is None:
+            return (name, tuple(), hostname, device_name)
+        return (name, tuple(sorted(set(tags))), hostname, device_name)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -618,7 +1483,7 @@ class Aggregator(object):
                     device_name = tag[7:]
                     tags_to_remove.append(tag)
             if tags_to_remove:
-                # tags is a tuple already sorted, we convert it into a list to pop elements
+                # tags is a tuple, we convert it into a list to pop elements
                 tags = list(tags)
                 for tag in tags_to_remove:
                     tags.remove(tag)
@@ -630,6 +1495,13 @@ class Aggregator(object):
         """ Add a metric to be aggregated """
         raise NotImplementedError()
 
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
+        """
+        Add a metric to be aggregated, given its (name, sorted tags, hostname, device_name)
+        context. Metrics report the tags of their context unless `tags` are given.
+        """
+        raise NotImplementedError()
+
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
         event = {
             'msg_title': title,
@@ -704,6 +1576,22 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def send_context_limit_stats(self):
+        """
+        Submit the number of samples dropped or folded by the context limits since
+        the last call, and the metric names with the most of them. Both are also
+        kept in `context_limited_count` and `context_limit_offenders`.
+        """
+        if self.context_limiter is None:
+            return
+        limited, offenders = self.context_limiter.flush()
+        self.submit_metric('datadog.dogstatsd.context.limited', limited, 'g')
+        for name, count in offenders:
+            self.submit_metric('datadog.dogstatsd.context.limited_by_name', count, 'g',
+                tags=['metric_name:%s' % name])
+        self.context_limited_count = limited
+        self.context_limit_offenders = offenders
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -712,7 +1600,10 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_backend=None,
+            histogram_relative_accuracy=None, set_backend=None, set_precision=None,
+            max_new_contexts=None, max_new_contexts_per_name=None, context_overflow=None,
+            histogram_max_samples=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -721,48 +1612,75 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_backend,
+            histogram_relative_accuracy,
+            set_backend,
+            set_precision,
+            max_new_contexts,
+            max_new_contexts_per_name,
+            context_overflow,
+            histogram_max_samples
         )
         self.metric_by_bucket = {}
-        self.last_sample_time_by_context = {}
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
+        # Buckets are only flushed once closed before this time, if set. Dogstatsd
+        # workers set it to when they last exported, so that the main process
+        # doesn't flush a bucket they may still hold samples of.
+        self.flush_time_limit = None
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
         }
+        # Counters and gauges are the bulk of the contexts, they're kept in
+        # columns rather than in metric objects. Gauges are flushed as they're
+        # sampled, so integer gauges are kept exact.
+        self.counter_store = ColumnStore(self.interval)
+        self.gauge_store = ColumnStore(self.interval, exact_values=True)
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                                 device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        # Note: if you change the way that context is created, please also change flush_columns
+        #  and create_empty_metrics, which count on this order
+        context = self._get_context(name, tags, hostname, device_name)
+        self.submit_context_metric(context, value, mtype, timestamp, sample_rate)
 
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
+
+            if mtype == 'c' or mtype == 'g':
+                store = self.counter_store if mtype == 'c' else self.gauge_store
+                index = store.index_by_context.get(context)
+                if index is None:
+                    index = store.index(context)
+                values, sample_times, sampled = store.columns(bucket_start_timestamp)
+                if not sample_times[index]:
+                    sampled.append(index)
+                if mtype == 'c':
+                    values[index] += value * int(1 / sample_rate)
+                else:
+                    values[index] = value
+                sample_times[index] = cur_time
+                return
+
             if bucket_start_timestamp == self.current_bucket:
                 metric_by_context = self.current_mbc
             else:
@@ -774,75 +1692,357 @@ class MetricsBucketAggregator(Aggregator):
 
             if context not in metric_by_context:
                 metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+                # Report the deduplicated and sorted tags of the context, whatever the
+                # order they were received in.
+                metric_by_context[context] = metric_class(self.formatter, context[0], context[1] or None,
+                    context[2], context[3], self.metric_config.get(metric_class))
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
-        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
-        #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
+    def swap(self, flush_cutoff_time=None):
+        """
+        Detach the buckets started before `flush_cutoff_time`, or all the buckets
+        if None, and the packet count from the aggregator, and return them.
+
+        This is the only step of a flush or an export that must not run concurrently
+        with submissions: new samples go to fresh buckets, and the detached ones
+        can then be flushed or exported while samples keep coming in.
+
+        When all the buckets are detached, to be exported, the counter and gauge
+        stores are handed over with them and replaced by empty ones: the contexts
+        are only needed to export the buckets, the aggregator importing them
+        expires them, so they'd otherwise pile up here.
+        """
+        metric_by_bucket = {}
+        for bucket_start_timestamp in self.metric_by_bucket.keys():
+            if flush_cutoff_time is None or bucket_start_timestamp < flush_cutoff_time:
+                metric_by_bucket[bucket_start_timestamp] = self.metric_by_bucket.pop(bucket_start_timestamp)
+        self.current_bucket = None
+        self.current_mbc = {}
+
+        count = self.count
+        self.count = 0
+        num_discarded_old_points = self.num_discarded_old_points
+        self.num_discarded_old_points = 0
+
+        counter_store = self.counter_store
+        gauge_store = self.gauge_store
+        if flush_cutoff_time is None:
+            self.counter_store = ColumnStore(self.interval)
+            self.gauge_store = ColumnStore(self.interval, exact_values=True)
+
+        return {
+            'metric_by_bucket': metric_by_bucket,
+            'counter_store': counter_store,
+            'gauge_store': gauge_store,
+            'counter_buckets': counter_store.detach(flush_cutoff_time),
+            # Contexts keep being added while the buckets are flushed, the idle
+            # counters are looked for among the ones known at this point
+            'counter_context_count': len(counter_store.contexts),
+            'gauge_buckets': gauge_store.detach(flush_cutoff_time),
+            'count': count,
+            'num_discarded_old_points': num_discarded_old_points,
+        }
+
+    def export_state(self, snapshot=None):
+        """
+        Hand over the content of the aggregator, i.e. the metrics of all its buckets
+        (closed or not), its packet count, events and service checks, and reset it.
+        The result can be pickled and merged into another aggregator with
+        `import_state`, this is how dogstatsd workers feed the main process.
+
+        `snapshot` is the output of `swap()` if it was taken already.
+        """
+        if snapshot is None:
+            snapshot = self.swap()
+
+        metrics = []
+        for bucket_start_timestamp, metric_by_context in snapshot['metric_by_bucket'].iteritems():
+            for context, metric in metric_by_context.iteritems():
+                # Formatters can be closures, which can't be pickled
+                metric.formatter = None
+                metrics.append((bucket_start_timestamp, context, metric))
+
+        # Columns are exported as metric objects
+        for store, metric_class, buckets in ((snapshot['counter_store'], Counter, snapshot['counter_buckets']),
+                (snapshot['gauge_store'], BucketGauge, snapshot['gauge_buckets'])):
+            for bucket_start_timestamp, columns in buckets.iteritems():
+                values, sample_times, sampled = columns
+                for index in sampled:
+                    context = store.contexts[index]
+                    metric = metric_class(None, context[0], context[1] or None, context[2], context[3])
+                    metric.value = values[index]
+                    metric.last_sample_time = sample_times[index]
+                    metrics.append((bucket_start_timestamp, context, metric))
+
+        count = snapshot['count']
+
+        context_limits = None
+        if self.context_limiter is not None:
+            context_limits = self.context_limiter.flush()
+
+        return {
+            'metrics': metrics,
+            'count': count,
+            'events': self.flush_events(),
+            'service_checks': self.flush_service_checks(),
+            'context_limits': context_limits,
+        }
+
+    def import_state(self, state):
+        """
+        Merge the output of another aggregator's `export_state` into this one.
+
+        Samples of buckets already flushed go to the oldest bucket not flushed
+        yet: flushing their bucket again would report its timestamp twice, the
+        second time with only these samples and zeros for the idle counters.
+        """
+        oldest_bucket_start = self.last_flush_cutoff_time
+        for bucket_start_timestamp, context, metric in state['metrics']:
+            if bucket_start_timestamp < oldest_bucket_start:
+                bucket_start_timestamp = oldest_bucket_start
+            metric_class = type(metric)
+            if metric_class is Counter or metric_class is BucketGauge:
+                store = self.counter_store if metric_class is Counter else self.gauge_store
+                index = store.index(context)
+                values, sample_times, sampled = store.columns(bucket_start_timestamp)
+                if not sample_times[index]:
+                    sampled.append(index)
+                    values[index] = metric.value
+                    sample_times[index] = metric.last_sample_time
+                elif metric_class is Counter:
+                    values[index] += metric.value
+                    sample_times[index] = max(sample_times[index], metric.last_sample_time)
+                elif metric.last_sample_time >= sample_times[index]:
+                    # Keep the most recent gauge value
+                    values[index] = metric.value
+                    sample_times[index] = metric.last_sample_time
+                continue
+
+            if bucket_start_timestamp not in self.metric_by_bucket:
+                self.metric_by_bucket[bucket_start_timestamp] = {}
+            metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+
+            if context in metric_by_context:
+                metric_by_context[context].merge(metric)
             else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+                metric.formatter = self.formatter
+                metric_by_context[context] = metric
+
+        self.count += state['count']
+        self.events.extend(state['events'])
+        self.event_count += len(state['events'])
+        self.service_checks.extend(state['service_checks'])
+        self.service_check_count += len(state['service_checks'])
+        if state.get('context_limits') and self.context_limiter is not None:
+            self.context_limiter.merge(*state['context_limits'])
+
+    def create_empty_metrics(self, expiry_timestamp, flush_timestamp, metrics, sample_times=None,
+            context_count=None):
+        """
+        Even if no data is submitted, Counters keep reporting "0" for expiry_seconds. The other Metrics
+        (Set, Gauge, Histogram) do not report if no data is submitted.
 
-    def flush(self):
+        `sample_times` is the column of the counters sampled in the flushed bucket, if any.
+        Only the first `context_count` counter contexts are visited, if set: the
+        ones known when the buckets were detached, since submissions add more.
+        """
+        formatter = self.formatter
+        interval = self.interval
+        contexts = self.counter_store.contexts
+        templates = self.counter_store.templates
+        series_template = self.series_template
+        last_sample_times = self.counter_store.last_sample_times
+        sampled_count = 0
+        if sample_times is not None:
+            sampled_count = len(sample_times)
+        if context_count is None:
+            context_count = len(contexts)
+
+        for index in xrange(context_count):
+            last_sample_time = last_sample_times[index]
+            # Skip free indexes, counters never flushed yet, and the ones about to expire
+            if not last_sample_time or last_sample_time < expiry_timestamp:
+                continue
+            if index < sampled_count and sample_times[index]:
+                continue
+            # This counts on the ordering of the context created in submit_metric not changing
+            context = contexts[index]
+            if series_template is not None:
+                template = templates[index]
+                if template is None:
+                    template = templates[index] = series_template(context[0], context[1] or None,
+                        context[2], context[3], MetricTypes.RATE, interval)
+                series = template.copy()
+                series['points'] = [(flush_timestamp, 0.0)]
+                if not context[1]:
+                    series['tags'] = context[1]
+                metrics.append(series)
+                continue
+            metrics.append(formatter(
+                metric=context[0],
+                value=0.0,
+                timestamp=flush_timestamp,
+                tags=context[1],
+                hostname=context[2],
+                device_name=context[3],
+                metric_type=MetricTypes.RATE,
+                interval=interval,
+            ))
+
+    def flush_columns(self, bucket_start_timestamp, expiry_timestamp, metrics,
+            counter_columns=None, gauge_columns=None, context_count=None):
+        """
+        Flush the detached counter and gauge columns of a bucket, and the zeros
+        of the idle counters
+        """
+        formatter = self.formatter
+        interval = self.interval
+        series_template = self.series_template
+
+        columns = counter_columns
+        sample_times = None
+        if columns is not None:
+            self.counter_store.retire(columns)
+            values, sample_times, sampled = columns
+            contexts = self.counter_store.contexts
+            templates = self.counter_store.templates
+            for index in sampled:
+                context = contexts[index]
+                if sample_times[index] < expiry_timestamp:
+                    # This should never happen
+                    log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    continue
+                if series_template is not None:
+                    template = templates[index]
+                    if template is None:
+                        template = templates[index] = series_template(context[0], context[1] or None,
+                            context[2], context[3], MetricTypes.RATE, interval)
+                    series = template.copy()
+                    series['points'] = [(bucket_start_timestamp, values[index] / interval)]
+                    metrics.append(series)
+                    continue
+                metrics.append(formatter(
+                    metric=context[0],
+                    value=values[index] / interval,
+                    timestamp=bucket_start_timestamp,
+                    tags=context[1] or None,
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.RATE,
+                    interval=interval,
+                ))
+        # We need to account for Counters that have not expired and were not flushed for this bucket
+        self.create_empty_metrics(expiry_timestamp, bucket_start_timestamp, metrics, sample_times,
+            context_count)
+
+        columns = gauge_columns
+        if columns is not None:
+            self.gauge_store.retire(columns)
+            values, sample_times, sampled = columns
+            contexts = self.gauge_store.contexts
+            templates = self.gauge_store.templates
+            for index in sampled:
+                context = contexts[index]
+                if sample_times[index] < expiry_timestamp:
+                    log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    continue
+                if series_template is not None:
+                    template = templates[index]
+                    if template is None:
+                        template = templates[index] = series_template(context[0], context[1] or None,
+                            context[2], context[3], MetricTypes.GAUGE, interval)
+                    series = template.copy()
+                    series['points'] = [(bucket_start_timestamp, values[index])]
+                    metrics.append(series)
+                    continue
+                metrics.append(formatter(
+                    metric=context[0],
+                    timestamp=bucket_start_timestamp,
+                    value=values[index],
+                    tags=context[1] or None,
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.GAUGE,
+                    interval=interval,
+                ))
+
+    def snapshot(self):
+        """
+        Expire the contexts not sampled for expiry_seconds, and detach the closed
+        buckets with `swap`. Submissions must be paused while it runs (dogstatsd
+        holds its submit lock), unlike `flush_snapshot` which reports the result.
+        """
         cur_time = time()
-        flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
 
+        # Only the contexts that expire are visited. This runs before the buckets
+        # are detached, so that the contexts sampled in them don't expire.
+        for context in self.counter_store.expire(expiry_timestamp):
+            log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+        self.gauge_store.expire(expiry_timestamp)
+
+        if self.flush_time_limit is None:
+            flush_cutoff_time = self.calculate_bucket_start(cur_time)
+        else:
+            flush_cutoff_time = self.calculate_bucket_start(min(cur_time, self.flush_time_limit))
+        # Never go back to the buckets already flushed
+        flush_cutoff_time = max(flush_cutoff_time, self.last_flush_cutoff_time)
+        snapshot = self.swap(flush_cutoff_time)
+        snapshot['flush_cutoff_time'] = flush_cutoff_time
+        snapshot['expiry_timestamp'] = expiry_timestamp
+
+        # Save some stats.
+        log.debug("received %s payloads since last flush" % snapshot['count'])
+        self.total_count += snapshot['count']
+        return snapshot
+
+    def flush_snapshot(self, snapshot):
+        """ Return the metrics of the buckets detached by `snapshot` """
+        flush_cutoff_time = snapshot['flush_cutoff_time']
+        expiry_timestamp = snapshot['expiry_timestamp']
+        metric_by_bucket = snapshot['metric_by_bucket']
+        counter_buckets = snapshot['counter_buckets']
+        gauge_buckets = snapshot['gauge_buckets']
+        context_count = snapshot['counter_context_count']
+
         metrics = []
 
-        if self.metric_by_bucket:
+        bucket_start_timestamps = set(metric_by_bucket)
+        bucket_start_timestamps.update(counter_buckets)
+        bucket_start_timestamps.update(gauge_buckets)
+
+        if bucket_start_timestamps:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.
+            for bucket_start_timestamp in sorted(bucket_start_timestamps):
+                metric_by_context = metric_by_bucket.get(bucket_start_timestamp, {})
+                for context, metric in metric_by_context.iteritems():
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    else:
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                self.flush_columns(bucket_start_timestamp, expiry_timestamp, metrics,
+                    counter_buckets.get(bucket_start_timestamp), gauge_buckets.get(bucket_start_timestamp),
+                    context_count)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp, \
-                                                flush_cutoff_time-self.interval, metrics)
+                self.create_empty_metrics(expiry_timestamp, flush_cutoff_time-self.interval, metrics,
+                    context_count=context_count)
 
         # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+        if snapshot['num_discarded_old_points'] > 0:
+            log.warn('%s points were discarded as a result of having an old timestamp' % snapshot['num_discarded_old_points'])
 
-        # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
+    def flush(self):
+        return self.flush_snapshot(self.snapshot())
+
 
 class MetricsAggregator(Aggregator):
     """
@@ -852,7 +2052,10 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_backend=None,
+            histogram_relative_accuracy=None, set_backend=None, set_precision=None,
+            max_new_contexts=None, max_new_contexts_per_name=None, context_overflow=None,
+            histogram_max_samples=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -861,7 +2064,16 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_backend,
+            histogram_relative_accuracy,
+            set_backend,
+            set_precision,
+            max_new_contexts,
+            max_new_contexts_per_name,
+            context_overflow,
+            histogram_max_samples
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -869,30 +2081,26 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
             '_dd-r': Rate,
         }
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                                 device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
+        context = self._get_context(name, tags, hostname, device_name)
+        # Report the tags as given
+        self.submit_context_metric(context, value, mtype, timestamp, sample_rate, tags)
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+    def submit_context_metric(self, context, value, mtype, timestamp=None, sample_rate=1, tags=None):
         if context not in self.metrics:
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+            self.metrics[context] = metric_class(self.formatter, context[0], tags or context[1] or None,
+                context[2], context[3], self.metric_config.get(metric_class))
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
@@ -952,15 +2160,21 @@ def get_formatter(config):
   formatter = api_formatter
 
   if config['statsd_metric_namespace']:
+    metric_prefix = config['statsd_metric_namespace']
+    if metric_prefix[-1] != '.':
+      metric_prefix += '.'
+
     def metric_namespace_formatter_wrapper(metric, value, timestamp, tags,
         hostname=None, device_name=None, metric_type=None, interval=None):
-      metric_prefix = config['statsd_metric_namespace']
-      if metric_prefix[-1] != '.':
-        metric_prefix += '.'
-
       return api_formatter(metric_prefix + metric, value, timestamp, tags, hostname,
         device_name, metric_type, interval)
 
+    def metric_namespace_series_template(metric, tags, hostname=None, device_name=None,
+        metric_type=None, interval=None):
+      return api_series_template(metric_prefix + metric, tags, hostname, device_name,
+        metric_type, interval)
+
+    metric_namespace_formatter_wrapper.series_template = metric_namespace_series_template
     formatter = metric_namespace_formatter_wrapper
   return formatter
 
@@ -976,3 +2190,21 @@ def api_formatter(metric, value, timestamp, tags, hostname=None, device_name=Non
         'type': metric_type or MetricTypes.GAUGE,
         'interval':interval,
     }
+
+
+def api_series_template(metric, tags, hostname=None, device_name=None, metric_type=None,
+        interval=None):
+    """
+    The series api_formatter returns for a context, without its points. Copies
+    of it with their 'points' set are the same as api_formatter's output.
+    """
+    return {
+        'metric': metric,
+        'tags': tags,
+        'host': hostname,
+        'device_name': device_name,
+        'type': metric_type or MetricTypes.GAUGE,
+        'interval': interval,
+    }
+
+api_formatter.series_template = api_series_template
@@ -16,8 +16,12 @@ class CollectorMetrics(Check):
         self.gauge('datadog.agent.emitter.emit.time')
         self.gauge('datadog.agent.collector.threads.count')
         self.gauge('datadog.agent.collector.cpu.used')
+        self.gauge('datadog.agent.emitter.compression.ratio')
+        self.gauge('datadog.agent.emitter.compression.time')
+        self.gauge('datadog.agent.emitter.compression.level')
 
-    def check(self, payload, agent_config, collection_time, emit_time, cpu_time=None):
+    def check(self, payload, agent_config, collection_time, emit_time, cpu_time=None,
+            compression_stats=None):
 
         if threading.activeCount() > MAX_THREADS_COUNT:
             self.save_sample('datadog.agent.collector.threads.count', threading.activeCount())
@@ -44,4 +48,10 @@ class CollectorMetrics(Check):
                 self.logger.debug("Couldn't compute cpu used by collector with values %s %s %s"
                                   % (cpu_time, collection_time, str(e)))
 
+        if compression_stats is not None:
+            ratio, compression_time, level = compression_stats
+            self.save_sample('datadog.agent.emitter.compression.ratio', ratio)
+            self.save_sample('datadog.agent.emitter.compression.time', compression_time)
+            self.save_sample('datadog.agent.emitter.compression.level', level)
+
         return self.get_metrics()
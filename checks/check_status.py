@@ -579,13 +579,15 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-        metric_count=0, event_count=0):
+        metric_count=0, event_count=0, limited_context_count=0, context_limit_offenders=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
         self.packets_per_second = packets_per_second
         self.metric_count = metric_count
         self.event_count = event_count
+        self.limited_context_count = limited_context_count
+        self.context_limit_offenders = context_limit_offenders or []
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -598,6 +600,10 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
         ]
+        if self.limited_context_count:
+            lines.append("Samples over the context limits: %s" % self.limited_context_count)
+            for name, count in self.context_limit_offenders:
+                lines.append("  %s: %s" % (name, count))
         return lines
 
     def to_dict(self):
@@ -608,6 +614,8 @@ class DogstatsdStatus(AgentStatus):
             'packets_per_second': self.packets_per_second,
             'metric_count': self.metric_count,
             'event_count': self.event_count,
+            'limited_context_count': self.limited_context_count,
+            'context_limit_offenders': self.context_limit_offenders,
         })
         return status_info
 
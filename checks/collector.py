@@ -20,6 +20,8 @@ from checks.agent_metrics import CollectorMetrics
 from checks.ganglia import Ganglia
 from checks.datadog import Dogstreams, DdForwarder
 from checks.check_status import CheckStatus, CollectorStatus, EmitterStatus, STATUS_OK, STATUS_ERROR
+from compression import get_compressor
+from emitter import http_emitter
 from resources.processes import Processes as ResProcesses
 
 
@@ -45,6 +47,8 @@ class Collector(object):
         self.os = get_os()
         self.plugins = None
         self.emitters = emitters
+        # Compressor of the payloads of the http emitter, kept between runs to measure and adapt it
+        self.compressor = get_compressor(agentConfig)
         self.check_timings = agentConfig.get('check_timings')
         self.push_times = {
             'metadata': {
@@ -361,12 +365,16 @@ class Collector(object):
             payload['meta'] = self.metadata_cache  # add hostname metadata
         collect_duration = timer.step()
 
+        # Compression of the previous payloads
+        compression_stats = self.compressor.report()
+
         if self.os != 'windows':
             payload['metrics'].extend(self._agent_metrics.check(payload, self.agentConfig,
-                collect_duration, self.emit_duration, time.clock() - cpu_clock))
+                collect_duration, self.emit_duration, time.clock() - cpu_clock,
+                compression_stats=compression_stats))
         else:
             payload['metrics'].extend(self._agent_metrics.check(payload, self.agentConfig,
-                collect_duration, self.emit_duration))
+                collect_duration, self.emit_duration, compression_stats=compression_stats))
 
 
         emitter_statuses = self._emit(payload)
@@ -400,7 +408,10 @@ class Collector(object):
             name = emitter.__name__
             emitter_status = EmitterStatus(name)
             try:
-                emitter(payload, log, self.agentConfig)
+                if emitter is http_emitter:
+                    emitter(payload, log, self.agentConfig, compressor=self.compressor)
+                else:
+                    emitter(payload, log, self.agentConfig)
             except Exception, e:
                 log.exception("Error running emitter: %s" % emitter.__name__)
                 emitter_status = EmitterStatus(name, e)
@@ -0,0 +1,159 @@
+"""
+Compression of the payloads sent to Datadog, shared by the collector's
+http_emitter and the dogstatsd reporter.
+"""
+# stdlib
+import logging
+from time import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+# zlib window bits of each algorithm, named after their Content-Encoding
+WBITS = {
+    'deflate': zlib.MAX_WBITS,
+    'gzip': 16 + zlib.MAX_WBITS,
+}
+# Size of the headers and trailers of each algorithm, on top of deflate's bound
+OVERHEAD = {
+    'deflate': 13,
+    'gzip': 25,
+}
+DEFAULT_COMPRESSION_LEVEL = 6
+MIN_COMPRESSION_LEVEL = 1
+MAX_COMPRESSION_LEVEL = 9
+# Payloads up to this size aren't compressed
+COMPRESS_THRESHOLD = 1024
+
+# The adaptive level is the highest one taking at most this many ms per MB of payload..
+DEFAULT_MAX_MS_PER_MB = 20
+# .. it's raised when the time per MB is under this fraction of the budget..
+ADAPT_HEADROOM = 0.5
+# .. and lowered when it doesn't shrink payloads this much more than the level below
+ADAPT_MIN_GAIN = 0.02
+# Weight of the latest measures in the ones kept for each level
+ADAPT_SMOOTHING = 0.5
+# The measures of the other levels are forgotten every so many reports, for them
+# to be tried again as payloads change
+ADAPT_RESET_PERIOD = 60
+
+
+def deflate_bound(size, overhead=OVERHEAD['deflate']):
+    """ Upper bound of the size of `size` bytes once deflated, like zlib's compressBound """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + overhead
+
+
+def get_compressor(config):
+    """ Return the compressor set up by the compression_* options of the config """
+    return Compressor(
+        algorithm=config.get('compression_algorithm'),
+        level=config.get('compression_level'),
+        threshold=config.get('compression_threshold'),
+        adaptive=config.get('compression_adaptive', False),
+        max_ms_per_mb=config.get('compression_max_ms_per_mb'),
+    )
+
+
+class Compressor(object):
+    """
+    Compresses payloads with one of the algorithms of WBITS, and measures how
+    long it takes and how much smaller payloads get.
+
+    If `adaptive`, the level changes every time the measures are reported,
+    to the highest one that compresses a MB in at most `max_ms_per_mb` ms, as
+    long as it shrinks payloads more than the level below.
+    """
+
+    def __init__(self, algorithm=None, level=None, threshold=None, adaptive=False,
+            max_ms_per_mb=None):
+        self.algorithm = algorithm or 'deflate'
+        if self.algorithm not in WBITS:
+            raise ValueError("Unknown compression algorithm %s, must be one of %s" % (
+                self.algorithm, ', '.join(sorted(WBITS))))
+        self.content_encoding = self.algorithm
+        self.wbits = WBITS[self.algorithm]
+        self.overhead = OVERHEAD[self.algorithm]
+        self.level = level or DEFAULT_COMPRESSION_LEVEL
+        if threshold is None:
+            threshold = COMPRESS_THRESHOLD
+        self.threshold = threshold
+        self.adaptive = adaptive
+        self.max_ms_per_mb = max_ms_per_mb or DEFAULT_MAX_MS_PER_MB
+
+        # Size of the payloads before and after compression, and time spent
+        # compressing them, since the last report
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.duration = 0.0
+        # Smoothed [ms per MB, ratio] measured at each level
+        self.level_stats = {}
+        self.report_count = 0
+
+    def should_compress(self, size):
+        return size > self.threshold
+
+    def bound(self, size):
+        """ Upper bound of the size of `size` bytes once compressed """
+        return deflate_bound(size, self.overhead)
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+    def compress(self, data):
+        start_time = time()
+        compressor = self.compressobj()
+        compressed = compressor.compress(data) + compressor.flush()
+        self.record(len(data), len(compressed), time() - start_time)
+        return compressed
+
+    def record(self, raw_size, compressed_size, duration):
+        """ Account for `raw_size` bytes compressed to `compressed_size` in `duration` seconds """
+        self.raw_size += raw_size
+        self.compressed_size += compressed_size
+        self.duration += duration
+
+    def report(self):
+        """
+        Return the compression ratio, the time spent compressing in ms, and the
+        level of the compressions since the last call, None if there were none.
+        Adapt the level if the compressor is adaptive.
+        """
+        if not self.raw_size or not self.compressed_size:
+            return None
+        ratio = float(self.raw_size) / self.compressed_size
+        duration = self.duration * 1000.0
+        level = self.level
+        if self.adaptive:
+            self.adapt(duration * 1048576.0 / self.raw_size, ratio)
+        self.raw_size = self.compressed_size = 0
+        self.duration = 0.0
+        return ratio, duration, level
+
+    def adapt(self, ms_per_mb, ratio):
+        self.report_count += 1
+        if self.report_count % ADAPT_RESET_PERIOD == 0:
+            self.level_stats = {}
+
+        stats = self.level_stats.get(self.level)
+        if stats is None:
+            stats = self.level_stats[self.level] = [ms_per_mb, ratio]
+        else:
+            stats[0] += ADAPT_SMOOTHING * (ms_per_mb - stats[0])
+            stats[1] += ADAPT_SMOOTHING * (ratio - stats[1])
+        ms_per_mb, ratio = stats
+
+        lower = self.level_stats.get(self.level - 1)
+        upper = self.level_stats.get(self.level + 1)
+        level = self.level
+        if self.level > MIN_COMPRESSION_LEVEL and (ms_per_mb > self.max_ms_per_mb
+                or lower is not None and ratio < lower[1] * (1 + ADAPT_MIN_GAIN)):
+            # Too slow, or not worth it
+            level -= 1
+        elif self.level < MAX_COMPRESSION_LEVEL and ms_per_mb < self.max_ms_per_mb * ADAPT_HEADROOM:
+            if upper is None or (upper[0] <= self.max_ms_per_mb
+                    and upper[1] >= ratio * (1 + ADAPT_MIN_GAIN)):
+                level += 1
+        if level != self.level:
+            log.debug("Compression level %s: %.1f ms per MB, ratio %.2f, switching to level %s" % (
+                self.level, ms_per_mb, ratio, level))
+            self.level = level
@@ -405,6 +405,87 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            backend = config.get('Main', 'histogram_backend').strip()
+            if backend in ('exact', 'sketch'):
+                agentConfig['histogram_backend'] = backend
+            else:
+                agentConfig.pop('histogram_backend', None)
+                log.warning("Ignored histogram backend {0}, must be exact or sketch".format(backend))
+
+        if config.has_option('Main', 'histogram_relative_accuracy'):
+            try:
+                accuracy = float(config.get('Main', 'histogram_relative_accuracy'))
+                if accuracy <= 0 or accuracy >= 1:
+                    raise ValueError
+                agentConfig['histogram_relative_accuracy'] = accuracy
+            except ValueError:
+                agentConfig.pop('histogram_relative_accuracy', None)
+                log.warning("Bad histogram relative accuracy, must be float in ]0;1[, skipping")
+
+        if config.has_option('Main', 'histogram_max_samples'):
+            try:
+                max_samples = int(config.get('Main', 'histogram_max_samples'))
+                if max_samples < 1:
+                    raise ValueError
+                agentConfig['histogram_max_samples'] = max_samples
+            except ValueError:
+                agentConfig.pop('histogram_max_samples', None)
+                log.warning("Bad histogram max samples, must be a positive integer, skipping")
+
+        if config.has_option('Main', 'set_backend'):
+            backend = config.get('Main', 'set_backend').strip()
+            if backend in ('exact', 'hyperloglog'):
+                agentConfig['set_backend'] = backend
+            else:
+                agentConfig.pop('set_backend', None)
+                log.warning("Ignored set backend {0}, must be exact or hyperloglog".format(backend))
+
+        if config.has_option('Main', 'set_precision'):
+            try:
+                precision = int(config.get('Main', 'set_precision'))
+                if precision < 4 or precision > 16:
+                    raise ValueError
+                agentConfig['set_precision'] = precision
+            except ValueError:
+                agentConfig.pop('set_precision', None)
+                log.warning("Bad set precision, must be an integer between 4 and 16, skipping")
+
+        # Compression of the payloads sent by the collector and dogstatsd
+        if config.has_option('Main', 'compression_algorithm'):
+            algorithm = config.get('Main', 'compression_algorithm').strip()
+            if algorithm in ('deflate', 'gzip'):
+                agentConfig['compression_algorithm'] = algorithm
+            else:
+                agentConfig.pop('compression_algorithm', None)
+                log.warning("Ignored compression algorithm {0}, must be deflate or gzip".format(algorithm))
+
+        if config.has_option('Main', 'compression_level'):
+            try:
+                level = int(config.get('Main', 'compression_level'))
+                if level < 1 or level > 9:
+                    raise ValueError
+                agentConfig['compression_level'] = level
+            except ValueError:
+                agentConfig.pop('compression_level', None)
+                log.warning("Bad compression level, must be an integer between 1 and 9, skipping")
+
+        if config.has_option('Main', 'compression_threshold'):
+            agentConfig['compression_threshold'] = int(config.get('Main', 'compression_threshold'))
+
+        if config.has_option('Main', 'compression_adaptive'):
+            agentConfig['compression_adaptive'] = _is_affirmative(config.get('Main', 'compression_adaptive'))
+
+        if config.has_option('Main', 'compression_max_ms_per_mb'):
+            try:
+                max_ms_per_mb = float(config.get('Main', 'compression_max_ms_per_mb'))
+                if max_ms_per_mb <= 0:
+                    raise ValueError
+                agentConfig['compression_max_ms_per_mb'] = max_ms_per_mb
+            except ValueError:
+                agentConfig.pop('compression_max_ms_per_mb', None)
+                log.warning("Bad compression max ms per MB, must be a positive number, skipping")
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -433,6 +514,62 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             agentConfig['statsd_forward_host'] = config.get('Main', 'statsd_forward_host')
             if config.has_option('Main', 'statsd_forward_port'):
                 agentConfig['statsd_forward_port'] = int(config.get('Main', 'statsd_forward_port'))
+            if config.has_option('Main', 'statsd_forward_mode'):
+                agentConfig['statsd_forward_mode'] = config.get('Main', 'statsd_forward_mode')
+
+        # Number of datagrams dogstatsd reads per wakeup of its select loop
+        if config.has_option('Main', 'dogstatsd_recv_batch_size'):
+            agentConfig['dogstatsd_recv_batch_size'] = int(config.get('Main', 'dogstatsd_recv_batch_size'))
+
+        # Number of dogstatsd processes sharing the listening port
+        if config.has_option('Main', 'dogstatsd_workers'):
+            agentConfig['dogstatsd_workers'] = int(config.get('Main', 'dogstatsd_workers'))
+
+        # Size of the kernel receive buffer of the dogstatsd sockets
+        if config.has_option('Main', 'dogstatsd_so_rcvbuf'):
+            agentConfig['dogstatsd_so_rcvbuf'] = int(config.get('Main', 'dogstatsd_so_rcvbuf'))
+
+        # Number of metric contexts dogstatsd keeps parsed
+        if config.has_option('Main', 'dogstatsd_context_cache_size'):
+            agentConfig['dogstatsd_context_cache_size'] = int(config.get('Main', 'dogstatsd_context_cache_size'))
+
+        # Number of batches of packets waiting for the dogstatsd parsing thread
+        if config.has_option('Main', 'dogstatsd_pipeline_queue_size'):
+            agentConfig['dogstatsd_pipeline_queue_size'] = int(config.get('Main', 'dogstatsd_pipeline_queue_size'))
+
+        # Optional TCP listener of dogstatsd
+        if config.has_option('Main', 'dogstatsd_tcp_port'):
+            agentConfig['dogstatsd_tcp_port'] = int(config.get('Main', 'dogstatsd_tcp_port'))
+        if config.has_option('Main', 'dogstatsd_tcp_framing'):
+            agentConfig['dogstatsd_tcp_framing'] = config.get('Main', 'dogstatsd_tcp_framing')
+        if config.has_option('Main', 'dogstatsd_tcp_max_connections'):
+            agentConfig['dogstatsd_tcp_max_connections'] = int(config.get('Main', 'dogstatsd_tcp_max_connections'))
+
+        # Limits on the number of distinct dogstatsd contexts
+        if config.has_option('Main', 'dogstatsd_max_new_contexts'):
+            agentConfig['dogstatsd_max_new_contexts'] = int(config.get('Main', 'dogstatsd_max_new_contexts'))
+        if config.has_option('Main', 'dogstatsd_max_new_contexts_per_name'):
+            agentConfig['dogstatsd_max_new_contexts_per_name'] = int(config.get('Main', 'dogstatsd_max_new_contexts_per_name'))
+        if config.has_option('Main', 'dogstatsd_context_overflow'):
+            overflow = config.get('Main', 'dogstatsd_context_overflow').strip()
+            if overflow in ('fold', 'drop'):
+                agentConfig['dogstatsd_context_overflow'] = overflow
+            else:
+                agentConfig.pop('dogstatsd_context_overflow', None)
+                log.warning("Ignored dogstatsd context overflow {0}, must be fold or drop".format(overflow))
+
+        if config.has_option('Main', 'dogstatsd_columnar_series_url'):
+            url = config.get('Main', 'dogstatsd_columnar_series_url').strip()
+            if url:
+                agentConfig['dogstatsd_columnar_series_url'] = url
+
+        # Retry of the dogstatsd payloads that failed to be posted
+        if config.has_option('Main', 'dogstatsd_retry_queue_max_size'):
+            agentConfig['dogstatsd_retry_queue_max_size'] = int(config.get('Main', 'dogstatsd_retry_queue_max_size'))
+        if config.has_option('Main', 'dogstatsd_retry_spill_dir'):
+            agentConfig['dogstatsd_retry_spill_dir'] = config.get('Main', 'dogstatsd_retry_spill_dir').strip()
+        if config.has_option('Main', 'dogstatsd_retry_spill_max_size'):
+            agentConfig['dogstatsd_retry_spill_max_size'] = int(config.get('Main', 'dogstatsd_retry_spill_max_size'))
 
         # optionally send dogstatsd data directly to the agent.
         if config.has_option('Main', 'dogstatsd_use_ddurl'):
@@ -41,6 +41,7 @@ from util import Watchdog, get_uuid, get_hostname, json, get_tornado_ioloop
 from emitter import http_emitter
 from config import get_config, get_url_endpoint, get_version
 from checks.check_status import ForwarderStatus
+from compression import WBITS
 from transaction import Transaction, TransactionManager
 import modules
 
@@ -124,8 +125,9 @@ class EmitterManager(object):
     def send(self, data, headers=None):
         if not self.emitterThreads:
             return # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
+        content_encoding = headers and headers.get('Content-Encoding')
+        if content_encoding in WBITS:
+            data = zlib.decompress(data, WBITS[content_encoding])
         data = json_decode(data)
         for emitterThread in self.emitterThreads:
             logging.info('Queueing for emitter %r', emitterThread.name)
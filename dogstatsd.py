@@ -11,28 +11,42 @@ import os
 os.umask(022)
 
 # stdlib
+import errno
 import logging
+import multiprocessing
 import optparse
 import re
 import select
 import signal
 import socket
+import stat
+import struct
 import sys
 import zlib
 from time import time, sleep
 import threading
+from Queue import Queue, Empty, Full
+from array import array
+from collections import deque
+from itertools import chain, imap, izip
+from operator import itemgetter
 from urllib import urlencode
+from urlparse import parse_qsl, urlparse, urlsplit, urlunsplit
 
 # project
 from aggregator import MetricsBucketAggregator, get_formatter
 from checks.check_status import DogstatsdStatus
+from compression import Compressor, get_compressor
 from config import get_config, get_version
 from daemon import Daemon, AgentSupervisor
 from util import PidFile, get_hostname, plural, get_uuid, chunks
 
 # 3rd party
 import requests
+from requests.adapters import HTTPAdapter
 import simplejson as json
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -48,38 +62,735 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Maximum number of datagrams read from the socket on each wakeup of the
+# select loop. 1 means one datagram per select call.
+RECV_BATCH_SIZE = 1
+# How often, in seconds, dogstatsd workers send what they aggregated to the
+# main process when running several of them.
+WORKER_EXPORT_INTERVAL = 1
+# Number of received batches of datagrams that can wait for the parsing thread
+# when the reading and the parsing of packets are pipelined, the packets of
+# further batches are dropped. 0 parses packets in the reading thread.
+PIPELINE_QUEUE_SIZE = 0
+# Forwarded packets are coalesced into datagrams of at most this many bytes,
+# which fit in an ethernet frame along with the IP and UDP headers.
+FORWARD_MTU = 1432
+# Maximum time in seconds a coalesced packet waits before being forwarded
+FORWARD_COALESCE_DELAY = 0.1
+FORWARD_MODES = ('raw', 'coalesce', 'aggregate')
+# Framings of the packets sent over TCP: lines, or batches of lines prefixed by
+# their size as a 4-byte big-endian integer.
+TCP_FRAMINGS = ('newline', 'length')
+TCP_MAX_CONNECTIONS = 256
+# Longest line, or batch of lines, accepted from a TCP client
+TCP_MAX_FRAME_SIZE = 8 * 1024 * 1024
+# Python 2 doesn't expose SO_REUSEPORT, this is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Where the kernel keeps UDP sockets stats, including drops (Linux only)
+PROC_NET_UDP_FILES = ['/proc/net/udp', '/proc/net/udp6']
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
 FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
-COMPRESS_THRESHOLD = 1024
-
-def serialize_metrics(metrics):
-    serialized = json.dumps({"series" : metrics})
-    if len(serialized) > COMPRESS_THRESHOLD:
-        headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
+# Limits of the series payloads, as sent and once decompressed
+MAX_PAYLOAD_SIZE = 2621440
+MAX_UNCOMPRESSED_PAYLOAD_SIZE = 4194304
+# Number of series serialized at once
+SERIES_BATCH_SIZE = 1000
+
+# Series payloads can also be sent in a columnar binary format, see encode_columnar_series,
+# to an intake accepting it: /api/v1/series only accepts JSON
+COLUMNAR_CONTENT_TYPE = 'application/x-dd-series-columnar'
+COLUMNAR_MAGIC = 'DDS\x02'
+# Number of series per columnar payload, halved when payloads get too large
+COLUMNAR_BATCH_SIZE = 20000
+# Tag count of the series whose tags are None
+COLUMNAR_NO_TAGS = 0xffffffff
+# Integers up to this magnitude are exact as doubles, larger ones are also
+# stored as int64, if they fit
+COLUMNAR_MAX_EXACT_DOUBLE = 2 ** 53
+COLUMNAR_MAX_INT64 = 2 ** 63 - 1
+
+# Connections kept alive to the API, metrics, events and service checks are sent in parallel
+HTTP_POOL_SIZE = 3
+HTTP_TIMEOUT = 5
+
+# Outcomes of posting a payload: posted, to be retried, or rejected for good
+POST_OK = 'ok'
+POST_RETRY = 'retry'
+POST_DROPPED = 'dropped'
+
+# Payloads that failed to be posted are retried, with an exponential backoff
+RETRY_QUEUE_MAX_SIZE = 16 * 1024 * 1024
+RETRY_INITIAL_DELAY = 10
+RETRY_MAX_DELAY = 120
+# Status codes worth retrying a payload for, on top of the 5xx
+RETRY_STATUS_CODES = (408, 429)
+# Payloads that don't fit in memory are spilled to segment files of at most this size
+SPILL_SEGMENT_SIZE = 4 * 1024 * 1024
+SPILL_MAX_SIZE = 256 * 1024 * 1024
+
+
+class SeriesPayload(object):
+    """
+    A series payload being written. Series are added to it one at a time, and
+    once it's larger than the threshold of `compressor`, they're compressed as
+    they come.
+    """
+
+    HEADER = '{"series": ['
+    SEPARATOR = ', '
+    FOOTER = ']}'
+
+    def __init__(self, max_size=None, max_uncompressed_size=None, compressor=None):
+        self.max_size = max_size or MAX_PAYLOAD_SIZE
+        self.max_uncompressed_size = max_uncompressed_size or MAX_UNCOMPRESSED_PAYLOAD_SIZE
+        self.parts = [self.HEADER]
+        self.count = 0
+        self.size = len(self.HEADER)
+        self.compression = compressor or Compressor()
+        self.compressor = None
+        self.compressed_size = 0
+        # Bytes given to the compressor since it was last flushed
+        self.pending_size = 0
+        self.compress_duration = 0.0
+
+    def add(self, series, count=1):
+        """
+        Add `count` serialized series, separated by SEPARATOR, and return False
+        if they don't fit in the payload. A single series always fits in an
+        empty payload.
+        """
+        if self.count:
+            series = self.SEPARATOR + series
+        size = len(series)
+        if self.count or count > 1:
+            if self.size + size + len(self.FOOTER) > self.max_uncompressed_size:
+                return False
+            if self.compressor is None:
+                fits = self.compression.bound(self.size + size + len(self.FOOTER)) <= self.max_size
+            else:
+                fits = self._fits(size + len(self.FOOTER))
+            if not fits:
+                return False
+
+        self.count += count
+        self.size += size
+        if self.compressor is not None:
+            self._compress(series)
+        else:
+            self.parts.append(series)
+            if self.compression.should_compress(self.size + len(self.FOOTER)):
+                self.compressor = self.compression.compressobj()
+                uncompressed, self.parts = ''.join(self.parts), []
+                self._compress(uncompressed)
+        return True
+
+    def _compress(self, data):
+        start_time = time()
+        compressed = self.compressor.compress(data)
+        self.compress_duration += time() - start_time
+        if compressed:
+            self.parts.append(compressed)
+            self.compressed_size += len(compressed)
+        self.pending_size += len(data)
+
+    def _fits(self, size):
+        if self.compressed_size + self.compression.bound(self.pending_size + size) <= self.max_size:
+            return True
+        # Flush the compressor to know how large the payload is so far
+        start_time = time()
+        compressed = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.compress_duration += time() - start_time
+        self.parts.append(compressed)
+        self.compressed_size += len(compressed)
+        self.pending_size = 0
+        return self.compressed_size + self.compression.bound(size) <= self.max_size
+
+    def close(self):
+        """ Return the payload and its headers """
+        if self.compressor is None:
+            self.parts.append(self.FOOTER)
+            headers = {'Content-Type': 'application/json'}
+        else:
+            start_time = time()
+            self.parts.append(self.compressor.compress(self.FOOTER))
+            self.parts.append(self.compressor.flush())
+            self.compress_duration += time() - start_time
+            headers = {'Content-Type': 'application/json',
+                       'Content-Encoding': self.compression.content_encoding}
+        body = ''.join(self.parts)
+        if self.compressor is not None:
+            self.compression.record(self.size + len(self.FOOTER), len(body), self.compress_duration)
+        return body, headers
+
+
+def serialize_metrics(metrics, max_payload_size=None, max_uncompressed_size=None, compressor=None):
+    """
+    Serialize metrics to series payloads, and yield them along with their
+    headers. Series are serialized and compressed SERIES_BATCH_SIZE at a time,
+    and payloads are split so that they stay under max_payload_size bytes as
+    sent, and under max_uncompressed_size bytes once decompressed.
+    """
+    compressor = compressor or Compressor()
+    payload = SeriesPayload(max_payload_size, max_uncompressed_size, compressor)
+    for start in xrange(0, len(metrics), SERIES_BATCH_SIZE):
+        batches = [metrics[start:start + SERIES_BATCH_SIZE]]
+        while batches:
+            batch = batches.pop()
+            # Strip the brackets of the list, to get series separated like in the payload
+            series = json.dumps(batch)[1:-1]
+            if payload.add(series, len(batch)):
+                continue
+            if len(batch) > 1:
+                # Fill the payload with smaller batches
+                middle = len(batch) // 2
+                batches.append(batch[middle:])
+                batches.append(batch[:middle])
+            else:
+                yield payload.close()
+                payload = SeriesPayload(max_payload_size, max_uncompressed_size, compressor)
+                payload.add(series)
+    yield payload.close()
+
+class StringIds(dict):
+    """ Ids of the strings of a columnar payload, in order of appearance, starting at 1 """
+
+    def __init__(self):
+        dict.__init__(self)
+        self[None] = 0
+        self.strings = []
+
+    def __missing__(self, string):
+        self.strings.append(string)
+        string_id = self[string] = len(self.strings)
+        return string_id
+
+
+def _columnar_section(column):
+    if sys.byteorder == 'big':
+        column.byteswap()
+    data = column.tostring()
+    return struct.pack('<I', len(data)) + data
+
+
+def encode_columnar_series(metrics):
+    """
+    Encode series in a columnar binary format, which doesn't repeat the keys of
+    every series like JSON does. Strings (metric names, tags, hosts, device names
+    and types) are stored once, and referred to by their id: their index in order
+    of appearance, starting at 1, 0 standing for None.
+
+    The payload is COLUMNAR_MAGIC followed by sections, each prefixed by its size
+    in bytes as a little-endian uint32:
+      - the uint32 sizes of the strings, UTF-8 encoded, then the strings
+        themselves, one after the other
+      - per series uint32 columns: metric, type, host and device name ids, tag
+        counts (COLUMNAR_NO_TAGS for None) and point counts
+      - the uint32 ids of the tags of all the series
+      - per series float64 intervals, NaN for None
+      - the float64 timestamps, then the values, of the points of all the series
+      - the uint32 indexes, then the int64 values, of the integer values too
+        large to be exact as float64, which override them
+    All the numbers are little-endian.
+    """
+    # Columns are built with builtins rather than series by series, it's much
+    # faster, and with as few new objects as possible, to avoid triggering the
+    # garbage collector.
+    ids = StringIds()
+    string_id = ids.__getitem__
+    metric_names, types, hosts, device_names, tags, intervals, points = [
+        map(itemgetter(key), metrics)
+        for key in ('metric', 'type', 'host', 'device_name', 'tags', 'interval', 'points')]
+
+    if None in tags:
+        tag_counts = [COLUMNAR_NO_TAGS if t is None else len(t) for t in tags]
+        tags = [t for t in tags if t is not None]
     else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+        tag_counts = map(len, tags)
+    if None in intervals:
+        intervals = [float('nan') if i is None else i for i in intervals]
+    point_counts = map(len, points)
+    points = list(chain.from_iterable(points))
+    timestamps = map(itemgetter(0), points)
+    values = map(itemgetter(1), points)
+    exact_indexes, exact_values = _exact_int_values(values)
+
+    columns = [
+        array('I', map(string_id, metric_names)),
+        array('I', map(string_id, types)),
+        array('I', map(string_id, hosts)),
+        array('I', map(string_id, device_names)),
+        array('I', tag_counts),
+        array('I', point_counts),
+        array('I', map(string_id, chain.from_iterable(tags))),
+        array('d', intervals),
+        array('d', timestamps),
+        array('d', values),
+        array('I', exact_indexes),
+    ]
+    strings = [s.encode('utf-8') if isinstance(s, unicode) else s for s in ids.strings]
+    strings_data = ''.join(strings)
+    sections = [COLUMNAR_MAGIC, _columnar_section(array('I', map(len, strings))),
+        struct.pack('<I', len(strings_data)), strings_data]
+    sections.extend([_columnar_section(column) for column in columns])
+    # The array module has no 64-bit integers on Python 2
+    sections.extend([struct.pack('<I', 8 * len(exact_values)),
+        struct.pack('<%dq' % len(exact_values), *exact_values)])
+    return ''.join(sections)
+
+
+def _exact_int_values(values):
+    """
+    Return the indexes and values of the integers of `values` that doubles can't
+    represent exactly, but int64 can.
+    """
+    # Most payloads have none, look for large values without a python loop first
+    max_exact = float(COLUMNAR_MAX_EXACT_DOUBLE)
+    if not (any(imap(max_exact.__lt__, values)) or any(imap((-max_exact).__gt__, values))):
+        return [], []
+    indexes = []
+    exact_values = []
+    for index, value in enumerate(values):
+        if isinstance(value, (int, long)) \
+                and COLUMNAR_MAX_EXACT_DOUBLE < abs(value) <= COLUMNAR_MAX_INT64:
+            indexes.append(index)
+            exact_values.append(value)
+    return indexes, exact_values
+
+
+def decode_columnar_series(payload):
+    """ Decode the series encoded by encode_columnar_series, as api_formatter returns them """
+    if payload[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar series payload")
+    offset = len(COLUMNAR_MAGIC)
+    sections = []
+    while offset < len(payload):
+        size, = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        sections.append(payload[offset:offset + size])
+        offset += size
+
+    columns = []
+    for typecode, data in zip('I_IIIIIIIdddI', sections):
+        if typecode == '_':
+            columns.append(data)
+            continue
+        column = array(typecode)
+        column.fromstring(data)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+    (string_sizes, strings_data, metric_ids, type_ids, host_ids, device_ids, tag_counts,
+        point_counts, tag_ids, intervals, timestamps, values, exact_indexes) = columns
+
+    strings = [None]
+    string_offset = 0
+    for size in string_sizes:
+        strings.append(strings_data[string_offset:string_offset + size].decode('utf-8'))
+        string_offset += size
+    if exact_indexes:
+        exact_values = struct.unpack('<%dq' % len(exact_indexes), sections[13])
+        values = values.tolist()
+        for index, value in izip(exact_indexes, exact_values):
+            values[index] = value
+
+    metrics = []
+    tag_offset = point_offset = 0
+    for i in xrange(len(metric_ids)):
+        tag_count = tag_counts[i]
+        tags = None
+        if tag_count != COLUMNAR_NO_TAGS:
+            tags = tuple([strings[tag_id] for tag_id in tag_ids[tag_offset:tag_offset + tag_count]])
+            tag_offset += tag_count
+        point_count = point_counts[i]
+        points = zip(timestamps[point_offset:point_offset + point_count],
+            values[point_offset:point_offset + point_count])
+        point_offset += point_count
+        interval = intervals[i]
+        metrics.append({
+            'metric': strings[metric_ids[i]],
+            'points': points,
+            'tags': tags,
+            'host': strings[host_ids[i]],
+            'device_name': strings[device_ids[i]],
+            'type': strings[type_ids[i]],
+            'interval': None if interval != interval else interval,
+        })
+    return metrics
+
+
+def serialize_metrics_columnar(metrics, max_payload_size=None, max_uncompressed_size=None,
+        compressor=None):
+    """
+    Like serialize_metrics, but with series encoded by encode_columnar_series,
+    COLUMNAR_BATCH_SIZE at most per payload.
+    """
+    compressor = compressor or Compressor()
+    max_payload_size = max_payload_size or MAX_PAYLOAD_SIZE
+    max_uncompressed_size = max_uncompressed_size or MAX_UNCOMPRESSED_PAYLOAD_SIZE
+    batch_size = COLUMNAR_BATCH_SIZE
+    start = 0
+    while start < len(metrics):
+        batch = metrics[start:start + batch_size]
+        payload = encode_columnar_series(batch)
+        if len(batch) > 1 and len(payload) > max_uncompressed_size:
+            batch_size = len(batch) // 2
+            continue
+        payload = compressor.compress(payload)
+        if len(batch) > 1 and len(payload) > max_payload_size:
+            batch_size = len(batch) // 2
+            continue
+        yield payload, {'Content-Type': COLUMNAR_CONTENT_TYPE,
+            'Content-Encoding': compressor.content_encoding}
+        start += len(batch)
+
 
 def serialize_event(event):
     return json.dumps(event)
 
+def get_udp_drops(port, proc_files=None):
+    """
+    Return the number of datagrams dropped by the kernel on the UDP sockets
+    bound to `port` since they were opened, or None if it can't be known.
+    """
+    drops = None
+    for proc_file in proc_files or PROC_NET_UDP_FILES:
+        try:
+            f = open(proc_file)
+        except IOError:
+            continue
+        try:
+            f.readline() # Skip the header
+            for line in f:
+                fields = line.split()
+                local_port = int(fields[1].rsplit(':', 1)[1], 16)
+                if local_port == port:
+                    drops = (drops or 0) + int(fields[-1])
+        finally:
+            f.close()
+    return drops
+
+
+class UdpDropCounter(object):
+    """ Tracks the datagrams dropped by the kernel on a UDP port """
+
+    def __init__(self, port):
+        self.port = port
+        self.last_drops = 0
+
+    def dropped(self):
+        """ Number of datagrams dropped since the previous call, None if unknown """
+        drops = get_udp_drops(self.port)
+        if drops is None:
+            return None
+        # Sockets may have been re-opened in the meantime
+        dropped = max(drops - self.last_drops, 0)
+        self.last_drops = drops
+        return dropped
+
+
+def strip_api_key(url):
+    """ `url` without its api_key parameter """
+    parts = urlsplit(url)
+    params = [(k, v) for k, v in parse_qsl(parts[3]) if k != 'api_key']
+    return urlunsplit(parts[:3] + (urlencode(params), parts[4]))
+
+def add_api_key(url, api_key):
+    """ `url` with an api_key parameter set to `api_key` """
+    parts = urlsplit(strip_api_key(url))
+    params = parse_qsl(parts[3]) + [('api_key', api_key)]
+    return urlunsplit(parts[:3] + (urlencode(params), parts[4]))
+
+def strip_body_api_key(data, headers):
+    """
+    Return `data` without the apiKey of its JSON body, if it's an uncompressed
+    JSON object that has one, and whether it was removed.
+    """
+    if headers.get('Content-Type') != 'application/json' or headers.get('Content-Encoding'):
+        return data, False
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return data, False
+    if not isinstance(body, dict) or 'apiKey' not in body:
+        return data, False
+    del body['apiKey']
+    return json.dumps(body), True
+
+def add_body_api_key(data, api_key):
+    """ `data`, a JSON object, with its apiKey set to `api_key` """
+    body = json.loads(data)
+    body['apiKey'] = api_key
+    return json.dumps(body)
+
+
+class RetryQueue(object):
+    """
+    Payloads that failed to be posted, retried oldest first.
+
+    The payloads are kept in memory, up to `max_size` bytes. Past that, the
+    oldest payloads are dropped, unless `spill_dir` is set: new payloads are then
+    appended to segment files in that directory, up to `max_spill_size` bytes,
+    and loaded back in memory once there's room for them. Segments left over by a
+    previous run are retried too. They're written without the api_key parameter
+    of their URL and the apiKey of their JSON body, set back to `api_key` when
+    they're loaded.
+
+    After a failed retry, the queue waits RETRY_INITIAL_DELAY seconds before
+    retrying, doubled after every consecutive failure, up to `max_delay`.
+    """
+
+    SEGMENT_SUFFIX = '.seg'
+    RECORD_HEADER = struct.Struct('!II')
+
+    def __init__(self, max_size=None, spill_dir=None, max_spill_size=None, max_delay=None, api_key=None):
+        self.max_size = max_size or RETRY_QUEUE_MAX_SIZE
+        self.spill_dir = spill_dir
+        self.max_spill_size = max_spill_size or SPILL_MAX_SIZE
+        self.max_delay = max_delay or RETRY_MAX_DELAY
+        self.api_key = api_key
+        self.lock = threading.Lock()
+
+        # (url, data, headers) payloads in memory
+        self.payloads = deque()
+        self.size = 0
+        # Paths and sizes of the segment files, oldest first
+        self.segments = deque()
+        self.spill_size = 0
+        self.segment_file = None
+        self.segment_index = 0
+
+        self.failures = 0
+        self.next_retry = 0
+        self.dropped = 0
+
+        if spill_dir is not None:
+            self._open_spill_dir()
+
+    def __len__(self):
+        return len(self.payloads) + len(self.segments)
+
+    def _open_spill_dir(self):
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir, 0700)
+        for name in sorted(os.listdir(self.spill_dir)):
+            if not name.endswith(self.SEGMENT_SUFFIX):
+                continue
+            try:
+                index = int(name[:-len(self.SEGMENT_SUFFIX)])
+            except ValueError:
+                log.warning("Ignoring %s in %s, not a payload segment" % (name, self.spill_dir))
+                continue
+            path = os.path.join(self.spill_dir, name)
+            size = os.path.getsize(path)
+            self.segments.append([path, size])
+            self.spill_size += size
+            self.segment_index = max(self.segment_index, index + 1)
+        if self.segments:
+            log.info("Found %s payload segment%s to retry in %s" % (
+                len(self.segments), plural(len(self.segments)), self.spill_dir))
+
+    def add(self, url, data, headers):
+        """ Queue a payload to be retried """
+        size = len(data)
+        self.lock.acquire()
+        try:
+            if self.spill_dir is not None and (self.segments or self.size + size > self.max_size):
+                # Keep the order: once spilling, new payloads go after the spilled ones
+                self._spill(url, data, headers)
+                return
+            while self.payloads and self.size + size > self.max_size:
+                self.size -= len(self.payloads.popleft()[1])
+                self.dropped += 1
+            self.payloads.append((url, data, headers))
+            self.size += size
+        finally:
+            self.lock.release()
+
+    def _spill(self, url, data, headers):
+        data, body_api_key = strip_body_api_key(data, headers)
+        meta = json.dumps([strip_api_key(url), headers, body_api_key])
+        record = self.RECORD_HEADER.pack(len(meta), len(data)) + meta + data
+        while self.segments and self.spill_size + len(record) > self.max_spill_size:
+            self._drop_segment()
+        if self.segment_file is None or self.segments[-1][1] >= SPILL_SEGMENT_SIZE:
+            self._close_segment()
+            path = os.path.join(self.spill_dir, '%020d%s' % (self.segment_index, self.SEGMENT_SUFFIX))
+            self.segment_index += 1
+            self.segment_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600), 'ab')
+            self.segments.append([path, 0])
+        self.segment_file.write(record)
+        self.segment_file.flush()
+        self.segments[-1][1] += len(record)
+        self.spill_size += len(record)
+
+    def _close_segment(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+
+    def _drop_segment(self):
+        if len(self.segments) == 1:
+            self._close_segment()
+        path, size = self.segments.popleft()
+        self.spill_size -= size
+        log.warn("Retry queue is full, dropping the payloads of %s" % path)
+        self.dropped += len(self._read_segment(path))
+        os.remove(path)
+
+    def _read_segment(self, path):
+        payloads = []
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        offset = 0
+        header_size = self.RECORD_HEADER.size
+        while offset + header_size <= len(data):
+            meta_size, data_size = self.RECORD_HEADER.unpack_from(data, offset)
+            offset += header_size
+            if offset + meta_size + data_size > len(data):
+                # Truncated record, e.g. the agent stopped while writing it
+                break
+            meta = json.loads(data[offset:offset + meta_size])
+            url, headers = meta[0], meta[1]
+            offset += meta_size
+            body = data[offset:offset + data_size]
+            offset += data_size
+            if self.api_key:
+                url = add_api_key(url, self.api_key)
+                # Segments spilled by older versions don't have the body flag
+                if len(meta) > 2 and meta[2]:
+                    body = add_body_api_key(body, self.api_key)
+            payloads.append((url, body, headers))
+        return payloads
+
+    def _load_segments(self):
+        """ Move the oldest spilled payloads back to memory while there's room for them """
+        while self.segments and (not self.payloads or self.size + self.segments[0][1] <= self.max_size):
+            if len(self.segments) == 1:
+                self._close_segment()
+            path, size = self.segments.popleft()
+            self.spill_size -= size
+            for payload in self._read_segment(path):
+                self.payloads.append(payload)
+                self.size += len(payload[1])
+            os.remove(path)
+
+    def pop(self):
+        """ Oldest payload, None if the queue is empty """
+        self.lock.acquire()
+        try:
+            if not self.payloads:
+                self._load_segments()
+            if not self.payloads:
+                return None
+            payload = self.payloads.popleft()
+            self.size -= len(payload[1])
+            return payload
+        finally:
+            self.lock.release()
+
+    def push_back(self, payload):
+        """ Put back a payload that failed to be retried at the head of the queue """
+        self.lock.acquire()
+        try:
+            self.payloads.appendleft(payload)
+            self.size += len(payload[1])
+        finally:
+            self.lock.release()
+
+    def succeeded(self):
+        """ A payload was posted, retry right away """
+        self.failures = 0
+        self.next_retry = 0
+
+    def failed(self, now=None):
+        self.failures += 1
+        delay = min(RETRY_INITIAL_DELAY * 2 ** (self.failures - 1), self.max_delay)
+        self.next_retry = (now or time()) + delay
+
+    def retry(self, post, now=None):
+        """
+        Retry the queued payloads with `post`, which returns POST_RETRY if a
+        payload should be retried again, until one of them fails. Return the
+        number of payloads retried, posted or dropped.
+        """
+        now = now or time()
+        if now < self.next_retry:
+            return 0
+        count = 0
+        while True:
+            payload = self.pop()
+            if payload is None:
+                break
+            status = post(*payload)
+            if status == POST_RETRY:
+                self.push_back(payload)
+                self.failed(now)
+                break
+            count += 1
+            if status == POST_OK:
+                self.succeeded()
+        return count
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close_segment()
+        finally:
+            self.lock.release()
+
+
+def timed_connection(connection_class, on_connect):
+    """ Subclass an urllib3 connection class to call `on_connect` with the time taken to connect """
+    class TimedConnection(connection_class):
+        timed = True
+
+        def connect(self):
+            start_time = time()
+            connection_class.connect(self)
+            on_connect(time() - start_time)
+
+    return TimedConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter timing the new connections of its pools, TLS handshake
+    included, kept alive connections are reused untimed.
+    """
+
+    def __init__(self, on_connect, **kwargs):
+        self.on_connect = on_connect
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = HTTPAdapter.get_connection(self, url, proxies)
+        if not getattr(pool.ConnectionCls, 'timed', False):
+            pool.ConnectionCls = timed_connection(pool.ConnectionCls, self.on_connect)
+        return pool
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
     server.
     """
 
-    def __init__(self, interval, metrics_aggregator, api_host, api_key=None, use_watchdog=False, event_chunk_size=None):
+    def __init__(self, interval, metrics_aggregator, api_host, api_key=None, use_watchdog=False, event_chunk_size=None,
+            server=None, retry_queue=None, columnar_series_url=None, compressor=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        self.server = server
+        # Held while the aggregator's buffers are swapped, submissions hold it too
+        self.submit_lock = getattr(server, 'submit_lock', None) or threading.Lock()
         self.flush_count = 0
         self.log_count = 0
 
@@ -92,6 +803,21 @@ class Reporter(threading.Thread):
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
 
+        # Long-lived session, so that connections to the API are kept alive
+        self.session = None
+        # (metric name, value, tags) of the HTTP latencies since the last flush
+        self.http_stats = []
+        # Payloads that failed to be posted, None to drop them
+        self.retry_queue = retry_queue
+        # Series are posted as JSON to the API, or in the columnar format to
+        # columnar_series_url, if set, which must accept it
+        self.series_url = '%s/api/v1/series' % self.api_host
+        self.serialize_metrics = serialize_metrics
+        if columnar_series_url:
+            self.series_url = columnar_series_url
+            self.serialize_metrics = serialize_metrics_columnar
+        self.compressor = compressor or Compressor()
+
     def stop(self):
         log.info("Stopping reporter")
         self.finished.set()
@@ -106,11 +832,30 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet(): # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
-            self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+            # Reading the kernel's drops goes through /proc, don't hold up submissions meanwhile
+            udp_dropped = None
+            if self.server is not None:
+                udp_dropped = self.server.drop_counter.dropped()
+            self.submit_lock.acquire()
+            try:
+                self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+                self.metrics_aggregator.send_context_limit_stats()
+                self.send_http_stats()
+                self.send_retry_stats()
+                self.send_compression_stats()
+                if self.server is not None:
+                    self.server.send_stats(udp_dropped)
+            finally:
+                self.submit_lock.release()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
+        if self.session is not None:
+            self.session.close()
+        if self.retry_queue is not None:
+            self.retry_queue.close()
+
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
@@ -119,25 +864,37 @@ class Reporter(threading.Thread):
         try:
             self.flush_count += 1
             self.log_count += 1
-            packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
-            packet_count = self.metrics_aggregator.total_count
 
-            metrics = self.metrics_aggregator.flush()
+            # Only swapping the aggregator's buffers blocks the submissions, the
+            # swapped out buckets are then flushed while new samples come in.
+            self.submit_lock.acquire()
+            try:
+                packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
+                snapshot = self.metrics_aggregator.snapshot()
+                events = self.metrics_aggregator.flush_events()
+                service_checks = self.metrics_aggregator.flush_service_checks()
+            finally:
+                self.submit_lock.release()
+
+            if self.retry_queue is not None:
+                retried = self.retry_queue.retry(self.post)
+                if retried:
+                    log.info("Retried %s payload%s" % (retried, plural(retried)))
+
+            metrics = self.metrics_aggregator.flush_snapshot(snapshot)
             count = len(metrics)
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
-            if count:
-                self.submit(metrics)
-
-            events = self.metrics_aggregator.flush_events()
             event_count = len(events)
-            if event_count:
-                self.submit_events(events)
-
-            service_checks = self.metrics_aggregator.flush_service_checks()
             check_count = len(service_checks)
+            submissions = []
+            if count:
+                submissions.append((self.submit, metrics))
+            if event_count:
+                submissions.append((self.submit_events, events))
             if check_count:
-                self.submit_service_checks(service_checks)
+                submissions.append((self.submit_service_checks, service_checks))
+            self.submit_concurrently(submissions)
 
             should_log = self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT
             log_func = log.info
@@ -155,6 +912,8 @@ class Reporter(threading.Thread):
                 packets_per_second=packets_per_second,
                 metric_count=count,
                 event_count=event_count,
+                limited_context_count=self.metrics_aggregator.context_limited_count,
+                context_limit_offenders=self.metrics_aggregator.context_limit_offenders,
             ).persist()
 
         except Exception:
@@ -163,13 +922,76 @@ class Reporter(threading.Thread):
             else:
                 log.exception("Error flushing metrics")
 
+    def submit_concurrently(self, submissions):
+        """ Run the (submit function, payload) submissions in parallel and wait for them """
+        if len(submissions) == 1:
+            self._submit(*submissions[0])
+            return
+        threads = []
+        for submit, payload in submissions:
+            thread = threading.Thread(target=self._submit, args=(submit, payload))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _submit(self, submit, payload):
+        try:
+            submit(payload)
+        except Exception:
+            log.exception("Error submitting %s" % submit.__name__)
+
+    def get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = TimedHTTPAdapter(self.on_connect, pool_connections=1,
+                pool_maxsize=HTTP_POOL_SIZE)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def on_connect(self, duration):
+        self.http_stats.append(('datadog.dogstatsd.http.connect_time', duration * 1000.0, None))
+
+    def send_http_stats(self):
+        """ Submit the connection and request latencies, in ms, since the last call """
+        stats, self.http_stats = self.http_stats, []
+        for name, value, tags in stats:
+            self.metrics_aggregator.submit_metric(name, value, 'h', tags=tags)
+
+    def send_compression_stats(self):
+        """
+        Submit the compression ratio of the series payloads, the time spent
+        compressing them in ms, and the compression level, since the last call
+        """
+        stats = self.compressor.report()
+        if stats is None:
+            return
+        ratio, duration, level = stats
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.compression.ratio', ratio, 'g')
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.compression.time', duration, 'g')
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.compression.level', level, 'g')
+
+    def send_retry_stats(self):
+        """ Submit the size of the retry queue, and the payloads it dropped since the last call """
+        queue = self.retry_queue
+        if queue is None:
+            return
+        dropped, queue.dropped = queue.dropped, 0
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.retry_queue.size', queue.size, 'g')
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.retry_queue.spilled_size',
+            queue.spill_size, 'g')
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.retry_queue.dropped', dropped, 'g')
+
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
-        url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        url = '%s?%s' % (self.series_url, urlencode(params))
+        # Payloads are posted as they're serialized, one at a time
+        for body, headers in self.serialize_metrics(metrics, compressor=self.compressor):
+            self.submit_http(url, body, headers)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -193,17 +1015,33 @@ class Reporter(threading.Thread):
             self.submit_http(url, json.dumps(payload), headers)
 
     def submit_http(self, url, data, headers):
+        headers["DD-Dogstatsd-Version"] = get_version()
+        status = self.post(url, data, headers)
+        if status == POST_OK:
+            if self.retry_queue is not None:
+                self.retry_queue.succeeded()
+        elif status == POST_RETRY and self.retry_queue is not None:
+            log.info("Payload will be retried")
+            self.retry_queue.add(url, data, headers)
+
+    def post(self, url, data, headers):
+        """
+        Post a payload, return POST_OK, POST_RETRY if it failed and should be
+        retried, or POST_DROPPED if it was rejected for good, e.g. with a 403.
+        """
         no_proxy = {
         # See https://github.com/kennethreitz/requests/issues/879
         # and https://github.com/DataDog/dd-agent/issues/1112
             'no': 'pass',
         }
-        headers["DD-Dogstatsd-Version"] = get_version()
         log.debug("Posting payload to %s" % url)
+        r = None
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5,
+            r = self.get_session().post(url, data=data, timeout=HTTP_TIMEOUT,
                 headers=headers, proxies=no_proxy)
+            self.http_stats.append(('datadog.dogstatsd.http.request_time',
+                (time() - start_time) * 1000.0, ('endpoint:%s' % urlparse(url).path, )))
 
             r.raise_for_status()
 
@@ -216,11 +1054,15 @@ class Reporter(threading.Thread):
                             status, url, duration))
         except Exception:
             log.exception("Unable to post payload.")
-            try:
-                log.error("Received status code: {0}".format(r.status_code))
-            except Exception:
-                pass
-
+            if r is None:
+                # Connection error or timeout
+                return POST_RETRY
+            log.error("Received status code: {0}".format(r.status_code))
+            if r.status_code >= 500 or r.status_code in RETRY_STATUS_CODES:
+                return POST_RETRY
+            # Other client errors would fail again
+            return POST_DROPPED
+        return POST_OK
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
@@ -232,23 +1074,302 @@ class Reporter(threading.Thread):
         url = '{0}/api/v1/check_run?{1}'.format(self.api_host, urlencode(params))
         self.submit_http(url, json.dumps(service_checks), headers)
 
+class StatsdForwarder(object):
+    """
+    Forwards the packets received by the server to another statsd server.
+
+    In `raw` mode, every datagram is forwarded as is. In `coalesce` mode, packets
+    are packed into datagrams of up to `mtu` bytes, sent when full or at most
+    FORWARD_COALESCE_DELAY seconds later. In `aggregate` mode, counters are summed
+    and only the last value of gauges is kept, they're forwarded every
+    `flush_interval` seconds, the other packets are coalesced.
+    """
+
+    def __init__(self, sock, mode='raw', mtu=None, flush_interval=DOGSTATSD_FLUSH_INTERVAL):
+        if mode not in FORWARD_MODES:
+            raise ValueError("Invalid statsd forward mode %s, expected one of %s" % (mode, ', '.join(FORWARD_MODES)))
+        self.sock = sock
+        self.mode = mode
+        self.mtu = int(mtu or FORWARD_MTU)
+        self.flush_interval = flush_interval
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.buffer_time = None
+
+        self.counters = {}
+        self.gauges = {}
+        self.last_flush = time()
+
+    def forward(self, messages):
+        """ Forward a list of datagrams """
+        if self.mode == 'raw':
+            for message in messages:
+                self.sock.send(message)
+        elif self.mode == 'coalesce':
+            for message in messages:
+                self._add(message)
+        else:
+            for message in messages:
+                for packet in message.splitlines():
+                    if not self._aggregate(packet):
+                        self._add(packet)
+
+    def _add(self, packet):
+        size = len(packet)
+        if self.buffer and self.buffer_size + 1 + size > self.mtu:
+            self._send_buffer()
+        if not self.buffer:
+            self.buffer_time = time()
+            self.buffer_size = size
+        else:
+            self.buffer_size += 1 + size
+        self.buffer.append(packet)
+
+    def _send_buffer(self):
+        if self.buffer:
+            self.sock.send('\n'.join(self.buffer))
+        self.buffer = []
+        self.buffer_size = 0
+        self.buffer_time = None
+
+    def _aggregate(self, packet):
+        """ Aggregate a counter or a gauge packet, return False for any other packet """
+        name, separator, data = packet.partition(':')
+        if not separator or packet.startswith('_'):
+            return False
+        fields = data.split('|')
+        if len(fields) < 2 or ':' in data.partition('|#')[0]:
+            # Several values in one packet, leave it as is
+            return False
+        mtype = fields[1]
+        if mtype not in ('c', 'g'):
+            return False
+
+        sample_rate = 1
+        tags = None
+        for field in fields[2:]:
+            if field.startswith('@'):
+                sample_rate = field[1:]
+            elif field.startswith('#'):
+                tags = field
+        try:
+            value = float(fields[0])
+            sample_rate = float(sample_rate)
+        except ValueError:
+            return False
+
+        key = (name, tags)
+        if mtype == 'c':
+            if sample_rate <= 0:
+                return False
+            self.counters[key] = self.counters.get(key, 0) + value / sample_rate
+        else:
+            self.gauges[key] = fields[0]
+        return True
+
+    def _format_aggregate(self, name, value, mtype, tags):
+        if tags is None:
+            return '%s:%s|%s' % (name, value, mtype)
+        return '%s:%s|%s|%s' % (name, value, mtype, tags)
+
+    def flush_aggregates(self):
+        """ Forward the aggregated counters and gauges """
+        counters, self.counters = self.counters, {}
+        gauges, self.gauges = self.gauges, {}
+        for (name, tags), value in counters.iteritems():
+            if value == int(value):
+                value = int(value)
+            else:
+                value = repr(value)
+            self._add(self._format_aggregate(name, value, 'c', tags))
+        for (name, tags), value in gauges.iteritems():
+            self._add(self._format_aggregate(name, value, 'g', tags))
+        self.last_flush = time()
+
+    def timeout(self, now):
+        """ Time in seconds until the next flush, None if nothing is waiting """
+        timeouts = []
+        if self.buffer_time is not None:
+            timeouts.append(self.buffer_time + FORWARD_COALESCE_DELAY - now)
+        if self.counters or self.gauges:
+            timeouts.append(self.last_flush + self.flush_interval - now)
+        if not timeouts:
+            return None
+        return max(min(timeouts), 0)
+
+    def flush(self, force=False):
+        """ Send what is due, or everything if `force` """
+        now = time()
+        if self.counters or self.gauges:
+            if force or now - self.last_flush >= self.flush_interval:
+                self.flush_aggregates()
+        if self.buffer_time is not None:
+            if force or now - self.buffer_time >= FORWARD_COALESCE_DELAY:
+                self._send_buffer()
+
+
+class DogstatsdTCPServer(TCPServer):
+    """
+    Accepts statsd packets over TCP, and hands them to `submit` by batches.
+    """
+
+    def __init__(self, submit, framing='newline', max_connections=None, io_loop=None, **kwargs):
+        if framing not in TCP_FRAMINGS:
+            raise ValueError("Invalid dogstatsd TCP framing %s, expected one of %s" % (framing, ', '.join(TCP_FRAMINGS)))
+        self.submit = submit
+        self.framing = framing
+        self.max_connections = int(max_connections or TCP_MAX_CONNECTIONS)
+        self.connections = set()
+        TCPServer.__init__(self, io_loop=io_loop, **kwargs)
+
+    def handle_stream(self, stream, address):
+        if len(self.connections) >= self.max_connections:
+            log.warning("Refusing dogstatsd TCP connection from %s, already %s connections open"
+                % (address, len(self.connections)))
+            stream.close()
+            return
+        self.connections.add(DogstatsdTCPConnection(self, stream, address))
+
+    def close_all(self):
+        for connection in list(self.connections):
+            connection.stream.close()
+
+
+class DogstatsdTCPConnection(object):
+
+    def __init__(self, server, stream, address):
+        log.debug('received a new connection from %s', address)
+        self.server = server
+        self.submit = server.submit
+        self.stream = stream
+        self.address = address
+        self.stream.set_close_callback(self._on_close)
+        if server.framing == 'length':
+            self.stream.read_bytes(4, self._on_read_header)
+        else:
+            # Lines can be split between reads, keep the last partial one
+            self.partial = ''
+            self.stream.read_until_close(self._on_read_chunk, streaming_callback=self._on_read_chunk)
+
+    def _on_read_chunk(self, data):
+        if not data:
+            return
+        data = self.partial + data
+        end = data.rfind('\n')
+        if end == -1:
+            self.partial = data
+        else:
+            self.partial = data[end + 1:]
+            self._submit(data[:end])
+        if len(self.partial) > TCP_MAX_FRAME_SIZE:
+            log.warning("Closing dogstatsd TCP connection from %s, line longer than %s bytes"
+                % (self.address, TCP_MAX_FRAME_SIZE))
+            self.partial = ''
+            self.stream.close()
+
+    def _on_read_header(self, data):
+        size = struct.unpack('!L', data)[0]
+        if size > TCP_MAX_FRAME_SIZE:
+            log.warning("Closing dogstatsd TCP connection from %s, batch of %s bytes is too large"
+                % (self.address, size))
+            self.stream.close()
+        elif size == 0:
+            self.stream.read_bytes(4, self._on_read_header)
+        else:
+            self.stream.read_bytes(size, self._on_read_batch)
+
+    def _on_read_batch(self, data):
+        self._submit(data)
+        if not self.stream.closed():
+            self.stream.read_bytes(4, self._on_read_header)
+
+    def _submit(self, data):
+        try:
+            self.submit(data)
+        except Exception:
+            log.exception('Error processing packets from %s' % (self.address, ))
+
+    def _on_close(self):
+        log.debug('client quit %s', self.address)
+        if self.server.framing == 'newline' and self.partial:
+            # The last line doesn't need a newline
+            self._submit(self.partial)
+            self.partial = ''
+        self.server.connections.discard(self)
+
+
+class TCPListener(threading.Thread):
+    """
+    Runs a DogstatsdTCPServer in its own IO loop. It binds its port as it's
+    created, so it must be created by the process that runs it, once daemonized.
+    """
+
+    def __init__(self, submit, host, port, framing='newline', max_connections=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = int(port)
+        self.io_loop = IOLoop()
+        self.tcp_server = DogstatsdTCPServer(submit, framing or 'newline', max_connections,
+            io_loop=self.io_loop)
+        self.tcp_server.listen(self.port, self.host)
+        log.info('Listening on TCP host & port: %s' % str((self.host, self.port)))
+
+    def run(self):
+        self.io_loop.start()
+        self.io_loop.close(all_fds=True)
+
+    def stop(self):
+        def stop_loop():
+            self.tcp_server.stop()
+            self.tcp_server.close_all()
+            self.io_loop.stop()
+        self.io_loop.add_callback(stop_loop)
+
+
 class Server(object):
     """
     A statsd udp server.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+            recv_batch_size=None, reuse_port=False, socket_path=None, so_rcvbuf=None,
+            pipeline_queue_size=None, forward_mode=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.recv_batch_size = max(int(recv_batch_size or RECV_BATCH_SIZE), 1)
+        self.reuse_port = reuse_port
+        self.socket_path = socket_path
+        self.unix_socket = None
+        self.so_rcvbuf = so_rcvbuf
+        self.drop_counter = UdpDropCounter(self.port)
+
+        # When pipelined, the server thread only reads from the sockets, and a
+        # parsing thread submits what it read to the aggregator.
+        self.pipeline_queue_size = int(pipeline_queue_size or PIPELINE_QUEUE_SIZE)
+        self.pipeline_queue = None
+        self.pipeline_thread = None
+        # Packets dropped because the queue was full, only ever incremented by
+        # the reading thread; the stats report the difference since last time.
+        self.pipeline_dropped = 0
+        self.pipeline_dropped_reported = 0
+
+        # Packets can also be submitted from the thread of a TCP listener,
+        # created by calling tcp_listener_factory with the submit function.
+        self.submit_lock = threading.Lock()
+        self.tcp_listener_factory = None
+        self.tcp_listener = None
 
         self.running = False
 
         self.should_forward = forward_to_host is not None
 
         self.forward_udp_sock = None
+        self.forwarder = None
         # In case we want to forward every packet received to another statsd server
         if self.should_forward:
             if forward_to_port is None:
@@ -258,8 +1379,10 @@ class Server(object):
             try:
                 self.forward_udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 self.forward_udp_sock.connect((forward_to_host, forward_to_port))
+                self.forwarder = StatsdForwarder(self.forward_udp_sock, forward_mode or 'raw')
             except Exception:
                 log.exception("Error while setting up connection to external statsd server")
+                self.should_forward = False
 
     def start(self):
         """ Run the server. """
@@ -267,6 +1390,12 @@ class Server(object):
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if self.reuse_port:
+            # Let several processes bind the same port, the kernel balances
+            # the datagrams between them.
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.so_rcvbuf:
+            self._set_rcvbuf(self.socket)
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -277,38 +1406,390 @@ class Server(object):
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+        sockets = [self.socket]
+        if self.socket_path is not None:
+            self.unix_socket = self._bind_unix_socket(self.socket_path)
+            sockets.append(self.unix_socket)
+            log.info('Listening on unix socket: %s' % self.socket_path)
+
+        self.running = True
+
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        recv_batch_size = self.recv_batch_size
+        recv_batch = self._recv_batch
+        if self.pipeline_queue_size:
+            aggregator_submit = self._start_pipeline()
+        else:
+            aggregator_submit = self.submit_packets
+        if self.tcp_listener_factory is not None:
+            self.tcp_listener = self.tcp_listener_factory(self.submit_packets)
+            self.tcp_listener.start()
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
         should_forward = self.should_forward
         forward_udp_sock = self.forward_udp_sock
+        # Coalescing and aggregating forwarders hold packets for a while
+        forwarder = None
+        if should_forward and self.forwarder.mode != 'raw':
+            forwarder = self.forwarder
 
         # Run our select loop.
-        self.running = True
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
+                if forwarder is not None:
+                    forwarder.flush()
+                    forward_timeout = forwarder.timeout(time())
+                    if forward_timeout is not None:
+                        timeout = min(forward_timeout, UDP_SOCKET_TIMEOUT)
+                    else:
+                        timeout = UDP_SOCKET_TIMEOUT
+                ready = select_select(sockets, [], [], timeout)
+                for readable in ready[0]:
+                    if recv_batch_size == 1:
+                        message = readable.recv(buffer_size)
+                    else:
+                        # Drain the datagrams already queued on the socket, up to
+                        # recv_batch_size, and submit them all at once.
+                        message, messages = recv_batch(readable, should_forward)
+
                     aggregator_submit(message)
 
                     if should_forward:
-                        forward_udp_sock.send(message)
+                        if forwarder is not None:
+                            if recv_batch_size == 1:
+                                forwarder.forward([message])
+                            else:
+                                forwarder.forward(messages)
+                        elif recv_batch_size == 1:
+                            forward_udp_sock.send(message)
+                        else:
+                            for m in messages:
+                                forward_udp_sock.send(m)
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram')
 
+        if forwarder is not None:
+            try:
+                forwarder.flush(force=True)
+            except Exception:
+                log.exception('Error forwarding the last packets')
+
+        if self.tcp_listener is not None:
+            self.tcp_listener.stop()
+            self.tcp_listener.join()
+
+        if self.pipeline_thread is not None:
+            # Let the parsing thread finish the queued packets
+            self.pipeline_queue.put(None)
+            self.pipeline_thread.join()
+
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            self._remove_socket_file(self.socket_path)
+
+    def submit_packets(self, packets):
+        """ Submit packets to the aggregator, from any thread """
+        self.submit_lock.acquire()
+        try:
+            self.metrics_aggregator.submit_packets(packets)
+        finally:
+            self.submit_lock.release()
+
+    def _recv_batch(self, sock, keep_datagrams=False):
+        """
+        Read up to recv_batch_size datagrams from `sock`, and return them joined by
+        newlines, along with the list of datagrams if `keep_datagrams`.
+
+        recv_into preallocated buffers doesn't save anything here: the strings
+        the parser needs are still created when copying out of the buffers, and
+        tests/performance/benchmark_recv.py measures it as slower than recv.
+        """
+        buffer_size = self.buffer_size
+        recv = sock.recv
+        recv_batch_size = self.recv_batch_size
+        datagrams = []
+
+        try:
+            while len(datagrams) < recv_batch_size:
+                datagrams.append(recv(buffer_size))
+        except socket.error, e:
+            if not datagrams or e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        message = '\n'.join(datagrams)
+        if not keep_datagrams:
+            datagrams = None
+        return message, datagrams
+
+    def _start_pipeline(self):
+        """
+        Start the parsing thread, and return the function the reading thread
+        hands the received packets to.
+        """
+        self.pipeline_queue = Queue(self.pipeline_queue_size)
+        self.pipeline_thread = threading.Thread(target=self._run_pipeline)
+        self.pipeline_thread.daemon = True
+        self.pipeline_thread.start()
+
+        queue_put = self.pipeline_queue.put_nowait
+
+        def submit(message):
+            try:
+                queue_put(message)
+            except Full:
+                # Rather drop packets here, where we know it, than in the kernel
+                self.pipeline_dropped += message.count('\n') + 1
+
+        return submit
+
+    def _run_pipeline(self):
+        """ Submit the packets queued by the reading thread, until the server stops """
+        queue_get = self.pipeline_queue.get
+        aggregator_submit = self.submit_packets
+        while True:
+            message = queue_get()
+            if message is None:
+                break
+            try:
+                aggregator_submit(message)
+            except Exception:
+                log.exception('Error parsing datagram')
+
+    def _bind_unix_socket(self, path):
+        self._remove_socket_file(path)
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        unix_socket.setblocking(0)
+        if self.so_rcvbuf:
+            self._set_rcvbuf(unix_socket)
+        unix_socket.bind(path)
+        # Any local user can send to the UDP port, allow them to use the socket too
+        os.chmod(path, 0666)
+        return unix_socket
+
+    def _set_rcvbuf(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.so_rcvbuf)
+        # Linux doubles the value to account for its bookkeeping, and caps it
+        # to the net.core.rmem_max sysctl.
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if actual < self.so_rcvbuf:
+            log.warning("Could only set the receive buffer size to %s bytes instead of %s, "
+                "try raising net.core.rmem_max" % (actual, self.so_rcvbuf))
+
+    @staticmethod
+    def _remove_socket_file(path):
+        # Remove a socket left over by a previous run, but nothing else
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+        except OSError:
+            pass
+
+    def send_stats(self, udp_dropped=None):
+        """
+        Submit the internal metrics of the server to its aggregator, along with
+        the datagrams dropped by the kernel, read from its drop_counter.
+        """
+        if udp_dropped is not None:
+            self.metrics_aggregator.submit_metric('datadog.dogstatsd.packet.dropped', udp_dropped, 'g')
+        self.send_pipeline_stats()
+
+    def send_pipeline_stats(self, tags=None):
+        """ Submit the queue depth and the packets dropped by the parsing thread, if any """
+        if self.pipeline_queue is None:
+            return
+        # Not reset here: the reading thread could increment it in between
+        total_dropped = self.pipeline_dropped
+        dropped = total_dropped - self.pipeline_dropped_reported
+        self.pipeline_dropped_reported = total_dropped
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.pipeline.queue_depth',
+            self.pipeline_queue.qsize(), 'g', tags=tags)
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.pipeline.dropped',
+            dropped, 'g', tags=tags)
+
+    def stop(self):
+        self.running = False
+
+
+class WorkerPool(object):
+    """
+    Runs several statsd servers in child processes, all listening on the same port
+    with SO_REUSEPORT so that the kernel spreads the traffic between them.
+
+    `server_factory` is called in each worker with its aggregator and its index.
+    Each worker aggregates what it receives in its own aggregator, and sends its
+    state to the main process every WORKER_EXPORT_INTERVAL seconds. There it is
+    merged into `metrics_aggregator`, which the reporter flushes as usual, but
+    only the buckets closed before every worker last exported: until then, a
+    worker may still hold samples of them.
+
+    Workers aren't restarted: the main process runs threads by then, and forking
+    it would only keep the forking one. If a worker exits, the pool stops, and
+    dogstatsd with it, to be restarted as a whole.
+    """
+
+    def __init__(self, metrics_aggregator, worker_count, aggregator_factory, server_factory, port):
+        self.metrics_aggregator = metrics_aggregator
+        self.worker_count = int(worker_count)
+        self.aggregator_factory = aggregator_factory
+        self.server_factory = server_factory
+        # All the workers share the port, so do their drops
+        self.drop_counter = UdpDropCounter(int(port))
+        self.queue = None
+        self.workers = []
+        # When each worker last exported its state
+        self.export_times = {}
+        # Packets can also be submitted from the thread of a TCP listener
+        self.submit_lock = threading.Lock()
+        self.tcp_listener_factory = None
+        self.tcp_listener = None
+        self.running = False
+
+    def _run_worker(self, index, queue):
+        aggregator = self.aggregator_factory()
+        if aggregator.context_limiter is not None:
+            # The kernel spreads the contexts between the workers
+            aggregator.context_limiter.share(self.worker_count)
+        server = self.server_factory(aggregator, index)
+        stopped = threading.Event()
+
+        def stop(signum, frame):
+            server.stop()
+
+        # The parent process is in charge of the Ctrl-C, we just need to stop
+        # when it tells us to.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, stop)
+
+        def export():
+            while not stopped.isSet():
+                stopped.wait(WORKER_EXPORT_INTERVAL)
+                try:
+                    server.submit_lock.acquire()
+                    try:
+                        # The drops on the port are reported by the main process
+                        server.send_pipeline_stats(tags=['worker:%s' % index])
+                        export_time = time()
+                        snapshot = aggregator.swap()
+                    finally:
+                        server.submit_lock.release()
+                    state = aggregator.export_state(snapshot)
+                    state['worker'] = index
+                    state['export_time'] = export_time
+                    queue.put(state)
+                except Exception:
+                    log.exception("Error exporting worker metrics")
+
+        exporter = threading.Thread(target=export)
+        exporter.daemon = True
+        exporter.start()
+
+        try:
+            server.start()
+        finally:
+            stopped.set()
+            exporter.join()
+
+    def _spawn_worker(self, index):
+        worker = multiprocessing.Process(target=self._run_worker, args=(index, self.queue))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def spawn_workers(self):
+        """
+        Fork the workers. A forked process only keeps the thread that forked it,
+        so this must be called before starting any other thread.
+        """
+        self.queue = multiprocessing.Queue()
+        spawn_time = time()
+        self.export_times = dict((i, spawn_time) for i in xrange(self.worker_count))
+        self.metrics_aggregator.flush_time_limit = spawn_time
+        self.workers = [self._spawn_worker(i) for i in xrange(self.worker_count)]
+        log.info("Started %s dogstatsd workers" % self.worker_count)
+
+    def start(self):
+        """ Start the workers, unless they're already spawned, and merge their metrics until stopped. """
+        if not self.workers:
+            self.spawn_workers()
+
+        import_state = self.import_state
+        queue_get = self.queue.get
+        timeout = UDP_SOCKET_TIMEOUT
+
+        if self.tcp_listener_factory is not None:
+            self.tcp_listener = self.tcp_listener_factory(self.submit_packets)
+            self.tcp_listener.start()
+
+        self.running = True
+        while self.running:
+            try:
+                import_state(queue_get(True, timeout))
+            except Empty:
+                pass
+            except (IOError, OSError), e:
+                # Ignore interrupted system calls from sigterm.
+                if e.errno != errno.EINTR:
+                    log.exception('Error merging worker metrics')
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                log.exception('Error merging worker metrics')
+
+            for worker in self.workers:
+                if self.running and not worker.is_alive():
+                    log.error("Dogstatsd worker %s exited with code %s, stopping"
+                        % (worker.pid, worker.exitcode))
+                    self.running = False
+
+        if self.tcp_listener is not None:
+            self.tcp_listener.stop()
+            self.tcp_listener.join()
+
+        self._stop_workers()
+
+    def import_state(self, state):
+        self.submit_lock.acquire()
+        try:
+            self.metrics_aggregator.import_state(state)
+            self.export_times[state['worker']] = state['export_time']
+            self.metrics_aggregator.flush_time_limit = min(self.export_times.values())
+        finally:
+            self.submit_lock.release()
+
+    def submit_packets(self, packets):
+        """ Submit packets to the main aggregator, from any thread """
+        self.submit_lock.acquire()
+        try:
+            self.metrics_aggregator.submit_packets(packets)
+        finally:
+            self.submit_lock.release()
+
+    def send_stats(self, udp_dropped=None):
+        if udp_dropped is not None:
+            self.metrics_aggregator.submit_metric('datadog.dogstatsd.packet.dropped', udp_dropped, 'g')
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(UDP_SOCKET_TIMEOUT + WORKER_EXPORT_INTERVAL)
+
+        # Merge what the workers sent before exiting.
+        while True:
+            try:
+                self.import_state(self.queue.get(True, 0.1))
+            except Empty:
+                break
+
     def stop(self):
         self.running = False
 
@@ -333,6 +1814,10 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Fork the workers while the process has a single thread
+        if isinstance(self.server, WorkerPool):
+            self.server.spawn_workers()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -380,8 +1865,16 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     non_local_traffic = c['non_local_traffic']
     forward_to_host = c.get('statsd_forward_host')
     forward_to_port = c.get('statsd_forward_port')
+    forward_mode = c.get('statsd_forward_mode')
     event_chunk_size = c.get('event_chunk_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    recv_batch_size = c.get('dogstatsd_recv_batch_size')
+    worker_count = c.get('dogstatsd_workers', 1)
+    socket_path = c.get('dogstatsd_socket')
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf')
+    context_cache_size = c.get('dogstatsd_context_cache_size')
+    pipeline_queue_size = c.get('dogstatsd_pipeline_queue_size')
+    tcp_port = c.get('dogstatsd_tcp_port')
 
     target = c['dd_url']
     if use_forwarder:
@@ -393,18 +1886,27 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    def aggregator_factory():
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(c),
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            histogram_backend=c.get('histogram_backend'),
+            histogram_relative_accuracy=c.get('histogram_relative_accuracy'),
+            histogram_max_samples=c.get('histogram_max_samples'),
+            set_backend=c.get('set_backend'),
+            set_precision=c.get('set_precision'),
+            utf8_decoding=c['utf8_decoding'],
+            context_cache_size=context_cache_size,
+            max_new_contexts=c.get('dogstatsd_max_new_contexts'),
+            max_new_contexts_per_name=c.get('dogstatsd_max_new_contexts_per_name'),
+            context_overflow=c.get('dogstatsd_context_overflow')
+        )
+
+    aggregator = aggregator_factory()
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -413,7 +1915,35 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    def server_factory(aggregator, reuse_port=False, socket_path=None):
+        return Server(aggregator, server_host, port, forward_to_host=forward_to_host,
+            forward_to_port=forward_to_port, recv_batch_size=recv_batch_size,
+            reuse_port=reuse_port, socket_path=socket_path, so_rcvbuf=so_rcvbuf,
+            pipeline_queue_size=pipeline_queue_size, forward_mode=forward_mode)
+
+    if worker_count > 1:
+        # Only one process can listen on the unix socket, let the first worker do it
+        server = WorkerPool(aggregator, worker_count, aggregator_factory,
+            lambda worker_aggregator, index: server_factory(worker_aggregator, reuse_port=True,
+                socket_path=socket_path if index == 0 else None), port)
+    else:
+        server = server_factory(aggregator, socket_path=socket_path)
+
+    if tcp_port is not None:
+        # The listener binds its port, it's created once the server starts
+        server.tcp_listener_factory = lambda submit: TCPListener(submit, server_host, tcp_port,
+            framing=c.get('dogstatsd_tcp_framing'), max_connections=c.get('dogstatsd_tcp_max_connections'))
+
+    retry_queue = None
+    retry_queue_max_size = c.get('dogstatsd_retry_queue_max_size')
+    if retry_queue_max_size != 0:
+        retry_queue = RetryQueue(retry_queue_max_size, c.get('dogstatsd_retry_spill_dir'),
+            c.get('dogstatsd_retry_spill_max_size'), api_key=api_key)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+        server=server, retry_queue=retry_queue, columnar_series_url=c.get('dogstatsd_columnar_series_url'),
+        compressor=get_compressor(c))
 
     return reporter, server, c
 
@@ -3,13 +3,13 @@ from hashlib import md5
 import logging
 import re
 import sys
-import zlib
 
 # 3rd party
 import requests
 import simplejson as json
 
 # project
+from compression import get_compressor
 from config import get_version
 
 # urllib3 logs a bunch of stuff at the info level
@@ -31,8 +31,11 @@ NO_PROXY = {
 def remove_control_chars(s):
     return control_char_re.sub('', s)
 
-def http_emitter(message, log, agentConfig):
-    "Send payload"
+def http_emitter(message, log, agentConfig, compressor=None):
+    """
+    Send payload, compressed with `compressor`, or with a new compressor set up
+    by the config if there's none.
+    """
     url = agentConfig['dd_url']
 
     log.debug('http_emitter: attempting postback to ' + url)
@@ -44,7 +47,9 @@ def http_emitter(message, log, agentConfig):
         message = remove_control_chars(message)
         payload = json.dumps(message)
 
-    zipped = zlib.compress(payload)
+    if compressor is None:
+        compressor = get_compressor(agentConfig)
+    zipped = compressor.compress(payload)
 
     log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f" % (len(payload), len(zipped), float(len(payload))/float(len(zipped))))
 
@@ -56,7 +61,7 @@ def http_emitter(message, log, agentConfig):
 
     try:
         r = requests.post(url, data=zipped, timeout=5,
-            headers=post_headers(agentConfig, zipped), proxies=NO_PROXY)
+            headers=post_headers(agentConfig, zipped, compressor.content_encoding), proxies=NO_PROXY)
 
         r.raise_for_status()
 
@@ -71,13 +76,15 @@ def http_emitter(message, log, agentConfig):
             pass
 
 
-def post_headers(agentConfig, payload):
-    return {
+def post_headers(agentConfig, payload, content_encoding='deflate'):
+    headers = {
         'User-Agent': 'Datadog Agent/%s' % agentConfig['version'],
         'Content-Type': 'application/json',
-        'Content-Encoding': 'deflate',
         'Accept': 'text/html, */*',
         'Content-MD5': md5(payload).hexdigest(),
         'DD-Collector-Version': get_version()
     }
+    if content_encoding is not None:
+        headers['Content-Encoding'] = content_encoding
+    return headers
     
\ No newline at end of file
@@ -2,7 +2,11 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
-from aggregator import MetricsAggregator, MetricsBucketAggregator
+import random
+import time
+
+from aggregator import (DEFAULT_HISTOGRAM_AGGREGATES, Histogram, MetricsAggregator,
+    MetricsBucketAggregator, api_formatter)
 
 
 class TestAggregatorPerf(object):
@@ -106,6 +110,32 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    HISTOGRAM_SAMPLE_COUNTS = (10000, 100000, 1000000)
+
+    def test_histogram_flush_perf(self):
+        import aggregator
+        rand = random.Random(42)
+        config = {'aggregates': DEFAULT_HISTOGRAM_AGGREGATES, 'percentiles': [0.95, 0.99]}
+
+        for sample_count in self.HISTOGRAM_SAMPLE_COUNTS:
+            samples = [rand.lognormvariate(3, 2) for _ in xrange(sample_count)]
+            timings = []
+            # With numpy's selection if it's available, and by sorting
+            for numpy_module in (aggregator.numpy, None):
+                histogram = Histogram(api_formatter, 'histogram', None, 'my.host', None, config)
+                histogram.samples = list(samples)
+                histogram.count = sample_count
+                original_numpy, aggregator.numpy = aggregator.numpy, numpy_module
+                try:
+                    start = time.time()
+                    histogram.flush(start, 10)
+                    timings.append(time.time() - start)
+                finally:
+                    aggregator.numpy = original_numpy
+            print "%s samples: %.4fs with %s, %.4fs sorting" % (sample_count, timings[0],
+                'numpy selection' if aggregator.numpy is not None else 'sorting', timings[1])
+
+
 if __name__ == '__main__':
     t = TestAggregatorPerf()
     #t.test_dogstatsd_aggregation_perf()
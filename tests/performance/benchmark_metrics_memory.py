@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Memory footprint of the metrics kept by the dogstatsd aggregator.
+"""
+import sys
+
+import nose.tools as nt
+
+from aggregator import MetricsBucketAggregator
+
+
+class DictMetric(object):
+    """ A metric as it used to be stored: a regular object with a dict """
+
+
+def dict_size(metric):
+    """ Size the same metric would take with a per-instance dict """
+    legacy = DictMetric()
+    legacy.__dict__.update(metric.__getstate__())
+    return sys.getsizeof(legacy) + sys.getsizeof(legacy.__dict__)
+
+
+class TestMetricsMemory(object):
+
+    CONTEXT_COUNT = 100000
+
+    def test_metrics_memory(self):
+        ma = MetricsBucketAggregator('my.host')
+        for i in xrange(self.CONTEXT_COUNT):
+            tags = 'env:prod,service:web,endpoint:/api/v1/resource/%s' % i
+            ma.submit_packets('web.request.count:1|c|#%s' % tags)
+            ma.submit_packets('web.pool.size:%s|g|#%s' % (i, tags))
+            ma.submit_packets('web.request.latency:%s|ms|#%s' % (i, tags))
+            ma.submit_packets('web.users:user%s|s|#%s' % (i, tags))
+
+        by_class = {}
+        for metric_by_context in ma.metric_by_bucket.itervalues():
+            for metric in metric_by_context.itervalues():
+                nt.assert_false(hasattr(metric, '__dict__'))
+                sizes = by_class.setdefault(type(metric).__name__, [0, 0, 0])
+                sizes[0] += 1
+                sizes[1] += sys.getsizeof(metric)
+                sizes[2] += dict_size(metric)
+
+        total_slotted = total_dict = 0
+        for name, (count, slotted, with_dict) in sorted(by_class.iteritems()):
+            print "%s: %d bytes per metric with slots, %d with a dict" % (
+                name, slotted / count, with_dict / count)
+            total_slotted += slotted
+            total_dict += with_dict
+        print "%d metrics: %.1f MB with slots, %.1f MB with a dict (-%d%%)" % (
+            4 * self.CONTEXT_COUNT, total_slotted / 1048576., total_dict / 1048576.,
+            100 * (total_dict - total_slotted) / total_dict)
+        nt.assert_true(total_slotted < total_dict)
@@ -0,0 +1,130 @@
+"""
+Performance tests for the dogstatsd packet parser.
+
+Run with `nosetests -s` to see the throughput of the parser compared to the
+previous implementation, kept here as a reference.
+"""
+import random
+from timeit import repeat
+
+import nose.tools as nt
+
+from aggregator import MetricsBucketAggregator
+
+
+def reference_parse_metric_packet(packet, allow_strings=('s',)):
+    """ The previous parser, splitting on ':' then stitching the tags back """
+    parsed_packets = []
+    name_and_metadata = packet.split(':', 1)
+
+    if len(name_and_metadata) != 2:
+        raise Exception('Unparseable metric packet: %s' % packet)
+
+    name = name_and_metadata[0]
+    broken_split = name_and_metadata[1].split(':')
+    data = []
+    partial_datum = None
+    for token in broken_split:
+        if partial_datum is None:
+            partial_datum = token
+        elif "|" not in token:
+            partial_datum += ":" + token
+        else:
+            data.append(partial_datum)
+            partial_datum = token
+    data.append(partial_datum)
+
+    for datum in data:
+        value_and_metadata = datum.split('|')
+
+        if len(value_and_metadata) < 2:
+            raise Exception('Unparseable metric packet: %s' % packet)
+
+        raw_value = value_and_metadata[0]
+        metric_type = value_and_metadata[1]
+
+        if metric_type in allow_strings:
+            value = raw_value
+        else:
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+
+        sample_rate = 1
+        tags = None
+        for m in value_and_metadata[2:]:
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                assert 0 <= sample_rate <= 1
+            elif m[0] == '#':
+                tags = tuple(sorted(m[1:].split(',')))
+
+        parsed_packets.append((name, value, metric_type, tags, sample_rate))
+
+    return parsed_packets
+
+
+class TestParserPerf(object):
+
+    PACKET_COUNT = 5000
+    REPEAT = 5
+
+    def generate_packets(self):
+        """ Tagged traffic, as sent by a typical web application """
+        rand = random.Random(42)
+        packets = []
+        for i in xrange(self.PACKET_COUNT):
+            tags = 'env:prod,service:web,availability-zone:us-east-1%s,endpoint:/api/v1/resource/%s,status:%s' % (
+                rand.choice('abc'), rand.randint(0, 50), rand.choice([200, 200, 200, 404, 500]))
+            kind = i % 4
+            if kind == 0:
+                packets.append('web.request.latency:%s|ms|#%s' % (rand.random() * 100, tags))
+            elif kind == 1:
+                packets.append('web.request.count:1|c|@0.5|#%s' % tags)
+            elif kind == 2:
+                packets.append('web.pool.size:%s|g|#%s' % (rand.randint(0, 1000), tags))
+            else:
+                packets.append('web.users:user%s|s|#%s' % (rand.randint(0, 10000), tags))
+        return packets
+
+    def time_parser(self, parse, packets):
+        def run():
+            for packet in packets:
+                parse(packet)
+        return len(packets) / min(repeat(run, number=1, repeat=self.REPEAT))
+
+    def test_metric_packet_parsing_perf(self):
+        aggregator = MetricsBucketAggregator('my.host')
+        packets = self.generate_packets()
+
+        # Both parsers agree, except for the tags, which are split and sorted
+        # by the aggregator now.
+        for packet in packets:
+            expected = reference_parse_metric_packet(packet)
+            parsed = [(n, v, m, t and tuple(sorted(t.split(','))), r)
+                for n, v, m, t, r in aggregator.parse_metric_packet(packet)]
+            nt.assert_equal(parsed, expected)
+
+        reference = self.time_parser(reference_parse_metric_packet, packets)
+        current = self.time_parser(aggregator.parse_metric_packet, packets)
+        print "Reference parser: %d packets/s" % reference
+        print "Current parser: %d packets/s (x%.2f)" % (current, current / reference)
+
+    def test_context_cache_perf(self):
+        packets = self.generate_packets()
+
+        def time_submit(context_cache_size):
+            def run():
+                aggregator = MetricsBucketAggregator('my.host', context_cache_size=context_cache_size)
+                for packet in packets:
+                    aggregator.submit_packets(packet)
+            return len(packets) / min(repeat(run, number=1, repeat=self.REPEAT))
+
+        uncached = time_submit(0)
+        cached = time_submit(None)
+        print "Uncached contexts: %d packets/s" % uncached
+        print "Cached contexts: %d packets/s (x%.2f)" % (cached, cached / uncached)
@@ -0,0 +1,63 @@
+"""
+Performance tests for the dogstatsd pipeline.
+
+Run with `nosetests -s` to see how many packets of a burst dogstatsd handles,
+drops in its parsing queue, or lets the kernel drop, with and without a
+parsing thread.
+"""
+import socket
+import threading
+from time import sleep, time
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server, get_udp_drops
+
+
+class TestPipelinePerf(object):
+
+    PACKET_COUNT = 200000
+    RECV_BATCH_SIZE = 64
+
+    @staticmethod
+    def get_free_port():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def run_burst(self, pipeline_queue_size):
+        """ Send a burst of packets, and return the handled, queue-dropped and kernel-dropped packets, and the time taken """
+        aggregator = MetricsBucketAggregator('my.host')
+        port = self.get_free_port()
+        server = Server(aggregator, '127.0.0.1', port, recv_batch_size=self.RECV_BATCH_SIZE,
+            pipeline_queue_size=pipeline_queue_size)
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        while not server.running:
+            sleep(0.01)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time()
+        for i in xrange(self.PACKET_COUNT):
+            client.sendto('burst.counter:1|c|#endpoint:/api/%s' % (i % 100), ('127.0.0.1', port))
+        client.close()
+
+        # Wait for the server to be done with the burst
+        handled = -1
+        while aggregator.count != handled:
+            handled = aggregator.count
+            sleep(0.5)
+        duration = time() - start - 0.5
+        kernel_dropped = get_udp_drops(port)
+
+        server.stop()
+        thread.join()
+        return handled, server.pipeline_dropped, kernel_dropped, duration
+
+    def test_pipeline_burst(self):
+        for pipeline_queue_size in (0, 64, 1024):
+            handled, dropped, kernel_dropped, duration = self.run_burst(pipeline_queue_size)
+            print "Queue size %s: %d packets/s, %d handled, %d dropped in the queue, %s dropped by the kernel" % (
+                pipeline_queue_size, handled / duration, handled, dropped, kernel_dropped)
@@ -0,0 +1,93 @@
+"""
+Performance tests for reading batches of datagrams.
+
+Run with `nosetests -s` to compare the time dogstatsd takes to read a batch of
+datagrams with recv, to reading them with recv_into into preallocated buffers.
+"""
+import errno
+import socket
+from time import time
+
+from dogstatsd import Server
+
+try:
+    memoryview
+except NameError:
+    # Python 2.6
+    memoryview = None
+
+
+class TestRecvPerf(object):
+
+    BATCH_COUNT = 3000
+    RECV_BATCH_SIZE = 64
+    BUFFER_SIZE = 8192
+
+    def setUp(self):
+        self.reader = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.reader.bind(('127.0.0.1', 0))
+        self.reader.setblocking(0)
+        self.writer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def fill(self):
+        address = self.reader.getsockname()
+        for i in xrange(self.RECV_BATCH_SIZE):
+            self.writer.sendto('burst.counter:1|c|#endpoint:/api/%s' % i, address)
+
+    def run_batches(self, recv_batch):
+        """ Return the average time recv_batch takes to read a batch, in microseconds """
+        total = 0
+        for i in xrange(self.BATCH_COUNT):
+            self.fill()
+            start = time()
+            message = recv_batch(self.reader)
+            total += time() - start
+            assert message.count('\n') == self.RECV_BATCH_SIZE - 1
+        return total / self.BATCH_COUNT * 1e6
+
+    def recv_into_slots(self, sock):
+        """ recv_into a preallocated bytearray per datagram of the batch """
+        if not hasattr(self, 'slots'):
+            self.slots = [bytearray(self.BUFFER_SIZE) for _ in xrange(self.RECV_BATCH_SIZE)]
+        recv_into = sock.recv_into
+        datagrams = []
+        try:
+            for slot in self.slots:
+                size = recv_into(slot, self.BUFFER_SIZE)
+                datagrams.append(str(slot[:size]))
+        except socket.error, e:
+            if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return '\n'.join(datagrams)
+
+    def recv_into_view(self, sock):
+        """ recv_into a single preallocated buffer for the batch, through a memoryview """
+        if not hasattr(self, 'view'):
+            self.buffer = bytearray((self.BUFFER_SIZE + 1) * self.RECV_BATCH_SIZE)
+            self.view = memoryview(self.buffer)
+        buffer, view = self.buffer, self.view
+        recv_into = sock.recv_into
+        offset = 0
+        try:
+            for i in xrange(self.RECV_BATCH_SIZE):
+                offset += recv_into(view[offset:offset + self.BUFFER_SIZE], self.BUFFER_SIZE)
+                buffer[offset] = '\n'
+                offset += 1
+        except socket.error, e:
+            if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return view[:offset - 1].tobytes()
+
+    def test_recv_batch(self):
+        server = Server(None, '127.0.0.1', 0, recv_batch_size=self.RECV_BATCH_SIZE)
+        server_recv_batch = lambda sock: server._recv_batch(sock)[0]
+        recv_batches = [('recv', server_recv_batch), ('recv_into, bytearray per datagram', self.recv_into_slots)]
+        if memoryview is not None:
+            recv_batches.append(('recv_into, memoryview', self.recv_into_view))
+        for name, recv_batch in recv_batches:
+            print "%s: %.1f us per batch of %s datagrams" % (
+                name, self.run_batches(recv_batch), self.RECV_BATCH_SIZE)
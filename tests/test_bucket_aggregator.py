@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import random
+import threading
 import time
 
 import unittest
@@ -116,7 +117,7 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         import dogstatsd
         from aggregator import api_formatter
 
-        serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
+        serialized, = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
         self.assertTrue('"tags": ["tag"]' in serialized[0], serialized)
 
     def test_counter(self):
@@ -1031,5 +1032,228 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(stats.calculate_bucket_start(13284287), 13284285)
         nt.assert_equal(stats.calculate_bucket_start(13284280), 13284280)
 
+    def test_column_store(self):
+        from aggregator import ColumnStore
+
+        store = ColumnStore(10)
+        first = store.index(('a', (), 'myhost', None))
+        second = store.index(('b', (), 'myhost', None))
+        nt.assert_equal(store.index(('a', (), 'myhost', None)), first)
+
+        values, sample_times, sampled = store.columns(0)
+        nt.assert_true(len(values) >= 2)
+        for index, sample_time in ((first, 5), (second, 12)):
+            values[index] = 1
+            sample_times[index] = sample_time
+            sampled.append(index)
+        # New contexts grow the columns of the current bucket
+        third = store.index(('c', (), 'myhost', None))
+        nt.assert_true(len(store.columns(0)[0]) > third)
+        store.columns(0)[1][third] = 18
+        store.columns(0)[2].append(third)
+
+        nt.assert_equal(store.pop(0), (values, sample_times, [first, second, third]))
+        nt.assert_equal(store.buckets, {})
+        nt.assert_equal(sorted(store.expiry_slots.items()), [(0, set([first])), (1, set([second, third]))])
+
+        # Contexts sampled in a bucket that isn't flushed yet don't expire
+        store.columns(20)[2].append(third)
+        # Contexts not sampled since the expiry time free their index
+        nt.assert_equal(store.expire(11), [('a', (), 'myhost', None)])
+        nt.assert_equal(len(store), 2)
+        nt.assert_equal(store.index(('d', (), 'myhost', None)), first)
+        nt.assert_equal(store.expire(100), [('b', (), 'myhost', None)])
+
+    def test_series_templates(self):
+        from aggregator import get_formatter
+        formatter = get_formatter({'statsd_metric_namespace': 'ns'})
+
+        def plain_formatter(*args, **kwargs):
+            return formatter(*args, **kwargs)
+
+        templated = MetricsBucketAggregator('myhost', interval=self.interval, formatter=formatter)
+        plain = MetricsBucketAggregator('myhost', interval=self.interval, formatter=plain_formatter)
+        nt.assert_true(templated.series_template is not None)
+        nt.assert_equal(plain.series_template, None)
+
+        def flush(stats):
+            return sorted(stats.flush(), key=lambda m: (m['metric'], m['tags']))
+
+        self.wait_for_bucket_boundary()
+        for stats in (templated, plain):
+            stats.submit_packets('my.counter:1|c')
+            stats.submit_packets('my.counter:2|c|#tag1,tag2')
+            stats.submit_packets('my.gauge:3|g|#tag1,host:other')
+        self.sleep_for_interval_length()
+        metrics = flush(templated)
+        nt.assert_equal(len(metrics), 3)
+        nt.assert_equal(metrics, flush(plain))
+
+        # Counters report zeros from their templates too
+        self.sleep_for_interval_length()
+        metrics = flush(templated)
+        nt.assert_equal([m['metric'] for m in metrics], ['ns.my.counter', 'ns.my.counter'])
+        nt.assert_equal(metrics, flush(plain))
+
+    def test_snapshot(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        self.wait_for_bucket_boundary()
+        stats.submit_packets('my.counter:1|c')
+        stats.submit_packets('my.histogram:1|h')
+        self.sleep_for_interval_length()
+
+        snapshot = stats.snapshot()
+        # Samples submitted after the swap go to fresh buckets
+        stats.submit_packets('my.counter:2|c')
+        stats.submit_packets('my.histogram:2|h')
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush_snapshot(snapshot))
+        nt.assert_equal(metrics['my.counter'], 1 / self.interval)
+        nt.assert_equal(metrics['my.histogram.max'], 1)
+
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['my.counter'], 2 / self.interval)
+        nt.assert_equal(metrics['my.histogram.max'], 2)
+
+    def test_snapshot_context_count(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        self.wait_for_bucket_boundary()
+        stats.submit_packets('my.counter:1|c')
+        self.sleep_for_interval_length()
+        stats.flush()
+        self.sleep_for_interval_length()
+
+        snapshot = stats.snapshot()
+        # A context being indexed by the receive thread, its columns not grown yet
+        stats.counter_store.contexts.append(('my.other.counter', (), None, None))
+        metrics = stats.flush_snapshot(snapshot)
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.counter', 0)])
+
+    def test_flush_while_submitting(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        submit_lock = threading.Lock()
+        sample_count = 20000
+
+        def submit():
+            for i in xrange(sample_count):
+                submit_lock.acquire()
+                try:
+                    stats.submit_packets('my.counter:1|c|#tag:%s' % (i % 100))
+                finally:
+                    submit_lock.release()
+
+        def flush():
+            submit_lock.acquire()
+            try:
+                snapshot = stats.snapshot()
+            finally:
+                submit_lock.release()
+            return sum(m['points'][0][1] * self.interval for m in stats.flush_snapshot(snapshot))
+
+        submitter = threading.Thread(target=submit)
+        submitter.start()
+        flushed = 0
+        while submitter.is_alive():
+            flushed += flush()
+            time.sleep(0.01)
+        submitter.join()
+        self.sleep_for_interval_length()
+        flushed += flush()
+        nt.assert_equal(flushed, sample_count)
+
+    def test_export_import_state(self):
+        import cPickle as pickle
+        from aggregator import get_formatter
+
+        formatter = get_formatter({'statsd_metric_namespace': 'ns'})
+        main = MetricsBucketAggregator('myhost', interval=self.interval, formatter=formatter)
+        workers = [MetricsBucketAggregator('myhost', interval=self.interval, formatter=formatter)
+                        for _ in range(2)]
+
+        self.wait_for_bucket_boundary()
+        for i, stats in enumerate(workers):
+            stats.submit_packets('my.counter:%s|c' % (i + 1))
+            stats.submit_packets('my.gauge:%s|g' % (i + 1))
+            stats.submit_packets('my.set:%s|s' % i)
+            stats.submit_packets('my.set:shared|s')
+            stats.submit_packets('my.histogram:%s|h' % (i * 10))
+            stats.submit_packets('_e{5,4}:title|text')
+            # Workers' states go through a pipe
+            main.import_state(pickle.loads(pickle.dumps(stats.export_state(), 2)))
+
+        nt.assert_equal(main.count, 10)
+        nt.assert_equal(len(main.flush_events()), 2)
+        for stats in workers:
+            nt.assert_equal(stats.count, 0)
+            nt.assert_equal(stats.metric_by_bucket, {})
+
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in main.flush())
+
+        nt.assert_equal(metrics['ns.my.counter'], 3)
+        nt.assert_equal(metrics['ns.my.gauge'], 2)
+        nt.assert_equal(metrics['ns.my.set'], 3)
+        nt.assert_equal(metrics['ns.my.histogram.count'], 2)
+        nt.assert_equal(metrics['ns.my.histogram.max'], 10)
+
+    def test_export_state_drops_contexts(self):
+        # Workers export all their buckets, they don't keep the contexts they've seen
+        main = MetricsBucketAggregator('myhost', interval=self.interval)
+        worker = MetricsBucketAggregator('myhost', interval=self.interval)
+        for i in range(100):
+            worker.submit_packets('my.counter.%s:1|c\nmy.gauge.%s:1|g' % (i, i))
+            main.import_state(worker.export_state())
+            for store in (worker.counter_store, worker.gauge_store):
+                nt.assert_equal(len(store), 0)
+                nt.assert_equal(store.contexts, [])
+                nt.assert_equal(store.expiry_slots, {})
+        nt.assert_equal(len(main.counter_store), 100)
+        nt.assert_equal(len(main.gauge_store), 100)
+
+    def test_import_flushed_bucket(self):
+        main = MetricsBucketAggregator('myhost', interval=self.interval)
+        worker = MetricsBucketAggregator('myhost', interval=self.interval)
+        self.wait_for_bucket_boundary()
+        main.submit_packets('my.counter:1|c\nmy.other.counter:1|c')
+        worker.submit_packets('my.counter:2|c')
+        snapshot = worker.swap()
+        self.sleep_for_interval_length()
+        metrics = main.flush()
+        flushed_timestamp = metrics[0]['points'][0][0]
+
+        # The worker's export arrives after its bucket is flushed
+        main.import_state(worker.export_state(snapshot))
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m['points'][0]) for m in main.flush())
+        nt.assert_equal(metrics['my.counter'], (flushed_timestamp + self.interval, 2))
+        nt.assert_equal(metrics['my.other.counter'], (flushed_timestamp + self.interval, 0))
+
+    def test_flush_time_limit(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        self.wait_for_bucket_boundary()
+        stats.flush_time_limit = time.time()
+        stats.submit_packets('my.counter:1|c')
+        self.sleep_for_interval_length()
+        # The bucket closed after the limit is kept
+        nt.assert_equal(stats.flush(), [])
+
+        stats.flush_time_limit = time.time()
+        metrics = stats.flush()
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.counter', 1)])
+
+    def test_large_int_gauges(self):
+        # Gauges past 2 ** 53 aren't rounded, directly or through a worker
+        value = 2 ** 60 + 1
+        main = MetricsBucketAggregator('myhost', interval=self.interval)
+        worker = MetricsBucketAggregator('myhost', interval=self.interval)
+        main.submit_packets('my.gauge:%s|g' % value)
+        worker.submit_packets('my.other.gauge:%s|g' % value)
+        main.import_state(worker.export_state())
+        self.sleep_for_interval_length()
+        metrics = main.flush()
+        nt.assert_equal(len(metrics), 2)
+        for metric in metrics:
+            nt.assert_equal(repr(metric['points'][0][1]), repr(value))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,95 @@
+# stdlib
+import unittest
+import zlib
+
+# 3rd party
+import nose.tools as nt
+
+# project
+import compression
+from compression import Compressor, get_compressor
+
+
+class TestCompression(unittest.TestCase):
+
+    PAYLOAD = '{"series": [%s]}' % ', '.join(['{"metric": "my.metric.%s", "points": [[1, %s]]}' % (i % 50, i)
+        for i in range(2000)])
+
+    def test_algorithms(self):
+        compressor = Compressor()
+        nt.assert_equal(compressor.content_encoding, 'deflate')
+        nt.assert_equal(zlib.decompress(compressor.compress(self.PAYLOAD)), self.PAYLOAD)
+
+        compressor = Compressor('gzip', level=1)
+        compressed = compressor.compress(self.PAYLOAD)
+        nt.assert_equal(compressor.content_encoding, 'gzip')
+        nt.assert_equal(compressed[:2], '\x1f\x8b')
+        nt.assert_equal(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), self.PAYLOAD)
+        nt.assert_true(len(compressed) <= compressor.bound(len(self.PAYLOAD)))
+
+        nt.assert_raises(ValueError, Compressor, 'lz4')
+
+    def test_threshold(self):
+        compressor = Compressor()
+        nt.assert_false(compressor.should_compress(1024))
+        nt.assert_true(compressor.should_compress(1025))
+        nt.assert_true(Compressor(threshold=0).should_compress(1))
+
+    def test_report(self):
+        compressor = Compressor()
+        nt.assert_equal(compressor.report(), None)
+        compressed = compressor.compress(self.PAYLOAD)
+        compressor.record(100, 50, 0.5)
+        ratio, duration, level = compressor.report()
+        nt.assert_almost_equal(ratio, (len(self.PAYLOAD) + 100.0) / (len(compressed) + 50))
+        nt.assert_true(duration >= 500, duration)
+        nt.assert_equal(level, 6)
+        nt.assert_equal(compressor.report(), None)
+
+    def test_adaptive(self):
+        compressor = Compressor(level=6, adaptive=True, max_ms_per_mb=20)
+
+        def report(ms_per_mb, ratio):
+            compressor.record(1048576, int(1048576 / ratio), ms_per_mb / 1000.0)
+            compressor.report()
+            return compressor.level
+
+        # Too slow
+        nt.assert_equal(report(30, 10), 5)
+        # Fast enough, but level 6 is known to be too slow
+        nt.assert_equal(report(5, 9), 5)
+        # Once the measures are forgotten, level 6 is tried again
+        compressor.level_stats = {}
+        nt.assert_equal(report(5, 9), 6)
+        # Not worth it
+        nt.assert_equal(report(6, 9.05), 5)
+        # Level 6 isn't tried again
+        nt.assert_equal(report(5, 9), 5)
+        nt.assert_equal(compressor.level, 5)
+
+        # Levels stay between 1 and 9
+        compressor = Compressor(level=1, adaptive=True, max_ms_per_mb=20)
+        nt.assert_equal(report(50, 5), 1)
+        compressor = Compressor(level=9, adaptive=True, max_ms_per_mb=20)
+        nt.assert_equal(report(1, 5), 9)
+
+        # The measures of other levels are forgotten now and then
+        compressor = Compressor(level=5, adaptive=True, max_ms_per_mb=20)
+        compressor.level_stats[6] = [100, 10]
+        for i in range(compression.ADAPT_RESET_PERIOD - 1):
+            nt.assert_equal(report(5, 9), 5)
+        nt.assert_equal(report(5, 9), 6)
+
+    def test_get_compressor(self):
+        compressor = get_compressor({})
+        nt.assert_equal((compressor.algorithm, compressor.level, compressor.threshold, compressor.adaptive),
+            ('deflate', 6, 1024, False))
+        compressor = get_compressor({
+            'compression_algorithm': 'gzip',
+            'compression_level': 1,
+            'compression_threshold': 0,
+            'compression_adaptive': True,
+            'compression_max_ms_per_mb': 10,
+        })
+        nt.assert_equal((compressor.algorithm, compressor.level, compressor.threshold,
+            compressor.adaptive, compressor.max_ms_per_mb), ('gzip', 1, 0, True, 10))
@@ -19,6 +19,57 @@ class TestConfig(unittest.TestCase):
         self.assertEquals(agentConfig["graphite_listen_port"], 17126)
         self.assertTrue("statsd_metric_namespace" in agentConfig)
 
+    def get_config_with(self, options):
+        """ The config of a config file with the [Main] `options` """
+        fd, path = tempfile.mkstemp(suffix='.conf')
+        try:
+            f = os.fdopen(fd, 'w')
+            f.write("[Main]\ndd_url: https://app.datadoghq.com\napi_key: 1234\n")
+            for option, value in options:
+                f.write("%s: %s\n" % (option, value))
+            f.close()
+            return get_config(cfg_path=path)
+        finally:
+            os.remove(path)
+
+    def testBadCompressionConfig(self):
+        from compression import get_compressor
+        agentConfig = self.get_config_with([
+            ('compression_algorithm', 'lz4'),
+            ('compression_level', '12'),
+            ('compression_max_ms_per_mb', '-1'),
+        ])
+        for option in ('compression_algorithm', 'compression_level', 'compression_max_ms_per_mb'):
+            self.assertFalse(option in agentConfig, option)
+        compressor = get_compressor(agentConfig)
+        self.assertEquals((compressor.algorithm, compressor.level), ('deflate', 6))
+        compressor.compress('payload')
+
+    def testBadHistogramSketchConfig(self):
+        agentConfig = self.get_config_with([('histogram_backend', 'tdigest'),
+            ('histogram_relative_accuracy', '2')])
+        self.assertFalse('histogram_backend' in agentConfig)
+        self.assertFalse('histogram_relative_accuracy' in agentConfig)
+
+    def testBadHistogramMaxSamplesConfig(self):
+        for value in ('0', '-5', 'many'):
+            agentConfig = self.get_config_with([('histogram_max_samples', value)])
+            self.assertFalse('histogram_max_samples' in agentConfig, value)
+        agentConfig = self.get_config_with([('histogram_max_samples', '500')])
+        self.assertEquals(agentConfig['histogram_max_samples'], 500)
+
+    def testBadContextOverflowConfig(self):
+        agentConfig = self.get_config_with([('dogstatsd_max_new_contexts', '10'),
+            ('dogstatsd_context_overflow', 'foo')])
+        self.assertFalse('dogstatsd_context_overflow' in agentConfig)
+
+    def testBadSetConfig(self):
+        agentConfig = self.get_config_with([('set_backend', 'bloom'), ('set_precision', '30')])
+        self.assertFalse('set_backend' in agentConfig)
+        self.assertFalse('set_precision' in agentConfig)
+        agentConfig = self.get_config_with([('set_backend', 'hyperloglog'), ('set_precision', '10')])
+        self.assertEquals((agentConfig['set_backend'], agentConfig['set_precision']), ('hyperloglog', 10))
+
     def testGoodPidFie(self):
         """Verify that the pid file succeeds and fails appropriately"""
 
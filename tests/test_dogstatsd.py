@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import random
+import socket
+import threading
 import time
 
 import unittest
 import nose.tools as nt
 
-from aggregator import MetricsAggregator, get_formatter, DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator import MetricsAggregator, MetricsBucketAggregator, get_formatter, DEFAULT_HISTOGRAM_AGGREGATES
 
 class TestUnitDogStatsd(unittest.TestCase):
 
@@ -158,13 +160,195 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(fourth['points'][0][1], 16)
         nt.assert_equal(fourth['device_name'], 'floppy')
 
+    def test_context_cache(self):
+        stats = MetricsAggregator('myhost', context_cache_size=2)
+        for i in xrange(3):
+            stats.submit_packets('my.counter:1|c|#tag2,tag1,host:test-a')
+            stats.submit_packets('my.counter:1|c|#tag1,tag2,host:test-a')
+            stats.submit_packets('my.counter:1|c|#tag3')
+            stats.submit_packets('my.counter:1|c')
+
+        # The cache holds at most two generations of contexts
+        nt.assert_true(len(stats.context_cache) <= 4)
+
+        metrics = dict((m['tags'], m) for m in stats.flush())
+        nt.assert_equal(len(metrics), 3)
+        nt.assert_equal(metrics[None]['points'][0][1], 3)
+        nt.assert_equal(metrics[('tag1', 'tag2')]['host'], 'test-a')
+        nt.assert_equal(metrics[('tag1', 'tag2')]['points'][0][1], 6)
+        nt.assert_equal(metrics[('tag3', )]['host'], 'myhost')
+        nt.assert_equal(metrics[('tag3', )]['points'][0][1], 3)
+
+    def test_context_cache_lru(self):
+        from aggregator import ContextCache
+        cache = ContextCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        # 'a' is read from the previous generation and promoted
+        nt.assert_equal(cache.get('a'), 1)
+        cache.set('d', 4)
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.get('b'), None)
+        nt.assert_equal(cache.get('d'), 4)
+
+        disabled = ContextCache(0)
+        disabled.set('a', 1)
+        nt.assert_equal(disabled.get('a'), None)
+
+    def test_context_limits_fold(self):
+        stats = MetricsAggregator('myhost', max_new_contexts_per_name=2)
+        for i in range(5):
+            stats.submit_packets('my.counter:1|c|#user:%s' % i)
+        stats.submit_packets('my.counter:1|c|#user:0')
+        stats.submit_packets('other.counter:1|c|#user:0')
+        stats.send_context_limit_stats()
+
+        metrics = dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1])
+            for m in stats.flush())
+        nt.assert_equal(metrics[('my.counter', ('user:0', ))], 2)
+        nt.assert_equal(metrics[('my.counter', ('user:1', ))], 1)
+        nt.assert_equal(metrics[('my.counter', ('context_overflow:true', ))], 3)
+        nt.assert_equal(metrics[('other.counter', ('user:0', ))], 1)
+        nt.assert_equal(metrics[('datadog.dogstatsd.context.limited', ())], 3)
+        nt.assert_equal(metrics[('datadog.dogstatsd.context.limited_by_name',
+            ('metric_name:my.counter', ))], 3)
+        nt.assert_equal(stats.context_limit_offenders, [('my.counter', 3)])
+
+    def test_context_limits_drop(self):
+        stats = MetricsAggregator('myhost', max_new_contexts=3, max_new_contexts_per_name=2,
+            context_overflow='drop')
+        for i in range(3):
+            stats.submit_packets('my.counter:1|c|#user:%s' % i)
+            stats.submit_packets('other.counter:1|c|#user:%s' % i)
+
+        metrics = sorted((m['metric'], m['tags']) for m in stats.flush())
+        nt.assert_equal(metrics, [
+            ('my.counter', ('user:0', )),
+            ('my.counter', ('user:1', )),
+            ('other.counter', ('user:0', )),
+        ])
+        nt.assert_equal(stats.context_limiter.flush(), (3, [('other.counter', 2), ('my.counter', 1)]))
+
+    def test_context_limits_shared(self):
+        from aggregator import ContextLimiter
+        limiter = ContextLimiter(max_new_contexts=10, max_new_contexts_per_name=3, overflow='drop')
+        limiter.share(4)
+        nt.assert_equal((limiter.max_new_contexts, limiter.max_new_contexts_per_name), (2, 1))
+        nt.assert_equal(limiter.admit(('a', ('user:0', ), 'myhost', None)), ('a', ('user:0', ), 'myhost', None))
+        nt.assert_equal(limiter.admit(('a', ('user:1', ), 'myhost', None)), None)
+
+    def test_space_saving(self):
+        from aggregator import SpaceSaving
+        top = SpaceSaving(2)
+        for key in 'aaaabbbc':
+            top.add(key)
+        # 'c' evicts 'b', the least frequent key, and inherits its count
+        nt.assert_equal(top.top(), [('a', 4), ('c', 4)])
+        top.add('a', 2)
+        nt.assert_equal(top.top()[0], ('a', 6))
+
     def test_tags_gh442(self):
         import dogstatsd
         from aggregator import api_formatter
 
-        serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
+        serialized, = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialize_metrics_chunks(self):
+        import zlib
+        import simplejson as json
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter('my.metric.%s' % i, i, 1, ('tag:%s' % random.random(), ), 'host')
+            for i in range(5000)]
+        payloads = list(dogstatsd.serialize_metrics(metrics, max_payload_size=50000,
+            max_uncompressed_size=200000))
+        nt.assert_true(len(payloads) > 3, len(payloads))
+
+        series = []
+        for body, headers in payloads:
+            nt.assert_equal(headers['Content-Encoding'], 'deflate')
+            nt.assert_true(len(body) <= 50000, len(body))
+            decompressed = zlib.decompress(body)
+            nt.assert_true(len(decompressed) <= 200000, len(decompressed))
+            series.extend(json.loads(decompressed)['series'])
+        nt.assert_equal(series, json.loads(json.dumps(metrics)))
+
+        # Payloads can be gzipped, the compressor measures them
+        from compression import Compressor
+        compressor = Compressor('gzip', level=1)
+        payloads = list(dogstatsd.serialize_metrics(metrics, max_payload_size=50000,
+            max_uncompressed_size=200000, compressor=compressor))
+        series = []
+        for body, headers in payloads:
+            nt.assert_equal(headers['Content-Encoding'], 'gzip')
+            nt.assert_true(len(body) <= 50000, len(body))
+            series.extend(json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))['series'])
+        nt.assert_equal(series, json.loads(json.dumps(metrics)))
+        ratio, duration, level = compressor.report()
+        nt.assert_almost_equal(ratio, len(json.dumps({'series': metrics})) / float(sum(len(body) for body, _ in payloads)), 1)
+        nt.assert_equal(level, 1)
+
+        # Small payloads aren't compressed
+        payloads = list(dogstatsd.serialize_metrics(metrics[:2]))
+        nt.assert_equal(len(payloads), 1)
+        body, headers = payloads[0]
+        nt.assert_false('Content-Encoding' in headers)
+        nt.assert_equal(json.loads(body), {'series': json.loads(json.dumps(metrics[:2]))})
+
+    def test_columnar_series(self):
+        import zlib
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [
+            api_formatter('my.gauge', 1.5, 1400000000, ('env:prod', 'role:db'), 'myhost', None, 'gauge', 10),
+            api_formatter('my.gauge', 2, 1400000010, ('env:prod', u'caf\xe9:1'), 'myhost', 'sda1', 'gauge', 10),
+            api_formatter('my.rate', -3.25, 1400000000, None, None, None, 'rate', None),
+            api_formatter('my.count', 0, 1400000000, (), 'other', None, 'count', 10),
+        ]
+        metrics[0]['points'].append((1400000010, 2.5))
+        payload = dogstatsd.encode_columnar_series(metrics)
+        nt.assert_equal(dogstatsd.decode_columnar_series(payload), metrics)
+        # Strings are stored once
+        nt.assert_equal(payload.count('env:prod'), 1)
+        nt.assert_equal(payload.count('my.gauge'), 1)
+
+        # Strings can hold any character, and integers too large for doubles stay exact
+        metrics = [
+            api_formatter('my.gauge', 2 ** 60 + 1, 1400000000, ('a\0b', ), 'myhost', None, 'gauge', 10),
+            api_formatter('my.gauge', -2 ** 53 - 1, 1400000000, ('a', ), 'myhost', None, 'gauge', 10),
+            api_formatter('my.gauge', 2 ** 53 + 1.0, 1400000000, ('b', ), 'myhost', None, 'gauge', 10),
+            api_formatter('my.gauge', 2 ** 64, 1400000000, ('c', ), 'myhost', None, 'gauge', 10),
+        ]
+        decoded = dogstatsd.decode_columnar_series(dogstatsd.encode_columnar_series(metrics))
+        nt.assert_equal([m['tags'] for m in decoded], [('a\0b', ), ('a', ), ('b', ), ('c', )])
+        values = [m['points'][0][1] for m in decoded]
+        nt.assert_equal(values[:3], [2 ** 60 + 1, -2 ** 53 - 1, 2 ** 53])
+        # Out of the int64 range, values are only as exact as a double
+        nt.assert_equal(values[3], float(2 ** 64))
+
+        nt.assert_equal(dogstatsd.decode_columnar_series(dogstatsd.encode_columnar_series([])), [])
+        nt.assert_raises(ValueError, dogstatsd.decode_columnar_series, '{"series": []}')
+
+        # Payloads are split to stay under the caps
+        metrics = [api_formatter('my.metric.%s' % i, i, 1, ('tag:%s' % random.random(), ), 'host')
+            for i in range(5000)]
+        payloads = list(dogstatsd.serialize_metrics_columnar(metrics, max_payload_size=50000,
+            max_uncompressed_size=200000))
+        nt.assert_true(len(payloads) > 3, len(payloads))
+        series = []
+        for body, headers in payloads:
+            nt.assert_equal(headers, {'Content-Type': dogstatsd.COLUMNAR_CONTENT_TYPE,
+                'Content-Encoding': 'deflate'})
+            nt.assert_true(len(body) <= 50000, len(body))
+            decompressed = zlib.decompress(body)
+            nt.assert_true(len(decompressed) <= 200000, len(decompressed))
+            series.extend(dogstatsd.decode_columnar_series(decompressed))
+        nt.assert_equal(series, metrics)
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -284,6 +468,49 @@ class TestUnitDogStatsd(unittest.TestCase):
         # Assert there are no more sets
         assert not stats.flush()
 
+    def test_hyperloglog_sets(self):
+        from aggregator import HyperLogLogSet
+        stats = MetricsAggregator('myhost', set_backend='hyperloglog', set_precision=10)
+        nt.assert_equal(stats.metric_type_to_class['s'], HyperLogLogSet)
+
+        # Small sets are exact
+        for value in ('string', 'sets', 'sets', 'test'):
+            stats.submit_packets('my.set:%s|s' % value)
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 3)
+        assert not stats.flush()
+
+        for i in xrange(20000):
+            stats.submit_packets('my.set:user%s|s' % (i % 10000))
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        # 1.04 / sqrt(1024) = 3.25% typical error
+        nt.assert_true(abs(metrics[0]['points'][0][1] - 10000) < 1000, metrics[0]['points'][0][1])
+
+    def test_bit_length(self):
+        from aggregator import bit_length
+        for n in [0, 1, 2, 3, 2 ** 32 - 1, 2 ** 32, 2 ** 53 + 1, 2 ** 60 - 1, 2 ** 64 - 1]:
+            nt.assert_equal(bit_length(n), len(bin(n)) - 2 if n else 0, n)
+
+    def test_hyperloglog_sets_merge(self):
+        from aggregator import HyperLogLogSet
+        sets = [HyperLogLogSet(None, 'my.set', None, 'myhost', None) for _ in range(3)]
+        for i in xrange(30000):
+            sets[i % 2].sample('user%s' % (i % 20000), 1)
+        for i in xrange(100):
+            sets[2].sample('user%s' % i, 1)
+        nt.assert_equal(sets[2].registers, None)
+        nt.assert_equal(len(sets[0].registers), 4096)
+
+        # Dense into sparse, sparse into dense
+        sets[2].merge(sets[0])
+        sets[2].merge(sets[1])
+        nt.assert_true(abs(sets[2].cardinality() - 20000) < 1000, sets[2].cardinality())
+
+        other = HyperLogLogSet(None, 'my.set', None, 'myhost', None, {'precision': 8})
+        nt.assert_raises(ValueError, sets[0].merge, other)
+
     def test_rate(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.rate:10|_dd-r')
@@ -500,6 +727,12 @@ class TestUnitDogStatsd(unittest.TestCase):
             else:
                 assert False, 'invalid : %s' % packet
 
+    def test_bad_packet_in_batch(self):
+        # Batched datagrams are joined with newlines, a bad one mustn't drop the next ones
+        stats = MetricsAggregator('myhost')
+        nt.assert_raises(Exception, stats.submit_packets, 'a:1|c\nbad packet\nb:1|c\n_e{1,}:bad\nc:1|c')
+        nt.assert_equal(sorted(m['metric'] for m in stats.flush()), ['a', 'b', 'c'])
+
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
         ag_interval = 1
@@ -820,5 +1053,685 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equals(third['metric'], 'line_ending.windows')
         nt.assert_equals(third['points'][0][1], 300)
 
+
+class TestDogstatsdServer(unittest.TestCase):
+
+    def setUp(self):
+        # TestCase.addCleanup is only there from Python 2.7
+        self.cleanups = []
+
+    def tearDown(self):
+        while self.cleanups:
+            function, args = self.cleanups.pop()
+            function(*args)
+
+    def add_cleanup(self, function, *args):
+        self.cleanups.append((function, args))
+
+    @staticmethod
+    def get_free_port():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def start_server(self, server):
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        for _ in xrange(100):
+            if server.running:
+                break
+            time.sleep(0.01)
+        self.add_cleanup(thread.join, 10)
+        self.add_cleanup(server.stop)
+        return thread
+
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        start = time.time()
+        while not condition() and time.time() - start < timeout:
+            time.sleep(0.01)
+
+    def test_recv_batch(self):
+        from dogstatsd import Server
+
+        stats = MetricsAggregator('myhost')
+        port = self.get_free_port()
+        server = Server(stats, '127.0.0.1', port, recv_batch_size=16)
+        self.start_server(server)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(50):
+            client.sendto('batch.counter:1|c', ('127.0.0.1', port))
+        client.sendto('batch.gauge:3|g', ('127.0.0.1', port))
+        client.close()
+
+        self.wait_for(lambda: stats.count == 51)
+        nt.assert_equal(stats.count, 51)
+
+        metrics = TestUnitDogStatsd.sort_metrics(stats.flush())
+        nt.assert_equal(len(metrics), 2)
+        nt.assert_equal(metrics[0]['metric'], 'batch.counter')
+        nt.assert_equal(metrics[0]['points'][0][1], 50)
+        nt.assert_equal(metrics[1]['metric'], 'batch.gauge')
+        nt.assert_equal(metrics[1]['points'][0][1], 3)
+
+    def test_recv_batch_datagrams(self):
+        from dogstatsd import Server
+
+        server = Server(MetricsAggregator('myhost'), '127.0.0.1', 0, recv_batch_size=3)
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        self.add_cleanup(receiver.close)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.add_cleanup(client.close)
+        datagrams = ['a:1|c', 'b:2|g\nc:3|ms', 'd:4|h', 'e:5|c']
+        for datagram in datagrams:
+            client.sendto(datagram, receiver.getsockname())
+        time.sleep(0.1)
+        receiver.setblocking(0)
+
+        message, messages = server._recv_batch(receiver, keep_datagrams=True)
+        nt.assert_equal(message, '\n'.join(datagrams[:3]))
+        nt.assert_equal(messages, datagrams[:3])
+
+        message, messages = server._recv_batch(receiver)
+        nt.assert_equal(message, 'e:5|c')
+        nt.assert_equal(messages, None)
+        nt.assert_raises(socket.error, server._recv_batch, receiver)
+
+    def test_pipeline(self):
+        from dogstatsd import Server
+
+        stats = MetricsAggregator('myhost')
+        port = self.get_free_port()
+        server = Server(stats, '127.0.0.1', port, recv_batch_size=16, pipeline_queue_size=64)
+        self.start_server(server)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(50):
+            client.sendto('pipeline.counter:1|c', ('127.0.0.1', port))
+        client.close()
+
+        self.wait_for(lambda: stats.count == 50)
+        nt.assert_equal(stats.count, 50)
+
+        server.pipeline_dropped = 3
+        server.send_stats()
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['pipeline.counter']['points'][0][1], 50)
+        nt.assert_equal(metrics['datadog.dogstatsd.pipeline.queue_depth']['points'][0][1], 0)
+        nt.assert_equal(metrics['datadog.dogstatsd.pipeline.dropped']['points'][0][1], 3)
+        nt.assert_equal(server.pipeline_dropped, 3)
+
+        # Only the packets dropped since the last report are reported
+        server.pipeline_dropped = 5
+        server.send_stats()
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['datadog.dogstatsd.pipeline.dropped']['points'][0][1], 2)
+
+    def test_pipeline_drops(self):
+        from dogstatsd import Server
+
+        stats = MetricsAggregator('myhost')
+        server = Server(stats, '127.0.0.1', self.get_free_port(), pipeline_queue_size=1)
+        submit = server._start_pipeline()
+        # The parsing thread takes the first batch, and waits for the lock
+        server.submit_lock.acquire()
+        try:
+            submit('a:1|c')
+            self.wait_for(lambda: server.pipeline_queue.qsize() == 0)
+            submit('b:1|c')
+            # The packets of the batches that don't fit in the queue are dropped and counted
+            submit('c:1|c\nd:1|c\ne:1|c')
+            submit('f:1|c')
+        finally:
+            server.submit_lock.release()
+        server.pipeline_queue.put(None)
+        server.pipeline_thread.join()
+        nt.assert_equal(server.pipeline_dropped, 4)
+        nt.assert_equal(stats.count, 2)
+
+    def test_tcp_listener(self):
+        from dogstatsd import Server, TCPListener
+
+        stats = MetricsAggregator('myhost')
+        port = self.get_free_port()
+        server = Server(stats, '127.0.0.1', port)
+        server.tcp_listener_factory = lambda submit: TCPListener(submit, '127.0.0.1', port)
+        nt.assert_equal(server.tcp_listener, None)
+        self.start_server(server)
+
+        client = socket.create_connection(('127.0.0.1', port))
+        client.sendall('tcp.counter:1|c\ntcp.coun')
+        time.sleep(0.1)
+        # A bad line doesn't drop the next ones
+        client.sendall('ter:2|c\nbad line\ntcp.gauge:5|g')
+        client.close()
+
+        self.wait_for(lambda: stats.count == 4)
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['tcp.counter']['points'][0][1], 3)
+        nt.assert_equal(metrics['tcp.gauge']['points'][0][1], 5)
+
+    def test_tcp_listener_length_framing(self):
+        import struct
+        from dogstatsd import TCPListener
+
+        stats = MetricsAggregator('myhost')
+        port = self.get_free_port()
+        listener = TCPListener(stats.submit_packets, '127.0.0.1', port, framing='length',
+            max_connections=1)
+        listener.start()
+        self.add_cleanup(listener.join, 10)
+        self.add_cleanup(listener.stop)
+
+        client = socket.create_connection(('127.0.0.1', port))
+        batch = 'tcp.counter:1|c\ntcp.counter:2|c'
+        client.sendall(struct.pack('!L', len(batch)) + batch)
+        self.wait_for(lambda: stats.count == 2)
+
+        # Over the connection cap, connections are closed right away
+        refused = socket.create_connection(('127.0.0.1', port))
+        refused.settimeout(5)
+        nt.assert_equal(refused.recv(1), '')
+        refused.close()
+
+        client.sendall(struct.pack('!L', 14) + 'tcp.gauge:5|g\n')
+        client.close()
+
+        self.wait_for(lambda: stats.count == 3)
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        nt.assert_equal(metrics['tcp.counter']['points'][0][1], 3)
+        nt.assert_equal(metrics['tcp.gauge']['points'][0][1], 5)
+
+    def test_worker_pool(self):
+        from dogstatsd import Server, WorkerPool
+
+        stats = MetricsBucketAggregator('myhost')
+        port = self.get_free_port()
+        pool = WorkerPool(stats, 2, lambda: MetricsBucketAggregator('myhost'),
+            lambda aggregator, index: Server(aggregator, '127.0.0.1', port, reuse_port=True), port)
+        self.start_server(pool)
+        # Give the workers some time to bind
+        self.wait_for(lambda: all(w.is_alive() for w in pool.workers))
+        time.sleep(0.5)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(100):
+            client.sendto('pool.counter:1|c', ('127.0.0.1', port))
+        client.close()
+
+        self.wait_for(lambda: stats.count == 100)
+        nt.assert_equal(stats.count, 100)
+
+    def test_worker_pool_flush_time_limit(self):
+        from dogstatsd import WorkerPool
+
+        stats = MetricsBucketAggregator('myhost')
+        pool = WorkerPool(stats, 2, None, None, self.get_free_port())
+        pool.export_times = {0: 100.0, 1: 100.0}
+        # Buckets are flushed up to the oldest export of the workers
+        for worker, export_time, limit in ((0, 120.0, 100.0), (1, 110.0, 110.0), (1, 130.0, 120.0)):
+            state = MetricsBucketAggregator('myhost').export_state()
+            state['worker'] = worker
+            state['export_time'] = export_time
+            pool.import_state(state)
+            nt.assert_equal(stats.flush_time_limit, limit)
+
+    def test_worker_pool_exit(self):
+        from dogstatsd import WorkerPool
+
+        def server_factory(aggregator, index):
+            # The worker exits as it starts
+            raise SystemExit(1)
+
+        stats = MetricsBucketAggregator('myhost')
+        port = self.get_free_port()
+        pool = WorkerPool(stats, 2, lambda: MetricsBucketAggregator('myhost'), server_factory, port)
+        thread = self.start_server(pool)
+        # A worker exiting stops the pool rather than being forked again
+        thread.join(10)
+        nt.assert_false(thread.is_alive())
+        nt.assert_false(pool.running)
+        nt.assert_equal(len(pool.workers), 2)
+        nt.assert_false(any(w.is_alive() for w in pool.workers))
+
+    def test_workers_spawned_first(self):
+        import signal
+        from dogstatsd import Dogstatsd, WorkerPool
+        calls = []
+
+        class Pool(WorkerPool):
+            def spawn_workers(self):
+                calls.append('spawn_workers')
+
+            def start(self):
+                calls.append('start')
+
+        class Reporter(object):
+            def start(self):
+                calls.append('reporter')
+
+            def stop(self):
+                pass
+
+            def join(self):
+                pass
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.add_cleanup(signal.signal, signum, signal.getsignal(signum))
+        Dogstatsd('/tmp/dogstatsd-test.pid', Pool(None, 2, None, None, 8125), Reporter(), False).run()
+        # The workers are forked before any thread is started
+        nt.assert_equal(calls, ['spawn_workers', 'reporter', 'start'])
+
+    def test_unix_socket(self):
+        import os
+        import shutil
+        import tempfile
+        from dogstatsd import Server
+
+        tmp_dir = tempfile.mkdtemp()
+        self.add_cleanup(shutil.rmtree, tmp_dir)
+        socket_path = os.path.join(tmp_dir, 'dsd.socket')
+
+        stats = MetricsAggregator('myhost')
+        port = self.get_free_port()
+        server = Server(stats, '127.0.0.1', port, socket_path=socket_path)
+        thread = self.start_server(server)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('unix.counter:1|c|#tag', socket_path)
+        client.sendto('unix.counter:2|c|#tag', socket_path)
+        client.close()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto('unix.counter:4|c|#tag', ('127.0.0.1', port))
+        client.close()
+
+        self.wait_for(lambda: stats.count == 3)
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 7)
+
+        # The socket file is removed on exit
+        server.stop()
+        thread.join(10)
+        nt.assert_false(os.path.exists(socket_path))
+
+    def test_udp_drops(self):
+        import os
+        import tempfile
+        from dogstatsd import get_udp_drops
+
+        proc_net_udp = tempfile.NamedTemporaryFile(delete=False)
+        self.add_cleanup(os.remove, proc_net_udp.name)
+        proc_net_udp.write(
+            "   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+            "  127: 0100007F:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   106        0 11523 2 ffff88003689c000 42\n"
+            "  127: 00000000:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   106        0 11524 2 ffff88003689c400 8\n"
+            "  160: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 10254 2 ffff88003689c800 1000\n"
+        )
+        proc_net_udp.close()
+
+        nt.assert_equal(get_udp_drops(8125, [proc_net_udp.name, '/does/not/exist']), 50)
+        nt.assert_equal(get_udp_drops(8126, [proc_net_udp.name]), None)
+        nt.assert_equal(get_udp_drops(8125, ['/does/not/exist']), None)
+
+
+class TestStatsdForwarder(unittest.TestCase):
+
+    class FakeSocket(object):
+        def __init__(self):
+            self.sent = []
+
+        def send(self, data):
+            self.sent.append(data)
+
+    def test_raw(self):
+        from dogstatsd import StatsdForwarder
+        sock = self.FakeSocket()
+        forwarder = StatsdForwarder(sock)
+        forwarder.forward(['a:1|c', 'b:2|g'])
+        nt.assert_equal(sock.sent, ['a:1|c', 'b:2|g'])
+
+    def test_coalesce(self):
+        from dogstatsd import StatsdForwarder
+        sock = self.FakeSocket()
+        forwarder = StatsdForwarder(sock, 'coalesce', mtu=16)
+        forwarder.forward(['a:1|c', 'b:2|g', 'c:3|ms'])
+        # The first two packets fill a datagram
+        nt.assert_equal(sock.sent, ['a:1|c\nb:2|g'])
+        nt.assert_true(forwarder.timeout(time.time()) <= 0.1)
+
+        forwarder.flush(force=True)
+        nt.assert_equal(sock.sent, ['a:1|c\nb:2|g', 'c:3|ms'])
+        nt.assert_equal(forwarder.timeout(time.time()), None)
+
+    def test_aggregate(self):
+        from dogstatsd import StatsdForwarder
+        sock = self.FakeSocket()
+        forwarder = StatsdForwarder(sock, 'aggregate')
+        forwarder.forward([
+            'a:1|c\na:2|c|#tag\na:1|c|@0.5|#tag',
+            'g:1|g\ng:5|g',
+            'h:3|h\na:1|c:2|c\n_e{1,1}:a|b',
+        ])
+        forwarder.flush(force=True)
+
+        nt.assert_equal(len(sock.sent), 1)
+        nt.assert_equal(sorted(sock.sent[0].split('\n')), [
+            '_e{1,1}:a|b', 'a:1|c', 'a:1|c:2|c', 'a:4|c|#tag', 'g:5|g', 'h:3|h'
+        ])
+
+        forwarder.flush(force=True)
+        nt.assert_equal(len(sock.sent), 1)
+
+    def test_invalid_mode(self):
+        from dogstatsd import StatsdForwarder
+        nt.assert_raises(ValueError, StatsdForwarder, self.FakeSocket(), 'compress')
+
+
+class TestRetryQueue(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spill_dir)
+
+    def drain(self, queue):
+        payloads = []
+        while True:
+            payload = queue.pop()
+            if payload is None:
+                return payloads
+            payloads.append(payload[1])
+
+    def test_drop_oldest(self):
+        from dogstatsd import RetryQueue
+        queue = RetryQueue(max_size=10)
+        for data in ['aaaa', 'bbbb', 'cccc']:
+            queue.add('http://url', data, {})
+        nt.assert_equal(queue.dropped, 1)
+        nt.assert_equal(queue.size, 8)
+        nt.assert_equal(self.drain(queue), ['bbbb', 'cccc'])
+
+    def test_spill(self):
+        import os
+        import dogstatsd
+        from dogstatsd import RetryQueue
+        old_segment_size, dogstatsd.SPILL_SEGMENT_SIZE = dogstatsd.SPILL_SEGMENT_SIZE, 50
+        try:
+            queue = RetryQueue(max_size=10, spill_dir=self.spill_dir)
+            payloads = ['payload %s' % i for i in range(10)]
+            for data in payloads:
+                queue.add('http://url', data, {'Content-Type': 'application/json'})
+            nt.assert_equal(queue.dropped, 0)
+            nt.assert_equal(queue.size, 9)
+            nt.assert_true(len(os.listdir(self.spill_dir)) > 1)
+
+            # Spilled payloads come back in order
+            url, data, headers = queue.pop()
+            nt.assert_equal((url, data, headers), ('http://url', 'payload 0', {'Content-Type': 'application/json'}))
+            queue.push_back((url, data, headers))
+            nt.assert_equal(self.drain(queue), payloads)
+            nt.assert_equal(os.listdir(self.spill_dir), [])
+            nt.assert_equal(queue.spill_size, 0)
+
+            # Segments left by a previous run are retried, truncated records are
+            # skipped. The payloads in memory are lost.
+            for data in payloads:
+                queue.add('http://url', data, {})
+            queue.close()
+            last_segment = os.path.join(self.spill_dir, sorted(os.listdir(self.spill_dir))[-1])
+            with open(last_segment, 'ab') as f:
+                f.write('\x00\x00\x00\x02\x00\x00\x00\x10[]')
+            # Files that aren't segments are ignored
+            open(os.path.join(self.spill_dir, 'backup.seg'), 'wb').close()
+            nt.assert_equal(self.drain(RetryQueue(max_size=10, spill_dir=self.spill_dir)), payloads[1:])
+            os.remove(os.path.join(self.spill_dir, 'backup.seg'))
+
+            # The oldest segments are dropped when the spill is full
+            queue = RetryQueue(max_size=10, spill_dir=self.spill_dir, max_spill_size=100)
+            for data in payloads:
+                queue.add('http://url', data, {})
+            nt.assert_true(queue.spill_size <= 100, queue.spill_size)
+            nt.assert_true(queue.dropped > 0)
+            # The first payload was kept in memory
+            nt.assert_equal(self.drain(queue), payloads[:1] + payloads[1 + queue.dropped:])
+        finally:
+            dogstatsd.SPILL_SEGMENT_SIZE = old_segment_size
+
+    def test_spill_api_key(self):
+        import os
+        from dogstatsd import RetryQueue
+        queue = RetryQueue(max_size=1, spill_dir=self.spill_dir, api_key='newkey')
+        queue.add('http://url/api/v1/series?api_key=secret', 'a', {})
+        queue.add('http://url/api/v1/series?api_key=secret', 'b', {})
+        queue.close()
+        for name in os.listdir(self.spill_dir):
+            with open(os.path.join(self.spill_dir, name), 'rb') as f:
+                nt.assert_false('secret' in f.read())
+        # The spilled payload is sent with the key of the queue
+        nt.assert_equal([queue.pop()[0] for _ in range(2)], ['http://url/api/v1/series?api_key=secret',
+            'http://url/api/v1/series?api_key=newkey'])
+
+    def test_retry_backoff(self):
+        from dogstatsd import POST_DROPPED, POST_OK, POST_RETRY, RetryQueue
+        queue = RetryQueue(max_delay=60)
+        for data in ['a', 'b', 'c']:
+            queue.add('http://url', data, {})
+
+        posted = []
+        def post(url, data, headers):
+            posted.append(data)
+            return POST_RETRY if data == 'b' else POST_OK
+
+        nt.assert_equal(queue.retry(post, now=1000), 1)
+        nt.assert_equal(posted, ['a', 'b'])
+        nt.assert_equal(queue.next_retry, 1010)
+        nt.assert_equal(queue.retry(post, now=1005), 0)
+        nt.assert_equal(queue.retry(post, now=1010), 0)
+        nt.assert_equal(queue.next_retry, 1030)
+        for now in (1030, 1070):
+            queue.retry(post, now=now)
+        # Capped to max_delay
+        nt.assert_equal(queue.next_retry, 1130)
+
+        # Dropped payloads don't reset the backoff
+        queue.next_retry = 0
+        nt.assert_equal(queue.retry(lambda *payload: POST_DROPPED, now=1080), 2)
+        nt.assert_equal(len(queue), 0)
+        nt.assert_equal(queue.failures, 4)
+
+
+class TestReporter(unittest.TestCase):
+
+    def setUp(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        posts = self.posts = []
+        # Status codes of the next responses, 202 once empty
+        statuses = self.statuses = []
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep the connections alive
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                posts.append(self.path.split('?')[0])
+                self.send_response(statuses.pop(0) if statuses else 202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        from SocketServer import ThreadingMixIn
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        from dogstatsd import Reporter
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        reporter = Reporter(1, aggregator, 'http://127.0.0.1:%s' % self.server.server_port, 'key')
+
+        for i in range(2):
+            # In a past bucket, to be flushed right away
+            aggregator.submit_metric('my.counter', 1, 'c', timestamp=time.time() - 5 + i)
+            aggregator.submit_packets('_e{3,4}:foo|text')
+            aggregator.submit_packets('_sc|my.check|0')
+            reporter.flush()
+        nt.assert_equal(sorted(self.posts), ['/api/v1/check_run'] * 2 + ['/api/v1/series'] * 2
+            + ['/intake'] * 2)
+
+        # Requests were sent concurrently, over at most HTTP_POOL_SIZE connections
+        stats = {}
+        for name, value, tags in reporter.http_stats:
+            stats.setdefault((name, tags), []).append(value)
+        connections = len(stats.pop(('datadog.dogstatsd.http.connect_time', None)))
+        nt.assert_true(1 <= connections <= 3, connections)
+        nt.assert_equal(sorted(stats), [
+            ('datadog.dogstatsd.http.request_time', ('endpoint:/api/v1/check_run', )),
+            ('datadog.dogstatsd.http.request_time', ('endpoint:/api/v1/series', )),
+            ('datadog.dogstatsd.http.request_time', ('endpoint:/intake', )),
+        ])
+
+        reporter.metrics_aggregator = MetricsAggregator('myhost')
+        reporter.send_http_stats()
+        nt.assert_equal(reporter.http_stats, [])
+        metrics = reporter.metrics_aggregator.flush()
+        nt.assert_true('datadog.dogstatsd.http.request_time.count' in set(m['metric'] for m in metrics))
+
+    def test_retry(self):
+        from dogstatsd import Reporter, RetryQueue
+        reporter = Reporter(1, MetricsBucketAggregator('myhost', interval=1),
+            'http://127.0.0.1:%s' % self.server.server_port, 'key', retry_queue=RetryQueue())
+
+        self.statuses.extend([503, 403])
+        reporter.submit_service_checks([{'check': 'a'}])
+        reporter.submit_service_checks([{'check': 'b'}])
+        # Only the server error is retried
+        nt.assert_equal(len(reporter.retry_queue), 1)
+        nt.assert_equal(reporter.retry_queue.next_retry, 0)
+
+        reporter.flush()
+        nt.assert_equal(len(reporter.retry_queue), 0)
+        nt.assert_equal(len(self.posts), 3)
+
+        # Connection errors are retried too
+        self.server.shutdown()
+        self.server.server_close()
+        reporter.session.close()
+        reporter.submit_service_checks([{'check': 'c'}])
+        nt.assert_equal(len(reporter.retry_queue), 1)
+        reporter.metrics_aggregator = MetricsAggregator('myhost')
+        reporter.send_retry_stats()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in reporter.metrics_aggregator.flush())
+        nt.assert_true(metrics['datadog.dogstatsd.retry_queue.size'] > 0)
+        nt.assert_equal(metrics['datadog.dogstatsd.retry_queue.dropped'], 0)
+
+    def test_spilled_events_api_key(self):
+        import os
+        import shutil
+        import tempfile
+        import simplejson as json
+        from dogstatsd import Reporter, RetryQueue
+        spill_dir = tempfile.mkdtemp()
+        try:
+            queue = RetryQueue(max_size=1, spill_dir=spill_dir, api_key='secretkey')
+            reporter = Reporter(1, MetricsBucketAggregator('myhost', interval=1),
+                'http://127.0.0.1:%s' % self.server.server_port, 'secretkey', retry_queue=queue)
+            self.statuses.extend([503, 503])
+            reporter.submit_events([{'title': 'first'}])
+            reporter.submit_events([{'title': 'second'}])
+            queue.close()
+
+            # Neither the URL nor the body of the events are spilled with the key
+            spilled = ''
+            for name in os.listdir(spill_dir):
+                with open(os.path.join(spill_dir, name), 'rb') as f:
+                    spilled += f.read()
+            nt.assert_true('second' in spilled)
+            nt.assert_false('secretkey' in spilled)
+
+            # It's set back when they're retried
+            for title in ('first', 'second'):
+                url, data, headers = queue.pop()
+                body = json.loads(data)
+                nt.assert_equal(body['events']['api'], [{'title': title}])
+                nt.assert_equal(body['apiKey'], 'secretkey')
+                nt.assert_true(url.endswith('api_key=secretkey'), url)
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_udp_drops_read_unlocked(self):
+        from dogstatsd import Reporter, Server
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        server = Server(aggregator, '127.0.0.1', 0)
+        reporter = Reporter(1, aggregator, 'http://127.0.0.1:%s' % self.server.server_port, 'key',
+            server=server)
+        reporter.interval = 0
+        locked = []
+
+        class DropCounter(object):
+            def dropped(self):
+                locked.append(server.submit_lock.locked())
+                reporter.stop()
+                return 7
+
+        server.drop_counter = DropCounter()
+        reporter.run()
+        # Submissions aren't blocked while /proc is read
+        nt.assert_equal(locked, [False])
+
+    def test_series_encoding(self):
+        import dogstatsd
+        api_host = 'http://127.0.0.1:%s' % self.server.server_port
+        metrics = [{'metric': 'my.gauge', 'points': [(1, 1)], 'tags': None, 'host': 'myhost',
+            'device_name': None, 'type': 'gauge', 'interval': 10}]
+        reporter = dogstatsd.Reporter(1, MetricsAggregator('myhost'), api_host, 'key')
+        nt.assert_equal(reporter.serialize_metrics, dogstatsd.serialize_metrics)
+        reporter.submit(metrics)
+        nt.assert_equal(self.posts, ['/api/v1/series'])
+
+        # Columnar series are only sent to the intake accepting them
+        reporter = dogstatsd.Reporter(1, MetricsAggregator('myhost'), api_host, 'key',
+            columnar_series_url=api_host + '/api/v1/series/columnar')
+        nt.assert_equal(reporter.serialize_metrics, dogstatsd.serialize_metrics_columnar)
+        reporter.submit(metrics)
+        nt.assert_equal(self.posts, ['/api/v1/series', '/api/v1/series/columnar'])
+
+    def test_compression_stats(self):
+        from dogstatsd import Reporter
+        reporter = Reporter(1, MetricsAggregator('myhost'), 'http://127.0.0.1:%s' % self.server.server_port, 'key')
+        reporter.send_compression_stats()
+        nt.assert_equal(reporter.metrics_aggregator.flush(), [])
+
+        reporter.compressor.record(3000, 1000, 0.002)
+        reporter.send_compression_stats()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in reporter.metrics_aggregator.flush())
+        nt.assert_equal(metrics, {
+            'datadog.dogstatsd.compression.ratio': 3,
+            'datadog.dogstatsd.compression.time': 2,
+            'datadog.dogstatsd.compression.level': 6,
+        })
+
+
 if __name__ == "__main__":
     unittest.main()
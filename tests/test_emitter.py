@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 import unittest
-from emitter import remove_control_chars
+import zlib
+
+import mock
+import simplejson as json
+
+from compression import Compressor
+from emitter import http_emitter, remove_control_chars
 
 class TestEmitter(unittest.TestCase):
 
@@ -13,3 +19,31 @@ class TestEmitter(unittest.TestCase):
 
         for bad, good in messages:
             self.assertTrue(remove_control_chars(bad) == good, (bad,good))
+
+    def test_post_headers(self):
+        from emitter import post_headers
+        agentConfig = {'version': '5.0.0'}
+        headers = post_headers(agentConfig, 'payload')
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        headers = post_headers(agentConfig, 'payload', 'gzip')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        headers = post_headers(agentConfig, 'payload', None)
+        self.assertFalse('Content-Encoding' in headers)
+
+    @mock.patch('emitter.requests.post')
+    def test_http_emitter_compression(self, post):
+        agentConfig = {'version': '5.0.0', 'dd_url': 'http://localhost:17123'}
+        message = {'apiKey': 'foo', 'metrics': []}
+
+        # Even small payloads are compressed
+        http_emitter(message, mock.Mock(), agentConfig)
+        kwargs = post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(kwargs['data'])), message)
+
+        compressor = Compressor('gzip')
+        http_emitter(message, mock.Mock(), agentConfig, compressor=compressor)
+        kwargs = post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(zlib.decompress(kwargs['data'], 16 + zlib.MAX_WBITS)), message)
+        self.assertNotEqual(compressor.report(), None)
@@ -1,6 +1,7 @@
+import random
 import unittest
 
-from aggregator import MetricsAggregator, Histogram
+from aggregator import MetricsAggregator, Histogram, ReservoirHistogram, SketchHistogram
 from config import get_histogram_aggregates, get_histogram_percentiles
 
 class TestHistogram(unittest.TestCase):
@@ -141,3 +142,149 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_summarize(self):
+        import aggregator
+        rand = random.Random(42)
+        for length in (1, 2, 20, 1000):
+            samples = [rand.randint(0, 100) for _ in xrange(length)] + [0.5]
+            ordered = sorted(samples)
+            length += 1
+            expected = (ordered[0], ordered[-1], ordered[int(round(length/2 - 1))],
+                sum(samples) / float(length),
+                [ordered[int(round(p * length - 1))] for p in (0.01, 0.5, 0.95, 0.999)])
+
+            # With numpy's selection when it's available, and by sorting
+            for module in set([aggregator.numpy, None]):
+                histogram = Histogram(None, 'myhistogram', None, 'myhost', None,
+                    {'percentiles': [0.01, 0.5, 0.95, 0.999]})
+                for value in samples:
+                    histogram.sample(value, 1)
+                original_numpy, aggregator.numpy = aggregator.numpy, module
+                try:
+                    self.assertEquals(histogram.summarize(), expected)
+                finally:
+                    aggregator.numpy = original_numpy
+
+        # Extrema only
+        histogram = Histogram(None, 'myhistogram', None, 'myhost', None,
+            {'aggregates': ['max', 'avg'], 'percentiles': []})
+        for value in (3, 1, 2):
+            histogram.sample(value, 1)
+        self.assertEquals(histogram.summarize(), (1, 3, None, 2, []))
+
+    def test_reservoir(self):
+        stats = MetricsAggregator('myhost', histogram_max_samples=1000,
+            histogram_percentiles=[0.5, 0.95])
+        self.assertEquals(stats.metric_type_to_class['h'], ReservoirHistogram)
+
+        for i in xrange(20000):
+            stats.submit_packets('myhistogram:{0}|h'.format(i % 10000))
+        histogram = stats.metrics.values()[0]
+        self.assertEquals(len(histogram.samples), 1000)
+
+        values = self.get_values(stats)
+        self.assertEquals(values['count'], 20000)
+        self.assertEquals(values['max'], 9999)
+        self.assertEquals(values['avg'], 4999.5)
+        self.assertTrue(abs(values['median'] - 5000) <= 500, (values['median'], 5000))
+        self.assertTrue(abs(values['50percentile'] - 5000) <= 500, (values['50percentile'], 5000))
+        self.assertTrue(abs(values['95percentile'] - 9500) <= 200, (values['95percentile'], 9500))
+
+    def test_reservoir_sample_rate(self):
+        histogram = ReservoirHistogram(None, 'myhistogram', None, 'myhost', None,
+            {'percentiles': [0.5], 'max_samples': 1000})
+        other = ReservoirHistogram(None, 'myhistogram', None, 'myhost', None,
+            {'percentiles': [0.5], 'max_samples': 1000})
+        # Values sent at a 0.1 sample rate stand for 10 times as many
+        for i in xrange(10000):
+            histogram.sample(0, 1)
+            other.sample(1, 0.1)
+
+        histogram.merge(other)
+        self.assertEquals(histogram.count, 110000)
+        self.assertEquals(len(histogram.samples), 1000)
+        self.assertTrue(850 < sum(histogram.samples) < 970, sum(histogram.samples))
+        min_, max_, med, avg, percentiles = histogram.summarize()
+        self.assertEquals((min_, max_, med, avg, percentiles), (0, 1, 1, 0.5, [1]))
+
+    def get_values(self, stats, name='myhistogram'):
+        value_by_type = {}
+        for k in stats.flush():
+            value_by_type[k['metric'][len(name)+1:]] = k['points'][0][1]
+        return value_by_type
+
+    def test_sketch(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch',
+            histogram_percentiles=[0.5, 0.95, 0.99])
+        exact = MetricsAggregator('myhost', histogram_percentiles=[0.5, 0.95, 0.99])
+
+        rand = random.Random(42)
+        for i in xrange(10000):
+            packet = 'myhistogram:{0}|h'.format(rand.lognormvariate(3, 2))
+            stats.submit_packets(packet)
+            exact.submit_packets(packet)
+        stats.submit_packets('myhistogram:0|h')
+        exact.submit_packets('myhistogram:0|h')
+
+        values = self.get_values(stats)
+        exact_values = self.get_values(exact)
+        self.assertEquals(sorted(values.keys()), sorted(exact_values.keys()))
+        for name in ('count', 'max'):
+            self.assertEquals(values[name], exact_values[name], name)
+        self.assertAlmostEquals(values['avg'], exact_values['avg'])
+        for name in ('median', '50percentile', '95percentile', '99percentile'):
+            self.assertTrue(abs(values[name] - exact_values[name]) <= 0.01 * exact_values[name],
+                (name, values[name], exact_values[name]))
+
+    def test_sketch_small(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch',
+            histogram_relative_accuracy=0.001)
+        self.assertEquals(stats.metric_type_to_class['ms'], SketchHistogram)
+
+        for i in xrange(20):
+            stats.submit_packets('myhistogram:{0}|h'.format(i - 5))
+
+        values = self.get_values(stats)
+        self.assertEquals(values['max'], 14)
+        self.assertEquals(values['avg'], 4.5)
+        self.assertEquals(values['count'], 20.0)
+        self.assertTrue(abs(values['median'] - 4) <= 0.004, (values['median'], 4))
+        self.assertTrue(abs(values['95percentile'] - 13) <= 0.013, (values['95percentile'], 13))
+
+        stats.submit_packets('myhistogram:-3|h')
+        values = self.get_values(stats)
+        self.assertEquals(values['median'], -3)
+        self.assertEquals(values['95percentile'], -3)
+
+    def test_sketch_ranks(self):
+        # Same order statistics as Histogram, including the negative ranks of few samples
+        config = {'percentiles': [0.01, 0.2, 0.5, 0.95], 'relative_accuracy': 0.001}
+        for length in (1, 2, 3, 10):
+            histogram = Histogram(None, 'myhistogram', None, 'myhost', None, config)
+            sketch = SketchHistogram(None, 'myhistogram', None, 'myhost', None, config)
+            for value in xrange(1, length + 1):
+                histogram.sample(value * 10, 1)
+                sketch.sample(value * 10, 1)
+            expected = histogram.summarize()
+            min_, max_, med, avg, percentiles = sketch.summarize()
+            self.assertEquals((min_, max_, avg), expected[:2] + expected[3:4])
+            for value, expected_value in zip([med] + percentiles, [expected[2]] + expected[4]):
+                self.assertTrue(abs(value - expected_value) <= 0.01 * expected_value, (value, expected_value))
+
+    def test_sketch_bounded_merge(self):
+        sketch = SketchHistogram(None, 'myhistogram', None, 'myhost', None)
+        other = SketchHistogram(None, 'myhistogram', None, 'myhost', None)
+        sketch.max_buckets = other.max_buckets = 10
+        for i in xrange(1, 1000):
+            sketch.sample(i, 1)
+            other.sample(-i, 1)
+        self.assertEquals(len(sketch.positive), 10)
+
+        sketch.merge(other)
+        self.assertEquals(sketch.count, 1998)
+        self.assertEquals(len(sketch.negative), 10)
+        min_, max_, med, avg, percentiles = sketch.summarize()
+        self.assertEquals((min_, max_, avg), (-999, 999, 0))
+        # The 95th percentile is in a bucket that wasn't collapsed
+        self.assertTrue(abs(percentiles[0] - 899) <= 9, percentiles[0])
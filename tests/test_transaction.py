@@ -2,6 +2,7 @@
 import unittest
 from datetime import timedelta, datetime
 import time
+import zlib
 
 # 3rd party
 from tornado.web import Application
@@ -12,7 +13,7 @@ import simplejson as json
 # project
 from transaction import Transaction, TransactionManager
 from ddagent import (MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY,
-    MetricTransaction, APIMetricTransaction)
+    EmitterManager, MetricTransaction, APIMetricTransaction)
 from config import get_version
 from util import get_tornado_ioloop
 
@@ -106,6 +107,24 @@ class TestTransaction(unittest.TestCase):
             "before = %s after = %s" % (before, after))
 
 
+    def testEmitterManagerEncodings(self):
+        class memEmitterThread(object):
+            name = 'mem'
+            def __init__(self):
+                self.data = []
+            def enqueue(self, data, headers):
+                self.data.append(data)
+
+        emitterThread = memEmitterThread()
+        manager = EmitterManager({})
+        manager.emitterThreads = [emitterThread]
+        payload = json.dumps({'metrics': []})
+        manager.send(payload)
+        manager.send(zlib.compress(payload), {'Content-Encoding': 'deflate'})
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        manager.send(gzip.compress(payload) + gzip.flush(), {'Content-Encoding': 'gzip'})
+        self.assertEqual(emitterThread.data, [{'metrics': []}] * 3)
+
     def testCustomEndpoint(self):
         MetricTransaction._endpoints = []
         